@@ -25,19 +25,46 @@
 #include <intrin.h>
 #define popcount32 __popcnt
 #define popcount64 __popcnt64
+#define FORCE_INLINE __forceinline
 #else
 #define popcount32 __builtin_popcount
 #define popcount64 __builtin_popcountll
+#define FORCE_INLINE inline __attribute__((always_inline))
+#endif
+
+// SIMD kernels are compiled for specific instruction sets with target attributes and picked at runtime,
+// so the rest of the extension can be built for the baseline architecture
+#if (defined(__GNUC__) || defined(__clang__)) && (defined(__x86_64__) || defined(__i386__))
+#define HASHRANKING_X86_SIMD
+#include <immintrin.h>
+#define TARGET_POPCNT __attribute__((target("popcnt")))
+#define TARGET_AVX2 __attribute__((target("avx2,popcnt")))
+#define TARGET_AVX512 __attribute__((target("avx512f,avx512vpopcntdq,popcnt")))
+#define TARGET_AVX512BW __attribute__((target("avx512f,avx512bw")))
 #endif
 
 #include <inttypes.h>
 #include <algorithm>
+#include <array>
+#include <atomic>
+#include <chrono>
+#include <cmath>
+#include <cstring>
+#include <exception>
+#include <limits>
+#include <mutex>
+#include <string>
+#include <thread>
+#include <unordered_map>
+#include <vector>
 
 namespace py = pybind11;
 
 typedef py::array_t<float, py::array::c_style> ndarray_float;
 typedef py::array_t<uint8_t, py::array::c_style> ndarray_uint8;
 typedef py::array_t<uint32_t, py::array::c_style> ndarray_uint32;
+typedef py::array_t<uint16_t, py::array::c_style> ndarray_uint16;
+typedef py::array_t<int32_t, py::array::c_style> ndarray_int32;
 typedef py::array_t<uint64_t, py::array::c_style> ndarray_uint64;
 
 inline uint8_t hamming_distance32(uint32_t x, uint32_t y)
@@ -67,433 +94,3504 @@ inline uint8_t hamming_distance(uint64_t x, uint64_t y)
 	return hamming_distance64(x, y);
 }
 
-inline void to_int32_hashes(py::array_t<float, py::array::c_style> x, uint32_t* __restrict out)
+inline int get_num_threads(int num_threads)
 {
-	auto p = x.unchecked<2>();
-	int w = (int)p.shape(1);
-	int h = (int)p.shape(0);
-
-	for (int i = 0; i < h; ++i)
+	if (num_threads <= 0)
 	{
-		uint32_t output = 0;
-		uint32_t power = 1;
-		const float* __restrict hash = p.data(i, 0);
-
-		for (int y = 0; y < w; ++y)
-		{
-			output += (hash[y] > 0.0f ? power : 0);
-			power *= 2;
-		}
-		out[i] = output;
+		num_threads = (int)std::thread::hardware_concurrency();
 	}
+	return std::max(num_threads, 1);
 }
 
-inline void to_int64_hashes(py::array_t<float, py::array::c_style> x, uint64_t* __restrict out)
+// Splits range [0, size) into contiguous chunks, one per thread, and calls f(begin, end, thread_id) for each of them.
+// Chunks are assigned in order, so thread_id also gives the order of the chunks.
+// An exception thrown by any of the threads is rethrown on the calling thread after all of them are joined
+template<typename F>
+void parallel_for(ssize_t size, int num_threads, F f)
 {
-	auto p = x.unchecked<2>();
-	int w = (int)p.shape(1);
-	int h = (int)p.shape(0);
+	num_threads = (int)std::max<ssize_t>(std::min<ssize_t>(num_threads, size), 1);
+
+	if (num_threads == 1)
+	{
+		f((ssize_t)0, size, 0);
+		return;
+	}
 
-	for (int i = 0; i < h; ++i)
+	std::vector<std::exception_ptr> errors(num_threads);
+	auto run = [&errors](F g, ssize_t begin, ssize_t end, int thread_id)
 	{
-		uint64_t output = 0;
-		uint64_t power = 1;
-		const float* __restrict hash = p.data(i, 0);
+		try
+		{
+			g(begin, end, thread_id);
+		}
+		catch (...)
+		{
+			errors[thread_id] = std::current_exception();
+		}
+	};
 
-		for (int y = 0; y < w; ++y)
+	std::vector<std::thread> threads;
+	try
+	{
+		for (int t = 0; t < num_threads; ++t)
+		{
+			ssize_t begin = size * t / num_threads;
+			ssize_t end = size * (t + 1) / num_threads;
+			threads.emplace_back(run, f, begin, end, t);
+		}
+	}
+	catch (...)
+	{
+		for (auto& thread: threads)
+		{
+			thread.join();
+		}
+		throw;
+	}
+	for (auto& thread: threads)
+	{
+		thread.join();
+	}
+	for (auto& error: errors)
+	{
+		if (error)
 		{
-			output += (hash[y] > 0.0f ? power : 0);
-			power *= 2;
+			std::rethrow_exception(error);
 		}
-		out[i] = output;
 	}
 }
 
 template<typename T>
-void to_int_hashes(py::array_t<float, py::array::c_style> x, T* out);
-
-template<>
-inline void to_int_hashes(py::array_t<float, py::array::c_style> x, uint32_t* out)
+inline int hamming_distance(const T* __restrict x, const T* __restrict y, int words)
 {
-	to_int32_hashes(x, out);
+	int d = 0;
+	for (int k = 0; k < words; ++k)
+	{
+		d += hamming_distance<T>(x[k], y[k]);
+	}
+	return d;
 }
 
-template<>
-inline void to_int_hashes(py::array_t<float, py::array::c_style> x, uint64_t* out)
+// Number of words of type T needed to store a hash of the given width
+template<typename T>
+inline int words_per_hash(ssize_t bits)
 {
-	to_int64_hashes(x, out);
+	const ssize_t word_bits = 8 * sizeof(T);
+	return (int)((bits + word_bits - 1) / word_bits);
 }
 
+// Distances are uint8 while hash takes less than four uint64 words, that is up to 192 bits, otherwise uint16 is used.
+// Packed hashes keep only the number of words, so the dtype is decided by words rather than by bits
 template<typename T>
-void _hamming_distance(T* __restrict b2, ssize_t b2_size, T b1, uint8_t* out)
+inline bool is_wide_distance(int words)
 {
-	ssize_t j = 0;
-	for (; j + 3 < b2_size; j += 4)
+	return 8 * sizeof(T) * words >= 256;
+}
+
+// Formats of float hashes. A bit of the hash is set when the element is greater than zero. For 16-bit formats it is
+// checked on raw bits: positive numbers, including infinity and excluding NaN, are the range [1, positive_max]
+struct float32_format
+{
+	typedef float type;
+	static bool positive(float x) { return x > 0.0f; }
+};
+
+struct float64_format
+{
+	typedef double type;
+	static bool positive(double x) { return x > 0.0; }
+};
+
+struct float16_format
+{
+	typedef uint16_t type;
+	static const uint16_t positive_max = 0x7c00;
+	static bool positive(uint16_t x) { return (uint16_t)(x - 1) < positive_max; }
+};
+
+struct bfloat16_format
+{
+	typedef uint16_t type;
+	static const uint16_t positive_max = 0x7f80;
+	static bool positive(uint16_t x) { return (uint16_t)(x - 1) < positive_max; }
+};
+
+// Packs signs of one hash of w elements into ceil(w / 64) words. Full words have fixed trip count and use selects
+// instead of branches, so that compiler can unroll them
+template<typename F>
+void _pack_signs_scalar(const typename F::type* __restrict x, ssize_t w, uint64_t* __restrict out)
+{
+	ssize_t begin = 0;
+	for (; begin + 64 <= w; begin += 64)
 	{
-		out[j + 0] = hamming_distance<T>(b2[j + 0], b1);
-		out[j + 1] = hamming_distance<T>(b2[j + 1], b1);
-		out[j + 2] = hamming_distance<T>(b2[j + 2], b1);
-		out[j + 3] = hamming_distance<T>(b2[j + 3], b1);
+		uint64_t word = 0;
+		uint64_t bit = 1;
+		for (int y = 0; y < 64; ++y)
+		{
+			word |= F::positive(x[begin + y]) ? bit : 0;
+			bit <<= 1;
+		}
+		out[begin / 64] = word;
 	}
-	for (; j < b2_size; ++j)
+	if (begin < w)
 	{
-		out[j] = hamming_distance<T>(b2[j], b1);
+		uint64_t word = 0;
+		for (ssize_t y = begin; y < w; ++y)
+		{
+			word |= (uint64_t)F::positive(x[y]) << (y - begin);
+		}
+		out[begin / 64] = word;
 	}
 }
 
-template<typename T>
-ndarray_uint8 _hamming_distance(ndarray_float b1, ndarray_float b2)
+// Sign packing kernel currently in use for the given format
+template<typename F>
+struct sign_kernel
 {
-	py::buffer_info buf1 = b1.request(), buf2 = b2.request();
-	
-	py::gil_scoped_release release;
-	
-	ndarray_uint8 result = ndarray_uint8(std::vector<ssize_t>{buf1.shape[0], buf2.shape[0]});
-	auto r = result.mutable_unchecked<2>();
-	
-	T* __restrict b1_int = (T*)(malloc(sizeof(T) * buf1.shape[0]));
-	T* __restrict b2_int = (T*)(malloc(sizeof(T) * buf2.shape[0]));
-	to_int_hashes<T>(b1, b1_int);
-	to_int_hashes<T>(b2, b2_int);
-	
-	for (ssize_t i = 0, l = buf1.shape[0]; i < l; ++i)
+	typedef void (*function)(const typename F::type* __restrict x, ssize_t w, uint64_t* __restrict out);
+	static function active;
+};
+
+template<typename F>
+typename sign_kernel<F>::function sign_kernel<F>::active = &_pack_signs_scalar<F>;
+
+// Packs h hashes of w elements, which can be laid out with arbitrary strides given in bytes. Rows with non-unit
+// element stride are gathered one at a time into a buffer, so the input is never copied as a whole
+template<typename T, typename F>
+inline void to_int_hashes(const char* x, ssize_t h, ssize_t w, ssize_t row_stride, ssize_t col_stride, T* __restrict out, int words, int num_threads)
+{
+	typedef typename F::type E;
+	const int words64 = words_per_hash<uint64_t>(w);
+	const bool contiguous = col_stride == (ssize_t)sizeof(E);
+
+	parallel_for(h, num_threads, [&](ssize_t begin, ssize_t end, int)
 	{
-		uint8_t* __restrict ptr = r.mutable_data(i, 0);
-		T b1_i = b1_int[i];
-		_hamming_distance<T>(b2_int, buf2.shape[0], b1_i, ptr);
-	}
-	free(b1_int);
-	free(b2_int);
-	
-	return result;
+		std::vector<uint64_t> buffer(words64);
+		std::vector<E> row(contiguous ? 0 : w);
+		for (ssize_t i = begin; i < end; ++i)
+		{
+			const char* row_ptr = x + i * row_stride;
+			if (!contiguous)
+			{
+				for (ssize_t y = 0; y < w; ++y)
+				{
+					memcpy(&row[y], row_ptr + y * col_stride, sizeof(E));
+				}
+				row_ptr = (const char*)row.data();
+			}
+			sign_kernel<F>::active((const E*)row_ptr, w, buffer.data());
+
+			// Words are split into words of type T starting from the lowest bits
+			T* __restrict hash = out + i * words;
+			for (int k = 0; k < words; ++k)
+			{
+				int shift = (int)(8 * sizeof(T) * k);
+				hash[k] = shift / 64 < words64 ? (T)(buffer[shift / 64] >> (shift % 64)) : 0;
+			}
+		}
+	});
 }
 
-ndarray_uint8 hamming_distance(ndarray_float b1, ndarray_float b2)
+// Profiling counters of the stages of the computation. Counting is off by default, and then each timed block only
+// costs one relaxed load of the flag
+enum stage_t
+{
+	STAGE_PACK,
+	STAGE_DISTANCE,
+	STAGE_SORT,
+	STAGE_SIMILARITY,
+	STAGE_HISTOGRAM,
+	STAGE_RANK,
+	STAGE_AVERAGE_PRECISION,
+	STAGE_ASYMMETRIC,
+	STAGE_RERANK,
+	STAGE_COUNT
+};
+
+const char* stage_names[STAGE_COUNT] = {"pack", "distance", "sort", "similarity", "histogram", "rank", "average_precision", "asymmetric", "rerank"};
+
+struct stage_counters
 {
-	py::buffer_info buf1 = b1.request(), buf2 = b2.request();
+	std::atomic<uint64_t> calls;
+	std::atomic<uint64_t> nanoseconds;
+	std::atomic<uint64_t> bytes;
+};
 
-	if (buf1.ndim != 2 || buf2.ndim != 2)
-		throw std::runtime_error("Number of dimensions must be two");
+stage_counters stage_stats[STAGE_COUNT];
+std::atomic<bool> stats_enabled(false);
 
-	if (buf1.shape[1] != buf2.shape[1])
-		throw std::runtime_error("Second dimension must match");
-	
-	if (buf1.shape[1] > 64)
-		throw std::runtime_error("Supports only hashes up to 64b");
-	
-	bool hash32 = buf1.shape[1] <= 32;
-	
-	if (hash32)
+// Adds time spent in its scope, `bytes` and one call to the counters of a stage, if counting is enabled
+class stage_timer
+{
+public:
+	stage_timer(stage_t stage, uint64_t bytes): stage(stage), bytes(bytes), enabled(stats_enabled.load(std::memory_order_relaxed))
 	{
-		return _hamming_distance<uint32_t>(b1, b2);
+		if (enabled)
+			start = std::chrono::steady_clock::now();
 	}
-	else
+
+	~stage_timer()
 	{
-		return _hamming_distance<uint64_t>(b1, b2);
+		if (enabled)
+		{
+			uint64_t ns = (uint64_t)std::chrono::duration_cast<std::chrono::nanoseconds>(std::chrono::steady_clock::now() - start).count();
+			stage_stats[stage].calls.fetch_add(1, std::memory_order_relaxed);
+			stage_stats[stage].nanoseconds.fetch_add(ns, std::memory_order_relaxed);
+			stage_stats[stage].bytes.fetch_add(bytes, std::memory_order_relaxed);
+		}
 	}
-}
 
-void argsort_1d(uint32_t* __restrict out_ptr, const uint8_t* __restrict d_ptr, ssize_t size)
+private:
+	stage_t stage;
+	uint64_t bytes;
+	bool enabled;
+	std::chrono::steady_clock::time_point start;
+};
+
+void enable_stats(bool enabled)
 {
-	int32_t count[65];
-	memset(count, 0, sizeof(int32_t) * 65);
-	
-	for (ssize_t y = 0; y < size; ++y)
-		count[d_ptr[y]]++;	 
-	
-	for (int i = 1; i < 65; ++i)
-	{
-		count[i] += count[i - 1];	
-	}
-	
-	for (ssize_t y = size -1; y >= 0; --y)
-	{
-		int8_t key = d_ptr[y];	 
-		out_ptr[count[key] - 1] = (uint32_t)y;	 
-		count[key] -= 1;   
-	} 
+	stats_enabled.store(enabled);
 }
 
-ndarray_uint32 argsort(ndarray_uint8 distance)
+bool is_stats_enabled()
 {
-	py::buffer_info d_info = distance.request();
-	
-	py::gil_scoped_release release;
-	
-	if (d_info.ndim != 2)
-		throw std::runtime_error("Number of dimensions must be two");
+	return stats_enabled.load();
+}
 
-	ssize_t l1 = d_info.shape[0];
-	ssize_t l2 = d_info.shape[1];
-	
-	ndarray_uint32 result = ndarray_uint32(std::vector<ssize_t>{l1, l2});
-	
-	auto r = result.mutable_unchecked<2>();
-	auto d = distance.unchecked<2>();
-	
-	for (ssize_t x = 0; x < l1; ++x)
+py::dict stats()
+{
+	py::dict result;
+	for (int s = 0; s < STAGE_COUNT; ++s)
 	{
-		uint32_t* __restrict out_ptr = r.mutable_data(x, 0);
-		const uint8_t* __restrict d_ptr = d.data(x, 0);
-		
-		argsort_1d(out_ptr, d_ptr, l2);
+		py::dict stage;
+		stage["calls"] = stage_stats[s].calls.load();
+		stage["nanoseconds"] = stage_stats[s].nanoseconds.load();
+		stage["bytes"] = stage_stats[s].bytes.load();
+		result[stage_names[s]] = stage;
 	}
-	
 	return result;
 }
 
-inline double compute_average_precision(
-	const uint32_t* __restrict rank, 
-	const uint8_t* __restrict similarity, 
-	float* __restrict precision,
-	float* __restrict recall,
-	float* __restrict av_precision,
-	float* __restrict av_recall,
-	uint8_t* __restrict relevance, 
-	int* __restrict cumulative, 
-	ssize_t N, int top_n)
+void reset_stats()
 {
-	for (int i =0; i < top_n; ++i)
+	for (int s = 0; s < STAGE_COUNT; ++s)
 	{
-		uint32_t index = rank[i];
-		relevance[i] = similarity[index];
+		stage_stats[s].calls = 0;
+		stage_stats[s].nanoseconds = 0;
+		stage_stats[s].bytes = 0;
 	}
-	
-	cumulative[0] = relevance[0];
-	for (int i = 1; i < top_n; ++i)
+}
+
+// Scratch and output buffers that are kept between calls, so that repeated calls do not allocate memory. Entry points
+// take it as an optional argument, and use a temporary one for the duration of the call when it is not given
+class Workspace
+{
+public:
+	// Slots of per-thread scratch buffers
+	enum slot_t
 	{
-		cumulative[i] = relevance[i] + cumulative[i - 1];
+		DISTANCE,
+		SIMILARITY,
+		POSITION,
+		RELEVANT,
+		COUNT,
+		CANDIDATES,
+		CANDIDATE_DISTANCE,
+		SELECTION,
+		TABLE,
+		SLOT_COUNT
+	};
+
+	// Makes room for scratch buffers of the given number of threads. Must be called before the threads start
+	void reserve(int threads)
+	{
+		if ((int)scratch_buffers.size() < threads)
+		{
+			scratch_buffers.resize(threads);
+		}
 	}
-    
-	int max_number_of_relevant_documents = cumulative[top_n - 1];
-    
-	for (int i = top_n; i < N; ++i)
+
+	// Returns scratch buffer of n elements, contents are undefined. Each thread may only access its own buffers
+	template<typename X>
+	X* scratch(int thread_id, slot_t slot, size_t n)
 	{
-		uint32_t index = rank[i];
-		max_number_of_relevant_documents += similarity[index];
+		std::vector<uint64_t>& buffer = scratch_buffers[thread_id][slot];
+		size_t words = (n * sizeof(X) + sizeof(uint64_t) - 1) / sizeof(uint64_t);
+		if (buffer.size() < words)
+		{
+			buffer.resize(words);
+		}
+		return (X*)buffer.data();
 	}
-	max_number_of_relevant_documents = std::min(max_number_of_relevant_documents, top_n);
-    
-	if (max_number_of_relevant_documents != 0)
+
+	// Storage of packed float hashes, 0 is for the database and 1 is for queries
+	template<typename T>
+	std::vector<T>& storage(int i);
+
+	// Returns output array of the given shape. The array is reused by the next call with the same key and shape,
+	// so that its contents are overwritten. Must be called with GIL held
+	template<typename X>
+	py::array_t<X, py::array::c_style> output(const std::string& key, const std::vector<ssize_t>& shape)
 	{
-		for (int i = 0; i < top_n; ++i)
+		auto it = outputs.find(key);
+		if (it != outputs.end() && py::array_t<X, py::array::c_style>::check_(it->second))
 		{
-			precision[i] = cumulative[i] / float(i+1);
-			recall[i] = cumulative[i] / float(max_number_of_relevant_documents);
+			py::array_t<X, py::array::c_style> a = py::reinterpret_borrow<py::array_t<X, py::array::c_style> >(it->second);
+			if (std::vector<ssize_t>(a.shape(), a.shape() + a.ndim()) == shape)
+			{
+				return a;
+			}
 		}
-    
-		for (int i = 0; i < top_n; ++i)
+		py::array_t<X, py::array::c_style> a(shape);
+		outputs[key] = a;
+		return a;
+	}
+
+	// Number of bytes held by all buffers. Must be called with GIL held
+	size_t nbytes()
+	{
+		std::unique_lock<std::mutex> lock = acquire();
+		size_t result = sizeof(uint32_t) * (storage32[0].capacity() + storage32[1].capacity()) + sizeof(uint64_t) * (storage64[0].capacity() + storage64[1].capacity());
+		for (auto& buffers : scratch_buffers)
 		{
-			av_precision[i] += precision[i];
-			av_recall[i] += recall[i];
+			for (auto& buffer : buffers)
+			{
+				result += sizeof(uint64_t) * buffer.capacity();
+			}
 		}
-    
-		double ap = 0.0;
-		for (int i = 0; i < top_n; ++i)
+		for (auto& output : outputs)
 		{
-			ap += precision[i] * relevance[i];
+			result += py::array(output.second).nbytes();
 		}
-		ap /= max_number_of_relevant_documents;
-		return ap;
+		return result;
 	}
-	return 0.0;
-}
-
-std::tuple<double, ndarray_float, ndarray_float> compute_map_from_rank(ndarray_uint32 rank, ndarray_uint8 similarity, int top_n)
-{
-	py::buffer_info r_info = rank.request();
-	py::buffer_info s_info = similarity.request();
-
-	py::gil_scoped_release release;
-
-	if (r_info.ndim != 2)
-		throw std::runtime_error("Number of dimensions for rank must be two");
 
-	if (s_info.ndim != 2)
-		throw std::runtime_error("Number of dimensions for similarity must be two");
-
-	if (s_info.shape != r_info.shape)
-		throw std::runtime_error("Shape of rank must match shape of labels_query");
-
-	if (top_n > r_info.shape[1])
-		throw std::runtime_error("top_n must not be greater than second dimension of rank");
+	// Frees all buffers. Arrays returned earlier stay valid. Must be called with GIL held
+	void clear()
+	{
+		std::unique_lock<std::mutex> lock = acquire();
+		std::vector<std::array<std::vector<uint64_t>, SLOT_COUNT> >().swap(scratch_buffers);
+		std::vector<uint32_t>().swap(storage32[0]);
+		std::vector<uint32_t>().swap(storage32[1]);
+		std::vector<uint64_t>().swap(storage64[0]);
+		std::vector<uint64_t>().swap(storage64[1]);
+		outputs.clear();
+	}
 
-	ssize_t Q = r_info.shape[0];
-	ssize_t N = r_info.shape[1];
+	// Entry points hold it after releasing GIL, while they use scratch and storage buffers. It does not protect output
+	// arrays, which are handed out before, so a workspace must not be used by several threads at once
+	std::mutex mutex;
 
-	if (top_n == 0)
+private:
+	// Locks the mutex with GIL released while waiting, so that a call that holds it is not blocked by GIL
+	std::unique_lock<std::mutex> acquire()
 	{
-		top_n = (int)N;
+		py::gil_scoped_release release;
+		return std::unique_lock<std::mutex>(mutex);
 	}
 
-	auto s = similarity.unchecked<2>();
-	auto r = rank.unchecked<2>();
+	std::vector<std::array<std::vector<uint64_t>, SLOT_COUNT> > scratch_buffers;
+	std::vector<uint32_t> storage32[2];
+	std::vector<uint64_t> storage64[2];
+	std::unordered_map<std::string, py::object> outputs;
+};
 
-	uint8_t* relevance = (uint8_t*)(malloc(sizeof(uint8_t) * top_n));
-	int* cumulative = (int*)(malloc(sizeof(int) * top_n));
-	float* precision = (float*)(malloc(sizeof(float) * top_n));
-	float* recall = (float*)(malloc(sizeof(float) * top_n));
-	
-	float* __restrict av_precision = (float*)(malloc(sizeof(float) * top_n));
-	float* __restrict av_recall = (float*)(malloc(sizeof(float) * top_n));
-	
-	memset(av_precision, 0, sizeof(float) * top_n);
-	memset(av_recall, 0, sizeof(float) * top_n);
+template<>
+std::vector<uint32_t>& Workspace::storage<uint32_t>(int i)
+{
+	return storage32[i];
+}
 
-	double map = 0.0;
+template<>
+std::vector<uint64_t>& Workspace::storage<uint64_t>(int i)
+{
+	return storage64[i];
+}
 
-	for (int q = 0; q < Q; ++q)
-	{
-		const uint32_t* rank_ptr = r.data(q, 0);
-		const uint8_t* similarity_ptr = s.data(q, 0);
+// When set, inputs that would have to be converted or copied raise TypeError instead
+bool strict_inputs = false;
 
-		double ap = compute_average_precision(rank_ptr, similarity_ptr, precision, recall, av_precision, av_recall, relevance, cumulative, N, top_n);
-		map += ap;
-	}
-	
-	map /= Q;
-	
-	for (int i = 0; i < top_n; ++i)
-	{
-		av_precision[i] /= Q;
-		av_recall[i] /= Q;
-	}
+void set_strict(bool strict)
+{
+	strict_inputs = strict;
+}
 
-	free(relevance);
-	free(precision);
-	free(recall);
-	free(cumulative);
+bool is_strict()
+{
+	return strict_inputs;
+}
 
-	py::gil_scoped_acquire acquire;
-	return std::tuple<double, ndarray_float, ndarray_float>(map, 
-		ndarray_float(top_n, av_precision),
-		ndarray_float(top_n, av_recall)
-		);
+inline char dtype_kind(const py::dtype& d)
+{
+	return ((std::string)py::str(d.attr("kind")))[0];
 }
 
+// Tells whether x is an array of elements of type T, in any byte order. Dtypes are compared by kind and size, not by
+// identity, since an equal dtype can be a different object, for example in an unpickled array
 template<typename T>
-std::tuple<double, ndarray_float, ndarray_float> _compute_map_from_hashes(ndarray_float hashes_db, ndarray_float hashes_query, ndarray_uint32 labels_db, ndarray_uint32 labels_query, int top_n)
+inline bool is_array_of(py::handle x)
 {
-	py::buffer_info hashes_db_info = hashes_db.request(), hashes_query_info = hashes_query.request();
-	py::buffer_info labels_db_info = labels_db.request(), labels_query_info = labels_query.request();
-
-	T* __restrict hashes_db_int = (T*)(malloc(sizeof(T) * hashes_db_info.shape[0]));
-	T* __restrict hashes_query_int = (T*)(malloc(sizeof(T) * hashes_query_info.shape[0]));
-	to_int_hashes<T>(hashes_db, hashes_db_int);
-	to_int_hashes<T>(hashes_query, hashes_query_int);
+	if (!py::isinstance<py::array>(x))
+		return false;
+	py::dtype d = py::reinterpret_borrow<py::array>(x).dtype();
+	py::dtype t = py::dtype::of<T>();
+	return dtype_kind(d) == dtype_kind(t) && d.itemsize() == t.itemsize();
+}
 
-	ssize_t Q = hashes_query_info.shape[0];
-	ssize_t N = hashes_db_info.shape[0];
+// Returns x as a C-contiguous array of type T. Other arrays are converted, unless strict mode is on
+template<typename T>
+py::array_t<T, py::array::c_style> as_array(py::handle x, const std::string& name)
+{
+	typedef py::array_t<T, py::array::c_style> array_type;
+	std::string dtype = py::str(py::dtype::of<T>());
+	if (array_type::check_(x))
+		return py::reinterpret_borrow<array_type>(x);
+	if (strict_inputs)
+		throw py::type_error(name + " must be a C-contiguous " + dtype + " array, strict mode does not allow conversion");
+	array_type a = array_type::ensure(x);
+	if (!a)
+		throw py::type_error(name + " must be an array of " + dtype);
+	return a;
+}
 
-	if (top_n == 0)
+enum hash_format_t
+{
+	HASH_FLOAT32,
+	HASH_FLOAT64,
+	HASH_FLOAT16,
+	HASH_BFLOAT16,
+	HASH_PACKED
+};
+
+// Hashes passed from Python. Either a float array, where the sign of each element gives a bit,
+// or a uint64 array of hashes that were already packed with pack_hashes.
+// float16, bfloat16, float32 and float64 arrays with any strides are read as they are, without a copy
+struct hash_array
+{
+	// `dtype` can be given to read raw 16-bit integers as float16 or bfloat16, for example a view of a tensor
+	explicit hash_array(py::handle x, const std::string& dtype = "")
 	{
-		top_n = (int)N;
-	}
-
-	const uint32_t* labels_db_ptr = labels_db.unchecked<1>().data(0);
-	const uint32_t* labels_query_ptr = labels_query.unchecked<1>().data(0);
-
-	uint8_t* similarity = (uint8_t*)(malloc(sizeof(uint8_t) * N));
-	uint8_t* relevance = (uint8_t*)(malloc(sizeof(uint8_t) * top_n));
-	int* cumulative = (int*)(malloc(sizeof(int) * top_n));
-	float* precision = (float*)(malloc(sizeof(float) * top_n));
-	float* recall = (float*)(malloc(sizeof(float) * top_n));
-	
-	float* __restrict av_precision = (float*)(malloc(sizeof(float) * top_n));
-	float* __restrict av_recall = (float*)(malloc(sizeof(float) * top_n));
-	
-	uint8_t* __restrict dist = (uint8_t*)(malloc(sizeof(uint8_t) * N));
-	uint32_t* __restrict rank = (uint32_t*)(malloc(sizeof(uint32_t) * N));
+		if (py::isinstance<py::array>(x))
+		{
+			array = py::reinterpret_borrow<py::array>(x);
+		}
+		else
+		{
+			if (strict_inputs)
+				throw py::type_error("Hashes must be a numpy array, strict mode does not allow conversion");
+			array = py::array::ensure(x);
+			if (!array)
+				throw py::type_error("Hashes must be either a float array or a uint64 array of packed hashes");
+		}
 
-	memset(av_precision, 0, sizeof(float) * top_n);
-	memset(av_recall, 0, sizeof(float) * top_n);
+		format = get_format(array.dtype(), dtype);
+		if (!dtype.empty() && format != HASH_FLOAT16 && format != HASH_BFLOAT16)
+			throw py::value_error("dtype must be float16 or bfloat16 and hashes must be a 16-bit array");
 
-	double map = 0.0;
+		if (format == HASH_PACKED && !py::array_t<uint64_t, py::array::c_style>::check_(array))
+		{
+			// Packed hashes are used in place, so they must be contiguous
+			array = as_array<uint64_t>(array, "Packed hashes");
+		}
+		else if (format < 0)
+		{
+			// Other types, for example integer hashes of +1 and -1, are converted to float32
+			array = as_array<float>(array, "Hashes");
+			format = HASH_FLOAT32;
+		}
+		packed = format == HASH_PACKED;
+
+		ndim = array.ndim();
+		size = ndim > 0 ? array.shape(0) : 0;
+		bits = ndim > 1 ? (packed ? 64 * array.shape(1) : array.shape(1)) : 0;
+		row_stride = ndim > 0 ? array.strides(0) : 0;
+		col_stride = ndim > 1 ? array.strides(1) : 0;
+		ptr = array.data();
+	}
 
-	for (int q = 0; q < Q; ++q)
+	// Returns hashes packed into words of type T, packing float hashes into storage if needed. Does not need GIL
+	template<typename T>
+	const T* int_hashes(std::vector<T>& storage, int words, int num_threads) const
 	{
-		T query = hashes_query_int[q];
-		_hamming_distance<T>(hashes_db_int, hashes_db_info.shape[0], query, dist);
-
-		argsort_1d(rank, dist, hashes_db_info.shape[0]);
+		if (packed)
+		{
+			return (const T*)ptr;
+		}
+		storage.resize(size * words);
+		pack<T>(storage.data(), words, num_threads);
+		return storage.data();
+	}
 
-		for (int i = 0; i < N; ++i)
+	// Packs float hashes into words of type T. Does not need GIL
+	template<typename T>
+	void pack(T* out, int words, int num_threads) const
+	{
+		static const int itemsize[] = {4, 8, 2, 2};
+		stage_timer timer(STAGE_PACK, size * bits * itemsize[format]);
+		const char* x = (const char*)ptr;
+		switch (format)
 		{
-		    similarity[i] = labels_query_ptr[q] == labels_db_ptr[i];
+		case HASH_FLOAT16:
+			to_int_hashes<T, float16_format>(x, size, bits, row_stride, col_stride, out, words, num_threads);
+			break;
+		case HASH_BFLOAT16:
+			to_int_hashes<T, bfloat16_format>(x, size, bits, row_stride, col_stride, out, words, num_threads);
+			break;
+		case HASH_FLOAT64:
+			to_int_hashes<T, float64_format>(x, size, bits, row_stride, col_stride, out, words, num_threads);
+			break;
+		default:
+			to_int_hashes<T, float32_format>(x, size, bits, row_stride, col_stride, out, words, num_threads);
+			break;
 		}
+	}
 
-		double ap = compute_average_precision(rank, similarity, precision, recall, av_precision, av_recall, relevance, cumulative, N, top_n);
-		map += ap;
+	py::array array;
+	bool packed;
+	int format;
+	ssize_t ndim;
+	ssize_t size;
+	ssize_t bits;
+	ssize_t row_stride;
+	ssize_t col_stride;
+	const void* ptr;
+
+private:
+	// Returns format of hashes of the given dtype, or -1 if they need to be converted
+	static int get_format(const py::dtype& d, const std::string& dtype)
+	{
+		char kind = dtype_kind(d);
+		if (kind == 'u' && d.itemsize() == 8)
+			return HASH_PACKED;
+		if (!d.attr("isnative").cast<bool>())
+			return -1;
+		if (d.itemsize() == 2 && (!dtype.empty() || kind == 'f' || kind == 'V'))
+		{
+			std::string name = dtype.empty() ? (std::string)py::str(d.attr("name")) : dtype;
+			if (name == "float16")
+				return HASH_FLOAT16;
+			if (name == "bfloat16")
+				return HASH_BFLOAT16;
+		}
+		if (kind == 'f' && d.itemsize() == 4)
+			return HASH_FLOAT32;
+		if (kind == 'f' && d.itemsize() == 8)
+			return HASH_FLOAT64;
+		return -1;
 	}
+};
 
-	map /= Q;
+// Checks that two sets of hashes are of the same, non-zero, length. Returns true if both fit into uint32 words.
+// Kernels assume at least one word per hash, so zero-width hashes are rejected here, before any of them is dispatched
+inline bool check_hash_length(const hash_array& a, const hash_array& b)
+{
+	if (a.bits == 0 || b.bits == 0)
+		throw std::runtime_error("Hashes must not be empty");
 
-	for (int i = 0; i < top_n; ++i)
+	if (a.packed || b.packed)
 	{
-		av_precision[i] /= Q;
-		av_recall[i] /= Q;
+		if (words_per_hash<uint64_t>(a.bits) != words_per_hash<uint64_t>(b.bits))
+			throw std::runtime_error("Length of packed hashes must match");
+		return false;
 	}
 
-	free(relevance);
-	free(precision);
-	free(recall);
-	free(cumulative);
-	free(hashes_db_int);
-	free(hashes_query_int);
-	free(similarity);
+	if (a.bits != b.bits)
+		throw std::runtime_error("Second dimension must match");
 
-	py::gil_scoped_acquire acquire;
-	return std::tuple<double, ndarray_float, ndarray_float>(map,
-		ndarray_float(top_n, av_precision),
-		ndarray_float(top_n, av_recall)
-		);
+	return a.bits <= 32;
 }
 
-std::tuple<double, ndarray_float, ndarray_float> compute_map_from_hashes(ndarray_float hashes_db, ndarray_float hashes_query, ndarray_uint32 labels_db, ndarray_uint32 labels_query, int top_n)
+ndarray_uint64 pack_hashes(py::object x, int num_threads, const std::string& dtype, Workspace* workspace)
 {
-	py::buffer_info hashes_db_info = hashes_db.request(), hashes_query_info = hashes_query.request();
-	py::buffer_info labels_db_info = labels_db.request(), labels_query_info = labels_query.request();
+	hash_array h(x, dtype);
 
-	if (hashes_db_info.ndim != 2 || hashes_query_info.ndim != 2)
-		throw std::runtime_error("Number of dimensions for hashes must be two");
+	if (h.ndim != 2)
+		throw std::runtime_error("Number of dimensions must be two");
 
-	if (labels_db_info.ndim != 1 || labels_query_info.ndim != 1)
-		throw std::runtime_error("Number of dimensions for labels must be one");
+	if (h.packed)
+	{
+		return py::reinterpret_borrow<ndarray_uint64>(h.array);
+	}
 
-	if (hashes_db_info.shape[1] != hashes_query_info.shape[1])
-		throw std::runtime_error("Second dimension must match");
+	int words = words_per_hash<uint64_t>(h.bits);
 
-	if (hashes_db_info.shape[0] != labels_db_info.shape[0])
-		throw std::runtime_error("Size of hashes_db and labels_db must match");
+	Workspace local;
+	Workspace& ws = workspace ? *workspace : local;
 
-	if (hashes_query_info.shape[0] != labels_query_info.shape[0])
-		throw std::runtime_error("Size of hashes_db and labels_db must match");
+	ndarray_uint64 result = ws.output<uint64_t>("pack_hashes", std::vector<ssize_t>{h.size, words});
+	uint64_t* r = result.mutable_data();
 
-	if (hashes_db_info.shape[1] > 64)
-		throw std::runtime_error("Supports only hashes up to 64b");
+	py::gil_scoped_release release;
+	std::lock_guard<std::mutex> lock(ws.mutex);
 
-	if (top_n > labels_db_info.shape[0])
-		throw std::runtime_error("top_n must not be greater than size of labels_db");
+	h.pack<uint64_t>(r, words, get_num_threads(num_threads));
 
-	bool hash32 = hashes_db_info.shape[1] <= 32;
+	return result;
+}
 
-	if (hash32)
+// Portable kernel, also compiled for CPUs with popcnt instruction by the wrapper below
+template<typename T, typename D>
+FORCE_INLINE void _hamming_distance_scalar(const T* __restrict b2, ssize_t b2_size, int words, const T* __restrict b1, D* __restrict out)
+{
+	ssize_t j = 0;
+	if (words == 1)
 	{
-		return _compute_map_from_hashes<uint32_t>(hashes_db, hashes_query, labels_db, labels_query, top_n);
+		T b1_0 = b1[0];
+		for (; j + 3 < b2_size; j += 4)
+		{
+			out[j + 0] = hamming_distance<T>(b2[j + 0], b1_0);
+			out[j + 1] = hamming_distance<T>(b2[j + 1], b1_0);
+			out[j + 2] = hamming_distance<T>(b2[j + 2], b1_0);
+			out[j + 3] = hamming_distance<T>(b2[j + 3], b1_0);
+		}
+		for (; j < b2_size; ++j)
+		{
+			out[j] = hamming_distance<T>(b2[j], b1_0);
+		}
 	}
 	else
 	{
-		return _compute_map_from_hashes<uint64_t>(hashes_db, hashes_query, labels_db, labels_query, top_n);
+		for (; j < b2_size; ++j)
+		{
+			out[j] = (D)hamming_distance<T>(b2 + j * words, b1, words);
+		}
 	}
 }
 
+#ifdef HASHRANKING_X86_SIMD
+template<typename T, typename D>
+TARGET_POPCNT void _hamming_distance_popcnt(const T* __restrict b2, ssize_t b2_size, int words, const T* __restrict b1, D* __restrict out)
+{
+	_hamming_distance_scalar<T, D>(b2, b2_size, words, b1, out);
+}
+
+// Popcount of each 8-bit lane, using pshufb as a lookup table of nibble popcounts
+TARGET_AVX2 inline __m256i popcount8_avx2(__m256i v)
+{
+	const __m256i lookup = _mm256_setr_epi8(
+		0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4,
+		0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4);
+	const __m256i low_mask = _mm256_set1_epi8(0x0f);
+	__m256i lo = _mm256_and_si256(v, low_mask);
+	__m256i hi = _mm256_and_si256(_mm256_srli_epi16(v, 4), low_mask);
+	return _mm256_add_epi8(_mm256_shuffle_epi8(lookup, lo), _mm256_shuffle_epi8(lookup, hi));
+}
+
+TARGET_AVX2 inline __m256i popcount64_avx2(__m256i v)
+{
+	return _mm256_sad_epu8(popcount8_avx2(v), _mm256_setzero_si256());
+}
+
+TARGET_AVX2 inline __m256i popcount32_avx2(__m256i v)
+{
+	__m256i pairs = _mm256_maddubs_epi16(popcount8_avx2(v), _mm256_set1_epi8(1));
+	return _mm256_madd_epi16(pairs, _mm256_set1_epi16(1));
+}
+
+// Stores 16 distances smaller than 256, given in 64-bit lanes. Vector k holds distances 4 * k ... 4 * k + 3
+TARGET_AVX2 inline void store16_avx2(__m256i d0, __m256i d1, __m256i d2, __m256i d3, uint8_t* out)
+{
+	__m256i x = _mm256_or_si256(
+		_mm256_or_si256(d0, _mm256_slli_epi64(d1, 8)),
+		_mm256_or_si256(_mm256_slli_epi64(d2, 16), _mm256_slli_epi64(d3, 24)));
+	x = _mm256_permutevar8x32_epi32(x, _mm256_setr_epi32(0, 2, 4, 6, 1, 3, 5, 7));
+	__m128i y = _mm_shuffle_epi8(_mm256_castsi256_si128(x), _mm_setr_epi8(0, 4, 8, 12, 1, 5, 9, 13, 2, 6, 10, 14, 3, 7, 11, 15));
+	_mm_storeu_si128((__m128i*)out, y);
+}
+
+template<typename D>
+TARGET_AVX2 void _hamming_distance_avx2(const uint64_t* __restrict b2, ssize_t b2_size, int words, const uint64_t* __restrict b1, D* __restrict out)
+{
+	ssize_t j = 0;
+	if (words == 1 && sizeof(D) == 1)
+	{
+		__m256i q = _mm256_set1_epi64x((long long)b1[0]);
+		for (; j + 15 < b2_size; j += 16)
+		{
+			__m256i d[4];
+			for (int k = 0; k < 4; ++k)
+			{
+				d[k] = popcount64_avx2(_mm256_xor_si256(_mm256_loadu_si256((const __m256i*)(b2 + j + 4 * k)), q));
+			}
+			store16_avx2(d[0], d[1], d[2], d[3], (uint8_t*)(out + j));
+		}
+	}
+	else if (words == 2 && sizeof(D) == 1)
+	{
+		__m256i q = _mm256_setr_epi64x((long long)b1[0], (long long)b1[1], (long long)b1[0], (long long)b1[1]);
+		for (; j + 15 < b2_size; j += 16)
+		{
+			__m256i d[4];
+			for (int k = 0; k < 4; ++k)
+			{
+				const uint64_t* h = b2 + (j + 4 * k) * 2;
+				__m256i a = popcount64_avx2(_mm256_xor_si256(_mm256_loadu_si256((const __m256i*)h), q));
+				__m256i b = popcount64_avx2(_mm256_xor_si256(_mm256_loadu_si256((const __m256i*)(h + 4)), q));
+				// Sums of word pairs come out as hashes 0, 2, 1, 3
+				__m256i s = _mm256_add_epi64(_mm256_unpacklo_epi64(a, b), _mm256_unpackhi_epi64(a, b));
+				d[k] = _mm256_permute4x64_epi64(s, _MM_SHUFFLE(3, 1, 2, 0));
+			}
+			store16_avx2(d[0], d[1], d[2], d[3], (uint8_t*)(out + j));
+		}
+	}
+	else if (words >= 4)
+	{
+		for (; j < b2_size; ++j)
+		{
+			const uint64_t* h = b2 + j * words;
+			__m256i acc = _mm256_setzero_si256();
+			int k = 0;
+			for (; k + 3 < words; k += 4)
+			{
+				__m256i x = _mm256_xor_si256(_mm256_loadu_si256((const __m256i*)(h + k)), _mm256_loadu_si256((const __m256i*)(b1 + k)));
+				acc = _mm256_add_epi64(acc, popcount64_avx2(x));
+			}
+			__m128i s = _mm_add_epi64(_mm256_castsi256_si128(acc), _mm256_extracti128_si256(acc, 1));
+			int d = (int)(_mm_cvtsi128_si64(s) + _mm_extract_epi64(s, 1));
+			for (; k < words; ++k)
+			{
+				d += hamming_distance<uint64_t>(h[k], b1[k]);
+			}
+			out[j] = (D)d;
+		}
+	}
+	for (; j < b2_size; ++j)
+	{
+		out[j] = (D)hamming_distance<uint64_t>(b2 + j * words, b1, words);
+	}
+}
+
+TARGET_AVX2 void _hamming_distance32_avx2(const uint32_t* __restrict b2, ssize_t b2_size, int, const uint32_t* __restrict b1, uint8_t* __restrict out)
+{
+	ssize_t j = 0;
+	__m256i q = _mm256_set1_epi32((int)b1[0]);
+	// Gathers the lowest byte of each 32-bit lane into the first 8 bytes
+	const __m256i shuffle = _mm256_setr_epi8(
+		0, 4, 8, 12, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1,
+		0, 4, 8, 12, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1);
+	const __m256i permute = _mm256_setr_epi32(0, 4, 1, 1, 1, 1, 1, 1);
+	for (; j + 7 < b2_size; j += 8)
+	{
+		__m256i d = popcount32_avx2(_mm256_xor_si256(_mm256_loadu_si256((const __m256i*)(b2 + j)), q));
+		d = _mm256_permutevar8x32_epi32(_mm256_shuffle_epi8(d, shuffle), permute);
+		_mm_storel_epi64((__m128i*)(out + j), _mm256_castsi256_si128(d));
+	}
+	for (; j < b2_size; ++j)
+	{
+		out[j] = hamming_distance<uint32_t>(b2[j], b1[0]);
+	}
+}
+
+TARGET_AVX512 inline void store8_avx512(__m512i d, uint8_t* out)
+{
+	_mm_storel_epi64((__m128i*)out, _mm512_cvtepi64_epi8(d));
+}
+
+TARGET_AVX512 inline void store8_avx512(__m512i d, uint16_t* out)
+{
+	_mm_storeu_si128((__m128i*)out, _mm512_cvtepi64_epi16(d));
+}
+
+template<typename D>
+TARGET_AVX512 void _hamming_distance_avx512(const uint64_t* __restrict b2, ssize_t b2_size, int words, const uint64_t* __restrict b1, D* __restrict out)
+{
+	ssize_t j = 0;
+	if (words == 1)
+	{
+		__m512i q = _mm512_set1_epi64((long long)b1[0]);
+		for (; j + 7 < b2_size; j += 8)
+		{
+			__m512i d = _mm512_popcnt_epi64(_mm512_xor_si512(_mm512_loadu_si512(b2 + j), q));
+			store8_avx512(d, out + j);
+		}
+	}
+	else if (words == 2)
+	{
+		__m512i q = _mm512_set4_epi64((long long)b1[1], (long long)b1[0], (long long)b1[1], (long long)b1[0]);
+		const __m512i even = _mm512_setr_epi64(0, 2, 4, 6, 8, 10, 12, 14);
+		const __m512i odd = _mm512_setr_epi64(1, 3, 5, 7, 9, 11, 13, 15);
+		for (; j + 7 < b2_size; j += 8)
+		{
+			__m512i a = _mm512_popcnt_epi64(_mm512_xor_si512(_mm512_loadu_si512(b2 + j * 2), q));
+			__m512i b = _mm512_popcnt_epi64(_mm512_xor_si512(_mm512_loadu_si512(b2 + j * 2 + 8), q));
+			__m512i d = _mm512_add_epi64(_mm512_permutex2var_epi64(a, even, b), _mm512_permutex2var_epi64(a, odd, b));
+			store8_avx512(d, out + j);
+		}
+	}
+	else if (words == 4)
+	{
+		__m512i q = _mm512_broadcast_i64x4(_mm256_loadu_si256((const __m256i*)b1));
+		const __m512i even = _mm512_setr_epi64(0, 2, 4, 6, 8, 10, 12, 14);
+		const __m512i odd = _mm512_setr_epi64(1, 3, 5, 7, 9, 11, 13, 15);
+		for (; j + 7 < b2_size; j += 8)
+		{
+			__m512i s[2];
+			for (int k = 0; k < 2; ++k)
+			{
+				const uint64_t* h = b2 + (j + 4 * k) * 4;
+				__m512i a = _mm512_popcnt_epi64(_mm512_xor_si512(_mm512_loadu_si512(h), q));
+				__m512i b = _mm512_popcnt_epi64(_mm512_xor_si512(_mm512_loadu_si512(h + 8), q));
+				s[k] = _mm512_add_epi64(_mm512_permutex2var_epi64(a, even, b), _mm512_permutex2var_epi64(a, odd, b));
+			}
+			__m512i d = _mm512_add_epi64(_mm512_permutex2var_epi64(s[0], even, s[1]), _mm512_permutex2var_epi64(s[0], odd, s[1]));
+			store8_avx512(d, out + j);
+		}
+	}
+	else
+	{
+		// Tail of a hash shorter than 8 words is handled with masked loads
+		__mmask8 tail_mask = (__mmask8)((1u << (words % 8)) - 1);
+		int full = words - words % 8;
+		for (; j < b2_size; ++j)
+		{
+			const uint64_t* h = b2 + j * words;
+			__m512i acc = _mm512_setzero_si512();
+			for (int k = 0; k < full; k += 8)
+			{
+				__m512i x = _mm512_xor_si512(_mm512_loadu_si512(h + k), _mm512_loadu_si512(b1 + k));
+				acc = _mm512_add_epi64(acc, _mm512_popcnt_epi64(x));
+			}
+			if (tail_mask)
+			{
+				__m512i x = _mm512_xor_si512(_mm512_maskz_loadu_epi64(tail_mask, h + full), _mm512_maskz_loadu_epi64(tail_mask, b1 + full));
+				acc = _mm512_add_epi64(acc, _mm512_popcnt_epi64(x));
+			}
+			out[j] = (D)_mm512_reduce_add_epi64(acc);
+		}
+	}
+	for (; j < b2_size; ++j)
+	{
+		out[j] = (D)hamming_distance<uint64_t>(b2 + j * words, b1, words);
+	}
+}
+
+TARGET_AVX512 void _hamming_distance32_avx512(const uint32_t* __restrict b2, ssize_t b2_size, int, const uint32_t* __restrict b1, uint8_t* __restrict out)
+{
+	ssize_t j = 0;
+	__m512i q = _mm512_set1_epi32((int)b1[0]);
+	for (; j + 15 < b2_size; j += 16)
+	{
+		__m512i d = _mm512_popcnt_epi32(_mm512_xor_si512(_mm512_loadu_si512(b2 + j), q));
+		_mm_storeu_si128((__m128i*)(out + j), _mm512_cvtepi32_epi8(d));
+	}
+	for (; j < b2_size; ++j)
+	{
+		out[j] = hamming_distance<uint32_t>(b2[j], b1[0]);
+	}
+}
+#endif
+
+#ifdef HASHRANKING_X86_SIMD
+TARGET_AVX2 void _pack_signs_avx2(const float* __restrict x, ssize_t w, uint64_t* __restrict out)
+{
+	const __m256 zero = _mm256_setzero_ps();
+	ssize_t y = 0;
+	for (; y + 64 <= w; y += 64)
+	{
+		uint64_t word = 0;
+		for (int k = 0; k < 8; ++k)
+		{
+			__m256 v = _mm256_loadu_ps(x + y + 8 * k);
+			word |= (uint64_t)(uint32_t)_mm256_movemask_ps(_mm256_cmp_ps(v, zero, _CMP_GT_OQ)) << (8 * k);
+		}
+		out[y / 64] = word;
+	}
+	if (y < w)
+	{
+		_pack_signs_scalar<float32_format>(x + y, w - y, out + y / 64);
+	}
+}
+
+// Elements in [1, positive_max] are selected with two signed comparisons, as positive_max is below 0x8000
+template<typename F>
+TARGET_AVX2 void _pack_signs16_avx2(const uint16_t* __restrict x, ssize_t w, uint64_t* __restrict out)
+{
+	const __m256i zero = _mm256_setzero_si256();
+	const __m256i limit = _mm256_set1_epi16((short)(F::positive_max + 1));
+	ssize_t y = 0;
+	for (; y + 64 <= w; y += 64)
+	{
+		uint64_t word = 0;
+		for (int k = 0; k < 2; ++k)
+		{
+			__m256i a = _mm256_loadu_si256((const __m256i*)(x + y + 32 * k));
+			__m256i b = _mm256_loadu_si256((const __m256i*)(x + y + 32 * k + 16));
+			a = _mm256_and_si256(_mm256_cmpgt_epi16(a, zero), _mm256_cmpgt_epi16(limit, a));
+			b = _mm256_and_si256(_mm256_cmpgt_epi16(b, zero), _mm256_cmpgt_epi16(limit, b));
+			// Packing interleaves 128-bit lanes of a and b, permutation puts them back in order
+			__m256i m = _mm256_permute4x64_epi64(_mm256_packs_epi16(a, b), 0xD8);
+			word |= (uint64_t)(uint32_t)_mm256_movemask_epi8(m) << (32 * k);
+		}
+		out[y / 64] = word;
+	}
+	if (y < w)
+	{
+		_pack_signs_scalar<F>(x + y, w - y, out + y / 64);
+	}
+}
+
+TARGET_AVX512 void _pack_signs_avx512(const float* __restrict x, ssize_t w, uint64_t* __restrict out)
+{
+	const __m512 zero = _mm512_setzero_ps();
+	for (ssize_t y = 0; y < w; y += 64)
+	{
+		uint64_t word = 0;
+		for (int k = 0; k < 4 && y + 16 * k < w; ++k)
+		{
+			ssize_t left = w - y - 16 * k;
+			__mmask16 mask = left >= 16 ? (__mmask16)0xFFFF : (__mmask16)((1u << left) - 1);
+			__m512 v = _mm512_maskz_loadu_ps(mask, x + y + 16 * k);
+			word |= (uint64_t)_mm512_cmp_ps_mask(v, zero, _CMP_GT_OQ) << (16 * k);
+		}
+		out[y / 64] = word;
+	}
+}
+
+template<typename F>
+TARGET_AVX512BW void _pack_signs16_avx512(const uint16_t* __restrict x, ssize_t w, uint64_t* __restrict out)
+{
+	const __m512i zero = _mm512_setzero_si512();
+	const __m512i limit = _mm512_set1_epi16((short)(F::positive_max + 1));
+	for (ssize_t y = 0; y < w; y += 64)
+	{
+		uint64_t word = 0;
+		for (int k = 0; k < 2 && y + 32 * k < w; ++k)
+		{
+			ssize_t left = w - y - 32 * k;
+			__mmask32 mask = left >= 32 ? (__mmask32)0xFFFFFFFF : (__mmask32)((1u << left) - 1);
+			__m512i v = _mm512_maskz_loadu_epi16(mask, x + y + 32 * k);
+			word |= (uint64_t)(_mm512_cmpgt_epi16_mask(v, zero) & _mm512_cmplt_epi16_mask(v, limit)) << (32 * k);
+		}
+		out[y / 64] = word;
+	}
+}
+#endif
+
+// Asymmetric scoring of real-valued queries against binary database hashes. Score is the inner product of the query
+// with the hash taken as a vector of +1 and -1, larger is closer. The query is turned into tables of partial inner
+// products with all values of each byte or nibble of the hash, so each database hash costs one lookup per byte or nibble.
+// `lut` is a scratch buffer of 256 * ceil(bits / 8) floats
+
+// Fills `lut` with tables of partial inner products of the query with all values of each group of `group` bits
+inline void build_asymmetric_lut(const float* __restrict query, int bits, int group, float* __restrict lut)
+{
+	int size = 1 << group;
+	for (int j = 0; j < (bits + group - 1) / group; ++j)
+	{
+		float q[8];
+		float sum = 0.0f;
+		for (int k = 0; k < group; ++k)
+		{
+			q[k] = group * j + k < bits ? query[group * j + k] : 0.0f;
+			sum += q[k];
+		}
+		float* __restrict table = lut + size * j;
+		table[0] = -sum;
+		// Value v differs from v with its lowest bit cleared only in that bit, which turns -q into +q
+		for (int v = 1; v < size; ++v)
+		{
+			table[v] = table[v & (v - 1)] + 2.0f * q[popcount32((v & -v) - 1)];
+		}
+	}
+}
+
+void _asymmetric_score_scalar(const float* __restrict query, int bits, const uint64_t* __restrict hashes, ssize_t size, int words, float* __restrict out, float* __restrict lut)
+{
+	build_asymmetric_lut(query, bits, 8, lut);
+	int bytes = (bits + 7) / 8;
+	int full_words = bytes / 8;
+	for (ssize_t i = 0; i < size; ++i)
+	{
+		const uint64_t* __restrict h = hashes + i * words;
+		const float* __restrict table = lut;
+		float s0 = 0.0f, s1 = 0.0f;
+		for (int w = 0; w < full_words; ++w, table += 8 * 256)
+		{
+			uint64_t x = h[w];
+			s0 += table[0 * 256 + (x & 0xFF)] + table[1 * 256 + ((x >> 8) & 0xFF)];
+			s1 += table[2 * 256 + ((x >> 16) & 0xFF)] + table[3 * 256 + ((x >> 24) & 0xFF)];
+			s0 += table[4 * 256 + ((x >> 32) & 0xFF)] + table[5 * 256 + ((x >> 40) & 0xFF)];
+			s1 += table[6 * 256 + ((x >> 48) & 0xFF)] + table[7 * 256 + (x >> 56)];
+		}
+		if (full_words < words)
+		{
+			uint64_t x = h[full_words];
+			for (int j = 0; j < bytes - 8 * full_words; ++j, table += 256)
+			{
+				s0 += table[(x >> (8 * j)) & 0xFF];
+			}
+		}
+		out[i] = s0 + s1;
+	}
+}
+
+#ifdef HASHRANKING_X86_SIMD
+// Adds up scores of 16 hashes over the nibbles of one word, given split into low and high 32-bit halves. Tables of
+// missing nibbles at the end of the hash are zero
+TARGET_AVX512 inline __m512 _asymmetric_word_avx512(__m512i lo, __m512i hi, const float* __restrict table)
+{
+	__m512 acc0 = _mm512_setzero_ps(), acc1 = _mm512_setzero_ps(), acc2 = _mm512_setzero_ps(), acc3 = _mm512_setzero_ps();
+	for (int j = 0; j < 8; j += 2)
+	{
+		acc0 = _mm512_add_ps(acc0, _mm512_permutexvar_ps(_mm512_srli_epi32(lo, 4 * j), _mm512_loadu_ps(table + 16 * j)));
+		acc1 = _mm512_add_ps(acc1, _mm512_permutexvar_ps(_mm512_srli_epi32(lo, 4 * j + 4), _mm512_loadu_ps(table + 16 * (j + 1))));
+		acc2 = _mm512_add_ps(acc2, _mm512_permutexvar_ps(_mm512_srli_epi32(hi, 4 * j), _mm512_loadu_ps(table + 16 * (j + 8))));
+		acc3 = _mm512_add_ps(acc3, _mm512_permutexvar_ps(_mm512_srli_epi32(hi, 4 * j + 4), _mm512_loadu_ps(table + 16 * (j + 9))));
+	}
+	return _mm512_add_ps(_mm512_add_ps(acc0, acc1), _mm512_add_ps(acc2, acc3));
+}
+
+// Scores 16 hashes at a time. A table of a nibble is 16 floats, which fit into one register, and vpermps looks up all 16
+// hashes in it at once. Low and high halves of 16 words are split into two registers, so that a nibble of each hash is
+// selected with a single shift, vpermps only uses the lowest 4 bits of each index
+TARGET_AVX512 void _asymmetric_score_avx512(const float* __restrict query, int bits, const uint64_t* __restrict hashes, ssize_t size, int words, float* __restrict out, float* __restrict lut)
+{
+	int tables = 16 * words;
+	memset(lut, 0, sizeof(float) * 16 * tables);
+	build_asymmetric_lut(query, bits, 4, lut);
+
+	const __m512i even = _mm512_setr_epi32(0, 2, 4, 6, 8, 10, 12, 14, 16, 18, 20, 22, 24, 26, 28, 30);
+	const __m512i odd = _mm512_setr_epi32(1, 3, 5, 7, 9, 11, 13, 15, 17, 19, 21, 23, 25, 27, 29, 31);
+	const long long wl = words;
+	const __m512i offsets = _mm512_setr_epi64(0, wl, 2 * wl, 3 * wl, 4 * wl, 5 * wl, 6 * wl, 7 * wl);
+
+	for (ssize_t i = 0; i < size; i += 16)
+	{
+		ssize_t left = size - i;
+		__mmask8 mask_a = left >= 8 ? (__mmask8)0xFF : (__mmask8)((1u << left) - 1);
+		__mmask8 mask_b = left >= 16 ? (__mmask8)0xFF : left > 8 ? (__mmask8)((1u << (left - 8)) - 1) : (__mmask8)0;
+		__m512 s = _mm512_setzero_ps();
+
+		for (int w = 0; w < words; ++w)
+		{
+			__m512i a, b;
+			if (words == 1)
+			{
+				a = _mm512_maskz_loadu_epi64(mask_a, hashes + i);
+				b = _mm512_maskz_loadu_epi64(mask_b, hashes + i + 8);
+			}
+			else
+			{
+				const uint64_t* base = hashes + i * words + w;
+				a = _mm512_mask_i64gather_epi64(_mm512_setzero_si512(), mask_a, offsets, (const long long*)base, 8);
+				b = _mm512_mask_i64gather_epi64(_mm512_setzero_si512(), mask_b, offsets, (const long long*)(base + 8 * words), 8);
+			}
+			s = _mm512_add_ps(s, _asymmetric_word_avx512(_mm512_permutex2var_epi32(a, even, b), _mm512_permutex2var_epi32(a, odd, b), lut + 256 * w));
+		}
+
+		_mm512_mask_storeu_ps(out + i, (__mmask16)(mask_a | (mask_b << 8)), s);
+	}
+}
+#endif
+
+enum simd_kernel_t
+{
+	SIMD_SCALAR,
+	SIMD_POPCNT,
+	SIMD_AVX2,
+	SIMD_AVX512_VPOPCNTDQ,
+	SIMD_KERNEL_COUNT
+};
+
+const char* simd_kernel_names[SIMD_KERNEL_COUNT] = {"scalar", "popcnt", "avx2", "avx512_vpopcntdq"};
+
+simd_kernel_t active_simd_kernel = SIMD_SCALAR;
+
+// Distance kernel currently in use for the given word and distance types
+template<typename T, typename D>
+struct distance_kernel
+{
+	typedef void (*function)(const T* __restrict b2, ssize_t b2_size, int words, const T* __restrict b1, D* __restrict out);
+	static function active;
+};
+
+template<typename T, typename D>
+typename distance_kernel<T, D>::function distance_kernel<T, D>::active = &_hamming_distance_scalar<T, D>;
+
+// Asymmetric scoring kernel currently in use
+struct asymmetric_kernel
+{
+	typedef void (*function)(const float* __restrict query, int bits, const uint64_t* __restrict hashes, ssize_t size, int words, float* __restrict out, float* __restrict lut);
+	static function active;
+};
+
+asymmetric_kernel::function asymmetric_kernel::active = &_asymmetric_score_scalar;
+
+bool is_simd_kernel_supported(simd_kernel_t kernel)
+{
+#ifdef HASHRANKING_X86_SIMD
+	__builtin_cpu_init();
+	switch (kernel)
+	{
+	case SIMD_SCALAR: return true;
+	case SIMD_POPCNT: return __builtin_cpu_supports("popcnt");
+	case SIMD_AVX2: return __builtin_cpu_supports("popcnt") && __builtin_cpu_supports("avx2");
+	case SIMD_AVX512_VPOPCNTDQ: return __builtin_cpu_supports("avx512f") && __builtin_cpu_supports("avx512vpopcntdq");
+	default: return false;
+	}
+#else
+	return kernel == SIMD_SCALAR;
+#endif
+}
+
+void select_simd_kernel(simd_kernel_t kernel)
+{
+	distance_kernel<uint32_t, uint8_t>::active = &_hamming_distance_scalar<uint32_t, uint8_t>;
+	distance_kernel<uint64_t, uint8_t>::active = &_hamming_distance_scalar<uint64_t, uint8_t>;
+	distance_kernel<uint64_t, uint16_t>::active = &_hamming_distance_scalar<uint64_t, uint16_t>;
+	sign_kernel<float32_format>::active = &_pack_signs_scalar<float32_format>;
+	sign_kernel<float16_format>::active = &_pack_signs_scalar<float16_format>;
+	sign_kernel<bfloat16_format>::active = &_pack_signs_scalar<bfloat16_format>;
+	asymmetric_kernel::active = &_asymmetric_score_scalar;
+#ifdef HASHRANKING_X86_SIMD
+	switch (kernel)
+	{
+	case SIMD_POPCNT:
+		distance_kernel<uint32_t, uint8_t>::active = &_hamming_distance_popcnt<uint32_t, uint8_t>;
+		distance_kernel<uint64_t, uint8_t>::active = &_hamming_distance_popcnt<uint64_t, uint8_t>;
+		distance_kernel<uint64_t, uint16_t>::active = &_hamming_distance_popcnt<uint64_t, uint16_t>;
+		break;
+	case SIMD_AVX2:
+		distance_kernel<uint32_t, uint8_t>::active = &_hamming_distance32_avx2;
+		distance_kernel<uint64_t, uint8_t>::active = &_hamming_distance_avx2<uint8_t>;
+		distance_kernel<uint64_t, uint16_t>::active = &_hamming_distance_avx2<uint16_t>;
+		sign_kernel<float32_format>::active = &_pack_signs_avx2;
+		sign_kernel<float16_format>::active = &_pack_signs16_avx2<float16_format>;
+		sign_kernel<bfloat16_format>::active = &_pack_signs16_avx2<bfloat16_format>;
+		break;
+	case SIMD_AVX512_VPOPCNTDQ:
+		distance_kernel<uint32_t, uint8_t>::active = &_hamming_distance32_avx512;
+		distance_kernel<uint64_t, uint8_t>::active = &_hamming_distance_avx512<uint8_t>;
+		distance_kernel<uint64_t, uint16_t>::active = &_hamming_distance_avx512<uint16_t>;
+		sign_kernel<float32_format>::active = &_pack_signs_avx512;
+		asymmetric_kernel::active = &_asymmetric_score_avx512;
+		if (__builtin_cpu_supports("avx512bw"))
+		{
+			sign_kernel<float16_format>::active = &_pack_signs16_avx512<float16_format>;
+			sign_kernel<bfloat16_format>::active = &_pack_signs16_avx512<bfloat16_format>;
+		}
+		else
+		{
+			sign_kernel<float16_format>::active = &_pack_signs16_avx2<float16_format>;
+			sign_kernel<bfloat16_format>::active = &_pack_signs16_avx2<bfloat16_format>;
+		}
+		break;
+	default:
+		break;
+	}
+#endif
+	active_simd_kernel = kernel;
+}
+
+// Picks the fastest kernel supported by the CPU. Called on import
+void select_best_simd_kernel()
+{
+	int kernel = SIMD_KERNEL_COUNT - 1;
+	while (!is_simd_kernel_supported((simd_kernel_t)kernel))
+	{
+		--kernel;
+	}
+	select_simd_kernel((simd_kernel_t)kernel);
+}
+
+std::string simd_kernel()
+{
+	return simd_kernel_names[active_simd_kernel];
+}
+
+std::vector<std::string> supported_simd_kernels()
+{
+	std::vector<std::string> result;
+	for (int kernel = 0; kernel < SIMD_KERNEL_COUNT; ++kernel)
+	{
+		if (is_simd_kernel_supported((simd_kernel_t)kernel))
+		{
+			result.push_back(simd_kernel_names[kernel]);
+		}
+	}
+	return result;
+}
+
+void set_simd_kernel(const std::string& name)
+{
+	for (int kernel = 0; kernel < SIMD_KERNEL_COUNT; ++kernel)
+	{
+		if (name == simd_kernel_names[kernel])
+		{
+			if (!is_simd_kernel_supported((simd_kernel_t)kernel))
+				throw py::value_error("Kernel " + name + " is not supported by this CPU");
+			select_simd_kernel((simd_kernel_t)kernel);
+			return;
+		}
+	}
+	throw py::value_error("Unknown kernel " + name);
+}
+
+template<typename T, typename D>
+inline void _hamming_distance(const T* __restrict b2, ssize_t b2_size, int words, const T* __restrict b1, D* __restrict out)
+{
+	distance_kernel<T, D>::active(b2, b2_size, words, b1, out);
+}
+
+// Size in bytes of a block of database hashes that is compared to all queries of a thread before moving to the next block.
+// Block is small enough to stay in L2 cache, so the database is read from memory once per thread and not once per query
+const ssize_t distance_tile_bytes = 128 * 1024;
+
+template<typename T, typename D>
+py::array _hamming_distance(const hash_array& b1, const hash_array& b2, py::object out, int num_threads, Workspace& ws)
+{
+	ssize_t l1 = b1.size;
+	ssize_t l2 = b2.size;
+	int words = words_per_hash<T>(std::max(b1.bits, b2.bits));
+
+	py::array_t<D, py::array::c_style> result;
+	if (out.is_none())
+	{
+		result = ws.output<D>("hamming_distance", std::vector<ssize_t>{l1, l2});
+	}
+	else
+	{
+		if (!py::array_t<D, py::array::c_style>::check_(out))
+			throw py::type_error(sizeof(D) == 1 ? "out must be a C-contiguous uint8 array" : "out must be a C-contiguous uint16 array");
+		result = py::reinterpret_borrow<py::array_t<D, py::array::c_style> >(out);
+		if (result.ndim() != 2 || result.shape(0) != l1 || result.shape(1) != l2)
+			throw std::runtime_error("Shape of out must be (len(b1), len(b2))");
+	}
+	D* __restrict r = result.mutable_data();
+
+	py::gil_scoped_release release;
+	std::lock_guard<std::mutex> lock(ws.mutex);
+
+	const T* __restrict b1_int = b1.int_hashes<T>(ws.storage<T>(1), words, num_threads);
+	const T* __restrict b2_int = b2.int_hashes<T>(ws.storage<T>(0), words, num_threads);
+
+	ssize_t tile = std::max<ssize_t>(distance_tile_bytes / (sizeof(T) * words), 64);
+
+	parallel_for(l1, num_threads, [&](ssize_t begin, ssize_t end, int)
+	{
+		stage_timer timer(STAGE_DISTANCE, (end - begin) * l2 * words * sizeof(T));
+		for (ssize_t j = 0; j < l2; j += tile)
+		{
+			ssize_t size = std::min(tile, l2 - j);
+			for (ssize_t i = begin; i < end; ++i)
+			{
+				D* __restrict ptr = r + i * l2 + j;
+				_hamming_distance<T, D>(b2_int + j * words, size, words, b1_int + i * words, ptr);
+			}
+		}
+	});
+
+	return std::move(result);
+}
+
+py::array hamming_distance(py::object b1_obj, py::object b2_obj, int num_threads, py::object out, Workspace* workspace)
+{
+	hash_array b1(b1_obj), b2(b2_obj);
+
+	if (b1.ndim != 2 || b2.ndim != 2)
+		throw std::runtime_error("Number of dimensions must be two");
+
+	bool hash32 = check_hash_length(b1, b2);
+
+	num_threads = get_num_threads(num_threads);
+	Workspace local;
+	Workspace& ws = workspace ? *workspace : local;
+
+	if (hash32)
+	{
+		return _hamming_distance<uint32_t, uint8_t>(b1, b2, out, num_threads, ws);
+	}
+	else if (!is_wide_distance<uint64_t>(words_per_hash<uint64_t>(b1.bits)))
+	{
+		return _hamming_distance<uint64_t, uint8_t>(b1, b2, out, num_threads, ws);
+	}
+	else
+	{
+		return _hamming_distance<uint64_t, uint16_t>(b1, b2, out, num_threads, ws);
+	}
+}
+
+// Counting sort, stable. `count` is a scratch buffer of `buckets` elements, where `buckets` must be greater than any distance value
+template<typename D>
+void argsort_1d(uint32_t* __restrict out_ptr, const D* __restrict d_ptr, ssize_t size, int32_t* __restrict count, int buckets)
+{
+	memset(count, 0, sizeof(int32_t) * buckets);
+
+	for (ssize_t y = 0; y < size; ++y)
+		count[d_ptr[y]]++;
+
+	for (int i = 1; i < buckets; ++i)
+	{
+		count[i] += count[i - 1];
+	}
+
+	for (ssize_t y = size -1; y >= 0; --y)
+	{
+		D key = d_ptr[y];
+		out_ptr[count[key] - 1] = (uint32_t)y;
+		count[key] -= 1;
+	}
+}
+
+template<typename D>
+ndarray_uint32 _argsort(py::array_t<D, py::array::c_style> distance, int num_threads, Workspace& ws)
+{
+	py::buffer_info d_info = distance.request();
+
+	if (d_info.ndim != 2)
+		throw std::runtime_error("Number of dimensions must be two");
+
+	ssize_t l1 = d_info.shape[0];
+	ssize_t l2 = d_info.shape[1];
+
+	ndarray_uint32 result = ws.output<uint32_t>("argsort", std::vector<ssize_t>{l1, l2});
+
+	uint32_t* r = result.mutable_data();
+	const D* d = (const D*)d_info.ptr;
+
+	py::gil_scoped_release release;
+	std::lock_guard<std::mutex> lock(ws.mutex);
+
+	int buckets = (int)std::numeric_limits<D>::max() + 1;
+	if (sizeof(D) > 1 && l1 * l2 > 0)
+	{
+		buckets = (int)*std::max_element(d, d + l1 * l2) + 1;
+	}
+
+	num_threads = get_num_threads(num_threads);
+	ws.reserve(num_threads);
+
+	parallel_for(l1, num_threads, [&](ssize_t begin, ssize_t end, int thread_id)
+	{
+		stage_timer timer(STAGE_SORT, (end - begin) * l2 * sizeof(D));
+		int32_t* count = ws.scratch<int32_t>(thread_id, Workspace::COUNT, buckets);
+
+		for (ssize_t x = begin; x < end; ++x)
+		{
+			uint32_t* __restrict out_ptr = r + x * l2;
+			const D* __restrict d_ptr = d + x * l2;
+
+			argsort_1d<D>(out_ptr, d_ptr, l2, count, buckets);
+		}
+	});
+
+	return result;
+}
+
+ndarray_uint32 argsort(py::object distance, int num_threads, Workspace* workspace)
+{
+	Workspace local;
+	Workspace& ws = workspace ? *workspace : local;
+
+	if (is_array_of<uint16_t>(distance))
+	{
+		return _argsort<uint16_t>(as_array<uint16_t>(distance, "Distance"), num_threads, ws);
+	}
+	return _argsort<uint8_t>(as_array<uint8_t>(distance, "Distance"), num_threads, ws);
+}
+
+// Selects k smallest distances in the same order as argsort_1d gives, without sorting the rest.
+// `count` is a scratch buffer of `buckets` elements, where `buckets` must be greater than any distance value
+template<typename D>
+void topk_1d(uint32_t* __restrict out_ptr, D* __restrict out_d_ptr, const D* __restrict d_ptr, ssize_t size, int k, int32_t* __restrict count, int buckets)
+{
+	memset(count, 0, sizeof(int32_t) * buckets);
+
+	for (ssize_t y = 0; y < size; ++y)
+		count[d_ptr[y]]++;
+
+	// Turn counts into start positions, bucket `cutoff` is the last one that makes it into top k
+	int32_t position = 0;
+	int cutoff = 0;
+	for (; cutoff < buckets; ++cutoff)
+	{
+		int32_t c = count[cutoff];
+		count[cutoff] = position;
+		position += c;
+		if (position >= k)
+			break;
+	}
+
+	int32_t filled = 0;
+	for (ssize_t y = 0; y < size && filled < k; ++y)
+	{
+		D key = d_ptr[y];
+		if (key < cutoff || (key == cutoff && count[key] < k))
+		{
+			int32_t i = count[key]++;
+			out_ptr[i] = (uint32_t)y;
+			out_d_ptr[i] = key;
+			++filled;
+		}
+	}
+}
+
+template<typename T, typename D>
+std::tuple<ndarray_uint32, py::array> _hamming_topk(const hash_array& b1, const hash_array& b2, int k, int num_threads, Workspace& ws)
+{
+	ssize_t l1 = b1.size;
+	ssize_t l2 = b2.size;
+	int words = words_per_hash<T>(std::max(b1.bits, b2.bits));
+	int buckets = (int)(8 * sizeof(T) * words) + 1;
+
+	ndarray_uint32 indices = ws.output<uint32_t>("hamming_topk.indices", std::vector<ssize_t>{l1, k});
+	py::array_t<D, py::array::c_style> distances = ws.output<D>("hamming_topk.distances", std::vector<ssize_t>{l1, k});
+	uint32_t* __restrict r = indices.mutable_data();
+	D* __restrict d = distances.mutable_data();
+
+	{
+		py::gil_scoped_release release;
+		std::lock_guard<std::mutex> lock(ws.mutex);
+
+		const T* __restrict b1_int = b1.int_hashes<T>(ws.storage<T>(1), words, num_threads);
+		const T* __restrict b2_int = b2.int_hashes<T>(ws.storage<T>(0), words, num_threads);
+		ws.reserve(num_threads);
+
+		parallel_for(l1, num_threads, [&](ssize_t begin, ssize_t end, int thread_id)
+		{
+			D* dist = ws.scratch<D>(thread_id, Workspace::DISTANCE, l2);
+			int32_t* count = ws.scratch<int32_t>(thread_id, Workspace::COUNT, buckets);
+
+			for (ssize_t i = begin; i < end; ++i)
+			{
+				{
+					stage_timer timer(STAGE_DISTANCE, l2 * words * sizeof(T));
+					_hamming_distance<T, D>(b2_int, l2, words, b1_int + i * words, dist);
+				}
+				stage_timer timer(STAGE_SORT, l2 * sizeof(D));
+				topk_1d<D>(r + i * k, d + i * k, dist, l2, k, count, buckets);
+			}
+		});
+	}
+
+	return std::make_tuple(indices, distances);
+}
+
+std::tuple<ndarray_uint32, py::array> hamming_topk(py::object b1_obj, py::object b2_obj, int k, int num_threads, Workspace* workspace)
+{
+	hash_array b1(b1_obj), b2(b2_obj);
+
+	if (b1.ndim != 2 || b2.ndim != 2)
+		throw std::runtime_error("Number of dimensions must be two");
+
+	bool hash32 = check_hash_length(b1, b2);
+
+	if (k < 0 || k > b2.size)
+		throw py::value_error("k must be in [0, size of b2]");
+
+	num_threads = get_num_threads(num_threads);
+	Workspace local;
+	Workspace& ws = workspace ? *workspace : local;
+
+	if (hash32)
+	{
+		return _hamming_topk<uint32_t, uint8_t>(b1, b2, k, num_threads, ws);
+	}
+	else if (!is_wide_distance<uint64_t>(words_per_hash<uint64_t>(b1.bits)))
+	{
+		return _hamming_topk<uint64_t, uint8_t>(b1, b2, k, num_threads, ws);
+	}
+	else
+	{
+		return _hamming_topk<uint64_t, uint16_t>(b1, b2, k, num_threads, ws);
+	}
+}
+
+const ssize_t asymmetric_topk_block = 16;
+
+// Number of items in the candidate buffer of asymmetric_topk_1d
+inline size_t asymmetric_topk_capacity(int k)
+{
+	return std::max<size_t>(2 * (size_t)k, 64);
+}
+
+// Selects k largest scores, ordered by score and then by index, NaN scores are the worst, the same as with numpy.argsort.
+// Items better than the k-th best one seen so far are collected into `candidates`, and when there are 2k of them, only
+// the best k are kept. Most items are rejected by a comparison with the threshold, which is done for blocks of items at
+// once. Until the first k are kept, every item is a candidate, so k candidates are found if k <= size, even if all
+// scores are -inf or NaN. Slots that are left, if k > size, get index 0xFFFFFFFF and NaN score.
+// The candidate buffer must have room for asymmetric_topk_capacity(k) + asymmetric_topk_block items
+inline void asymmetric_topk_1d(uint32_t* __restrict out_ptr, float* __restrict out_s_ptr, const float* __restrict s_ptr, ssize_t size, int k,
+	std::pair<float, uint32_t>* __restrict candidates)
+{
+	auto better = [](const std::pair<float, uint32_t>& a, const std::pair<float, uint32_t>& b)
+	{
+		bool a_nan = std::isnan(a.first);
+		bool b_nan = std::isnan(b.first);
+		if (a_nan || b_nan)
+			return !a_nan || (b_nan && a.second < b.second);
+		return a.first > b.first || (a.first == b.first && a.second < b.second);
+	};
+
+	if (k == 0)
+		return;
+
+	size_t capacity = asymmetric_topk_capacity(k);
+	size_t count_candidates = 0;
+	// Items come in the order of index, so an item with the same score as the k-th one is never better. Threshold is
+	// not used until k candidates are kept, and it is not used either while the k-th one is NaN, since any item that
+	// is not NaN is better
+	bool filter = false;
+	float threshold = 0.0f;
+	const ssize_t block = asymmetric_topk_block;
+
+	for (ssize_t y = 0; y < size; y += block)
+	{
+		ssize_t n = std::min(block, size - y);
+		if (filter)
+		{
+			int count = 0;
+			for (ssize_t j = 0; j < n; ++j)
+			{
+				count += s_ptr[y + j] > threshold;
+			}
+			if (count == 0)
+				continue;
+		}
+
+		for (ssize_t j = 0; j < n; ++j)
+		{
+			if (!filter || s_ptr[y + j] > threshold)
+			{
+				candidates[count_candidates++] = std::make_pair(s_ptr[y + j], (uint32_t)(y + j));
+			}
+		}
+		if (count_candidates >= capacity)
+		{
+			std::nth_element(candidates, candidates + (k - 1), candidates + count_candidates, better);
+			count_candidates = k;
+			threshold = candidates[k - 1].first;
+			filter = !std::isnan(threshold);
+		}
+	}
+
+	if (count_candidates > (size_t)k)
+	{
+		std::nth_element(candidates, candidates + (k - 1), candidates + count_candidates, better);
+		count_candidates = k;
+	}
+	std::sort(candidates, candidates + count_candidates, better);
+
+	for (int i = 0; i < (int)count_candidates; ++i)
+	{
+		out_s_ptr[i] = candidates[i].first;
+		out_ptr[i] = candidates[i].second;
+	}
+	for (int i = (int)count_candidates; i < k; ++i)
+	{
+		out_s_ptr[i] = std::numeric_limits<float>::quiet_NaN();
+		out_ptr[i] = 0xFFFFFFFF;
+	}
+}
+
+// Checks inputs of asymmetric functions, returns queries as float array of shape (Q, bits)
+ndarray_float check_asymmetric_inputs(py::object queries_obj, const hash_array& hashes)
+{
+	ndarray_float queries = as_array<float>(queries_obj, "Queries");
+
+	if (queries.ndim() != 2 || hashes.ndim != 2)
+		throw std::runtime_error("Number of dimensions must be two");
+
+	if (hashes.packed ? words_per_hash<uint64_t>((int)queries.shape(1)) != words_per_hash<uint64_t>(hashes.bits) : queries.shape(1) != hashes.bits)
+		throw std::runtime_error("Length of queries must match length of hashes");
+
+	return queries;
+}
+
+py::array_t<float, py::array::c_style> asymmetric_score(py::object queries_obj, py::object hashes_obj, int num_threads, Workspace* workspace)
+{
+	hash_array hashes(hashes_obj);
+	ndarray_float queries = check_asymmetric_inputs(queries_obj, hashes);
+
+	ssize_t Q = queries.shape(0);
+	ssize_t N = hashes.size;
+	int bits = (int)queries.shape(1);
+	int bytes = (bits + 7) / 8;
+	int words = words_per_hash<uint64_t>(bits);
+	num_threads = get_num_threads(num_threads);
+	Workspace local;
+	Workspace& ws = workspace ? *workspace : local;
+
+	py::array_t<float, py::array::c_style> result = ws.output<float>("asymmetric_score", std::vector<ssize_t>{Q, N});
+	float* __restrict r = result.mutable_data();
+	const float* __restrict q = queries.data();
+
+	py::gil_scoped_release release;
+	std::lock_guard<std::mutex> lock(ws.mutex);
+
+	const uint64_t* __restrict hashes_int = hashes.int_hashes<uint64_t>(ws.storage<uint64_t>(0), words, num_threads);
+	ws.reserve(num_threads);
+
+	parallel_for(Q, num_threads, [&](ssize_t begin, ssize_t end, int thread_id)
+	{
+		float* lut = ws.scratch<float>(thread_id, Workspace::TABLE, 256 * bytes);
+		for (ssize_t i = begin; i < end; ++i)
+		{
+			stage_timer timer(STAGE_ASYMMETRIC, N * words * sizeof(uint64_t));
+			asymmetric_kernel::active(q + i * bits, bits, hashes_int, N, words, r + i * N, lut);
+		}
+	});
+
+	return result;
+}
+
+std::tuple<ndarray_uint32, py::array_t<float, py::array::c_style> > asymmetric_topk(py::object queries_obj, py::object hashes_obj, int k, int num_threads,
+	Workspace* workspace)
+{
+	hash_array hashes(hashes_obj);
+	ndarray_float queries = check_asymmetric_inputs(queries_obj, hashes);
+
+	if (k < 0 || k > hashes.size)
+		throw py::value_error("k must be in [0, size of hashes]");
+
+	ssize_t Q = queries.shape(0);
+	ssize_t N = hashes.size;
+	int bits = (int)queries.shape(1);
+	int bytes = (bits + 7) / 8;
+	int words = words_per_hash<uint64_t>(bits);
+	num_threads = get_num_threads(num_threads);
+	Workspace local;
+	Workspace& ws = workspace ? *workspace : local;
+
+	ndarray_uint32 indices = ws.output<uint32_t>("asymmetric_topk.indices", std::vector<ssize_t>{Q, k});
+	py::array_t<float, py::array::c_style> scores = ws.output<float>("asymmetric_topk.scores", std::vector<ssize_t>{Q, k});
+	uint32_t* __restrict r = indices.mutable_data();
+	float* __restrict s = scores.mutable_data();
+	const float* __restrict q = queries.data();
+
+	{
+		py::gil_scoped_release release;
+		std::lock_guard<std::mutex> lock(ws.mutex);
+
+		const uint64_t* __restrict hashes_int = hashes.int_hashes<uint64_t>(ws.storage<uint64_t>(0), words, num_threads);
+		ws.reserve(num_threads);
+
+		parallel_for(Q, num_threads, [&](ssize_t begin, ssize_t end, int thread_id)
+		{
+			float* lut = ws.scratch<float>(thread_id, Workspace::TABLE, 256 * bytes);
+			float* score = ws.scratch<float>(thread_id, Workspace::DISTANCE, N);
+			std::pair<float, uint32_t>* candidates = ws.scratch<std::pair<float, uint32_t> >(thread_id, Workspace::SELECTION,
+				asymmetric_topk_capacity(k) + asymmetric_topk_block);
+			for (ssize_t i = begin; i < end; ++i)
+			{
+				{
+					stage_timer timer(STAGE_ASYMMETRIC, N * words * sizeof(uint64_t));
+					asymmetric_kernel::active(q + i * bits, bits, hashes_int, N, words, score, lut);
+				}
+				stage_timer timer(STAGE_SORT, N * sizeof(float));
+				asymmetric_topk_1d(r + i * k, s + i * k, score, N, k, candidates);
+			}
+		});
+	}
+
+	return std::make_tuple(indices, scores);
+}
+
+// Metrics of reranking. Dot and cosine are similarities, larger is closer, l2 is squared euclidean distance
+enum rerank_metric_t
+{
+	RERANK_DOT,
+	RERANK_COSINE,
+	RERANK_L2
+};
+
+// Returns dot product of x and y, their squared distance or cosine of the angle between them, given norm of x.
+// Partial sums are kept in separate lanes, so that the loop is vectorized
+template<rerank_metric_t M>
+inline float rerank_score(const float* __restrict x, const float* __restrict y, ssize_t size, float x_norm)
+{
+	float xy[16] = {}, yy[16] = {};
+	ssize_t i = 0;
+	for (; i + 16 <= size; i += 16)
+	{
+		for (int l = 0; l < 16; ++l)
+		{
+			if (M == RERANK_L2)
+			{
+				float d = x[i + l] - y[i + l];
+				xy[l] += d * d;
+			}
+			else
+			{
+				xy[l] += x[i + l] * y[i + l];
+			}
+			if (M == RERANK_COSINE)
+			{
+				yy[l] += y[i + l] * y[i + l];
+			}
+		}
+	}
+	float s = 0.0f, sy = 0.0f;
+	for (; i < size; ++i)
+	{
+		if (M == RERANK_L2)
+		{
+			float d = x[i] - y[i];
+			s += d * d;
+		}
+		else
+		{
+			s += x[i] * y[i];
+		}
+		if (M == RERANK_COSINE)
+		{
+			sy += y[i] * y[i];
+		}
+	}
+	for (int l = 0; l < 16; ++l)
+	{
+		s += xy[l];
+		sy += yy[l];
+	}
+	if (M == RERANK_COSINE)
+	{
+		float norm = x_norm * std::sqrt(sy);
+		return norm > 0.0f ? s / norm : 0.0f;
+	}
+	return s;
+}
+
+// Scores candidates of one query, distances are negated, so that larger is always closer
+template<rerank_metric_t M>
+void rerank_candidates(const float* __restrict query, const float* __restrict vectors, ssize_t dim, const uint32_t* __restrict candidate,
+	int candidates, std::pair<float, uint32_t>* __restrict out)
+{
+	float query_norm = M == RERANK_COSINE ? std::sqrt(rerank_score<RERANK_DOT>(query, query, dim, 0.0f)) : 0.0f;
+	for (int i = 0; i < candidates; ++i)
+	{
+		float score = rerank_score<M>(query, vectors + candidate[i] * dim, dim, query_norm);
+		out[i] = std::make_pair(M == RERANK_L2 ? -score : score, candidate[i]);
+	}
+}
+
+template<typename T, typename D>
+std::tuple<ndarray_uint32, ndarray_float> _hamming_rerank(const hash_array& hashes_query, const hash_array& hashes_db, ndarray_float vectors_query,
+	ndarray_float vectors_db, int k, int candidates, rerank_metric_t metric, int num_threads, Workspace& ws)
+{
+	ssize_t Q = hashes_query.size;
+	ssize_t N = hashes_db.size;
+	ssize_t dim = vectors_db.shape(1);
+	int words = words_per_hash<T>(std::max(hashes_query.bits, hashes_db.bits));
+	int buckets = (int)(8 * sizeof(T) * words) + 1;
+
+	ndarray_uint32 indices = ws.output<uint32_t>("hamming_rerank.indices", std::vector<ssize_t>{Q, k});
+	ndarray_float scores = ws.output<float>("hamming_rerank.scores", std::vector<ssize_t>{Q, k});
+	uint32_t* __restrict r = indices.mutable_data();
+	float* __restrict s = scores.mutable_data();
+	const float* __restrict vq = vectors_query.data();
+	const float* __restrict vdb = vectors_db.data();
+
+	{
+		py::gil_scoped_release release;
+		std::lock_guard<std::mutex> lock(ws.mutex);
+
+		const T* __restrict query_int = hashes_query.int_hashes<T>(ws.storage<T>(1), words, num_threads);
+		const T* __restrict db_int = hashes_db.int_hashes<T>(ws.storage<T>(0), words, num_threads);
+		ws.reserve(num_threads);
+
+		parallel_for(Q, num_threads, [&](ssize_t begin, ssize_t end, int thread_id)
+		{
+			D* dist = ws.scratch<D>(thread_id, Workspace::DISTANCE, N);
+			int32_t* count = ws.scratch<int32_t>(thread_id, Workspace::COUNT, buckets);
+			uint32_t* candidate = ws.scratch<uint32_t>(thread_id, Workspace::CANDIDATES, candidates);
+			D* candidate_dist = ws.scratch<D>(thread_id, Workspace::CANDIDATE_DISTANCE, candidates);
+			std::pair<float, uint32_t>* ranked = ws.scratch<std::pair<float, uint32_t> >(thread_id, Workspace::SELECTION, candidates);
+
+			for (ssize_t q = begin; q < end; ++q)
+			{
+				{
+					stage_timer timer(STAGE_DISTANCE, N * words * sizeof(T));
+					_hamming_distance<T, D>(db_int, N, words, query_int + q * words, dist);
+				}
+				{
+					stage_timer timer(STAGE_SORT, N * sizeof(D));
+					topk_1d<D>(candidate, candidate_dist, dist, N, candidates, count, buckets);
+				}
+
+				stage_timer timer(STAGE_RERANK, candidates * dim * sizeof(float));
+
+				// Rows are read in the order of index, which is friendlier to memory mapped arrays
+				std::sort(candidate, candidate + candidates);
+				switch (metric)
+				{
+				case RERANK_DOT: rerank_candidates<RERANK_DOT>(vq + q * dim, vdb, dim, candidate, candidates, ranked); break;
+				case RERANK_COSINE: rerank_candidates<RERANK_COSINE>(vq + q * dim, vdb, dim, candidate, candidates, ranked); break;
+				case RERANK_L2: rerank_candidates<RERANK_L2>(vq + q * dim, vdb, dim, candidate, candidates, ranked); break;
+				}
+
+				std::partial_sort(ranked, ranked + k, ranked + candidates,
+					[](const std::pair<float, uint32_t>& a, const std::pair<float, uint32_t>& b)
+					{
+						return a.first > b.first || (a.first == b.first && a.second < b.second);
+					});
+
+				for (int i = 0; i < k; ++i)
+				{
+					s[q * k + i] = metric == RERANK_L2 ? -ranked[i].first : ranked[i].first;
+					r[q * k + i] = ranked[i].second;
+				}
+			}
+		});
+	}
+
+	return std::make_tuple(indices, scores);
+}
+
+std::tuple<ndarray_uint32, ndarray_float> hamming_rerank(py::object hashes_query_obj, py::object hashes_db_obj, py::object vectors_query_obj,
+	py::object vectors_db_obj, int k, int candidates, const std::string& metric_name, int num_threads, Workspace* workspace)
+{
+	hash_array hashes_query(hashes_query_obj), hashes_db(hashes_db_obj);
+	ndarray_float vectors_query = as_array<float>(vectors_query_obj, "vectors_query");
+	ndarray_float vectors_db = as_array<float>(vectors_db_obj, "vectors_db");
+
+	if (hashes_query.ndim != 2 || hashes_db.ndim != 2 || vectors_query.ndim() != 2 || vectors_db.ndim() != 2)
+		throw std::runtime_error("Number of dimensions must be two");
+
+	bool hash32 = check_hash_length(hashes_query, hashes_db);
+
+	if (vectors_query.shape(0) != hashes_query.size || vectors_db.shape(0) != hashes_db.size)
+		throw std::runtime_error("Number of vectors must match number of hashes");
+
+	if (vectors_query.shape(1) != vectors_db.shape(1))
+		throw std::runtime_error("Length of vectors_query and vectors_db must match");
+
+	if (candidates == 0)
+		candidates = (int)hashes_db.size;
+
+	if (k < 0 || k > candidates || candidates > hashes_db.size)
+		throw py::value_error("k must be in [0, candidates] and candidates must not be greater than size of hashes_db");
+
+	rerank_metric_t metric;
+	if (metric_name == "dot")
+		metric = RERANK_DOT;
+	else if (metric_name == "cosine")
+		metric = RERANK_COSINE;
+	else if (metric_name == "l2")
+		metric = RERANK_L2;
+	else
+		throw py::value_error("Unknown metric " + metric_name + ", must be dot, cosine or l2");
+
+	num_threads = get_num_threads(num_threads);
+	Workspace local;
+	Workspace& ws = workspace ? *workspace : local;
+
+	if (hash32)
+	{
+		return _hamming_rerank<uint32_t, uint8_t>(hashes_query, hashes_db, vectors_query, vectors_db, k, candidates, metric, num_threads, ws);
+	}
+	else if (!is_wide_distance<uint64_t>(words_per_hash<uint64_t>(hashes_db.bits)))
+	{
+		return _hamming_rerank<uint64_t, uint8_t>(hashes_query, hashes_db, vectors_query, vectors_db, k, candidates, metric, num_threads, ws);
+	}
+	else
+	{
+		return _hamming_rerank<uint64_t, uint16_t>(hashes_query, hashes_db, vectors_query, vectors_db, k, candidates, metric, num_threads, ws);
+	}
+}
+
+// Scale of the fixed point numbers in which recall is accumulated. Partial sums of precision and recall are integers,
+// so they can be added up in any order, and the result does not depend on how queries are split between threads
+const double recall_scale = 4294967296.0;
+
+// Sum of precision terms of average precision, kept as 64.64 fixed point, so that it is exact and does not depend on
+// the order in which terms are added. Terms are floats in (0, 1] not smaller than 2^-31, so they are exact in this format
+struct fixed_point_sum
+{
+	fixed_point_sum(): hi(0), lo(0)
+	{}
+
+	void add(float x)
+	{
+		if (x >= 1.0f)
+		{
+			hi += 1;
+			return;
+		}
+		uint64_t v = (uint64_t)((double)x * 18446744073709551616.0);
+		lo += v;
+		hi += lo < v;
+	}
+
+	double value() const
+	{
+		return (double)hi + (double)lo * (1.0 / 18446744073709551616.0);
+	}
+
+	uint64_t hi;
+	uint64_t lo;
+};
+
+// Per-thread scratch buffers and partial sums of precision and recall curves
+struct APAccumulator
+{
+	explicit APAccumulator(int top_n):
+		relevance(top_n), cumulative(top_n), precision(top_n), precision_sum(top_n, 0), recall_sum(top_n, 0)
+	{}
+
+	std::vector<uint8_t> relevance;
+	std::vector<int> cumulative;
+	std::vector<float> precision;
+	std::vector<uint64_t> precision_sum;
+	std::vector<uint64_t> recall_sum;
+};
+
+template<typename R>
+inline double compute_average_precision(
+	const R* __restrict rank, 
+	const uint8_t* __restrict similarity, 
+	APAccumulator& acc,
+	ssize_t N, int top_n)
+{
+	uint8_t* __restrict relevance = acc.relevance.data();
+	int* __restrict cumulative = acc.cumulative.data();
+	float* __restrict precision = acc.precision.data();
+	uint64_t* __restrict av_precision = acc.precision_sum.data();
+	uint64_t* __restrict av_recall = acc.recall_sum.data();
+
+	for (int i =0; i < top_n; ++i)
+	{
+		R index = rank[i];
+		relevance[i] = similarity[index];
+	}
+	
+	cumulative[0] = relevance[0];
+	for (int i = 1; i < top_n; ++i)
+	{
+		cumulative[i] = relevance[i] + cumulative[i - 1];
+	}
+    
+	int max_number_of_relevant_documents = cumulative[top_n - 1];
+    
+	for (ssize_t i = top_n; i < N; ++i)
+	{
+		R index = rank[i];
+		max_number_of_relevant_documents += similarity[index];
+	}
+	max_number_of_relevant_documents = std::min(max_number_of_relevant_documents, top_n);
+    
+	if (max_number_of_relevant_documents != 0)
+	{
+		double scale = recall_scale / max_number_of_relevant_documents;
+
+		for (int i = 0; i < top_n; ++i)
+		{
+			precision[i] = cumulative[i] / float(i+1);
+		}
+    
+		for (int i = 0; i < top_n; ++i)
+		{
+			av_precision[i] += cumulative[i];
+			av_recall[i] += (uint64_t)(cumulative[i] * scale + 0.5);
+		}
+    
+		fixed_point_sum ap;
+		for (int i = 0; i < top_n; ++i)
+		{
+			if (relevance[i])
+				ap.add(precision[i]);
+		}
+		return ap.value() / max_number_of_relevant_documents;
+	}
+	return 0.0;
+}
+
+// Combines per-query average precisions and per-thread partial sums into mAP and averaged precision and recall curves.
+// Must be called with GIL held
+std::tuple<double, ndarray_float, ndarray_float> reduce_average_precision(const std::vector<double>& ap, std::vector<APAccumulator>& acc, int top_n, Workspace& ws)
+{
+	ssize_t Q = ap.size();
+
+	double map = 0.0;
+	for (ssize_t q = 0; q < Q; ++q)
+	{
+		map += ap[q];
+	}
+	map /= Q;
+
+	for (size_t t = 1; t < acc.size(); ++t)
+	{
+		for (int i = 0; i < top_n; ++i)
+		{
+			acc[0].precision_sum[i] += acc[t].precision_sum[i];
+			acc[0].recall_sum[i] += acc[t].recall_sum[i];
+		}
+	}
+
+	ndarray_float av_precision = ws.output<float>("precision", std::vector<ssize_t>{top_n});
+	ndarray_float av_recall = ws.output<float>("recall", std::vector<ssize_t>{top_n});
+	float* p = av_precision.mutable_data();
+	float* r = av_recall.mutable_data();
+
+	for (int i = 0; i < top_n; ++i)
+	{
+		p[i] = (float)((double)acc[0].precision_sum[i] / (i + 1) / Q);
+		r[i] = (float)((double)acc[0].recall_sum[i] / recall_scale / Q);
+	}
+
+	return std::tuple<double, ndarray_float, ndarray_float>(map, av_precision, av_recall);
+}
+
+template<typename R>
+std::tuple<double, ndarray_float, ndarray_float> _compute_map_from_rank(py::array_t<R, py::array::c_style> rank, ndarray_uint8 similarity, int top_n, int num_threads, Workspace& ws)
+{
+	py::buffer_info r_info = rank.request();
+	py::buffer_info s_info = similarity.request();
+
+	if (r_info.ndim != 2)
+		throw std::runtime_error("Number of dimensions for rank must be two");
+
+	if (s_info.ndim != 2)
+		throw std::runtime_error("Number of dimensions for similarity must be two");
+
+	if (s_info.shape != r_info.shape)
+		throw std::runtime_error("Shape of rank must match shape of labels_query");
+
+	if (top_n > r_info.shape[1])
+		throw py::value_error("top_n must not be greater than second dimension of rank");
+
+	ssize_t Q = r_info.shape[0];
+	ssize_t N = r_info.shape[1];
+
+	if (top_n == 0)
+	{
+		top_n = (int)N;
+	}
+
+	const R* r = (const R*)r_info.ptr;
+	const uint8_t* s = (const uint8_t*)s_info.ptr;
+
+	num_threads = (int)std::max<ssize_t>(std::min<ssize_t>(get_num_threads(num_threads), Q), 1);
+
+	std::vector<double> ap(Q);
+	std::vector<APAccumulator> acc(num_threads, APAccumulator(top_n));
+
+	{
+		py::gil_scoped_release release;
+		std::lock_guard<std::mutex> lock(ws.mutex);
+
+		parallel_for(Q, num_threads, [&](ssize_t begin, ssize_t end, int thread_id)
+		{
+			for (ssize_t q = begin; q < end; ++q)
+			{
+				const R* rank_ptr = r + q * N;
+				const uint8_t* similarity_ptr = s + q * N;
+
+				stage_timer timer(STAGE_AVERAGE_PRECISION, N * (sizeof(R) + 1));
+				ap[q] = compute_average_precision(rank_ptr, similarity_ptr, acc[thread_id], N, top_n);
+			}
+		});
+	}
+
+	return reduce_average_precision(ap, acc, top_n, ws);
+}
+
+// Rank is used as it is if it is uint32 or int64, as returned by numpy.argsort. Boolean similarity is read as uint8
+std::tuple<double, ndarray_float, ndarray_float> compute_map_from_rank(py::object rank, py::object similarity, int top_n, int num_threads, Workspace* workspace)
+{
+	Workspace local;
+	Workspace& ws = workspace ? *workspace : local;
+
+	if (is_array_of<bool>(similarity))
+	{
+		similarity = similarity.attr("view")(py::dtype::of<uint8_t>());
+	}
+	ndarray_uint8 s = as_array<uint8_t>(similarity, "Similarity");
+
+	if (is_array_of<int64_t>(rank))
+	{
+		return _compute_map_from_rank<int64_t>(as_array<int64_t>(rank, "Rank"), s, top_n, num_threads, ws);
+	}
+	return _compute_map_from_rank<uint32_t>(as_array<uint32_t>(rank, "Rank"), s, top_n, num_threads, ws);
+}
+
+// Histogram-based average precision. Ties are broken by index, so the position of an item in the rank is the number of
+// items with smaller distance plus the number of items with the same distance and smaller index. Distances do not need to
+// be sorted and relevance does not need to be gathered through the rank, two passes over distances in index order are enough
+
+// Adds items to per-distance histograms of all and of relevant items
+template<typename D>
+inline void count_relevant(const D* __restrict d, const uint8_t* __restrict s, ssize_t n, uint32_t* __restrict total, uint32_t* __restrict relevant)
+{
+	for (ssize_t i = 0; i < n; ++i)
+	{
+		total[d[i]]++;
+		relevant[d[i]] += s[i];
+	}
+}
+
+// Turns histograms into position of the first item and number of relevant items before each distance.
+// Returns number of relevant items
+inline uint32_t histogram_to_positions(uint32_t* __restrict position, uint32_t* __restrict relevant, int buckets)
+{
+	uint32_t position_sum = 0;
+	uint32_t relevant_sum = 0;
+	for (int d = 0; d < buckets; ++d)
+	{
+		uint32_t c = position[d];
+		position[d] = position_sum;
+		position_sum += c;
+		c = relevant[d];
+		relevant[d] = relevant_sum;
+		relevant_sum += c;
+	}
+	return relevant_sum;
+}
+
+// Walks items in index order and records precision terms of average precision and steps of precision and recall curves
+// at positions of relevant items within top_n, same as compute_average_precision does with cumulative sums over the rank.
+// `position` and `relevant` are advanced, so items can be given in several calls
+template<typename D>
+inline void rank_relevant(const D* __restrict d, const uint8_t* __restrict s, ssize_t n, uint32_t* __restrict position, uint32_t* __restrict relevant,
+	int top_n, int max_relevant, fixed_point_sum& ap, uint64_t* __restrict precision_step, uint64_t* __restrict recall_step)
+{
+	double scale = recall_scale / max_relevant;
+	int taken = 0;
+
+	for (ssize_t i = 0; i < n && taken < top_n; ++i)
+	{
+		uint32_t p = position[d[i]];
+		if (p >= (uint32_t)top_n)
+			continue;
+		position[d[i]]++;
+		++taken;
+		if (s[i])
+		{
+			uint32_t cumulative = ++relevant[d[i]];
+			ap.add(cumulative / float(p + 1));
+			precision_step[p] += 1;
+			recall_step[p] += (uint64_t)(cumulative * scale + 0.5) - (uint64_t)((cumulative - 1) * scale + 0.5);
+		}
+	}
+}
+
+// Turns steps of precision and recall curves into partial sums
+inline void steps_to_sums(APAccumulator& acc, int top_n)
+{
+	for (int i = 1; i < top_n; ++i)
+	{
+		acc.precision_sum[i] += acc.precision_sum[i - 1];
+		acc.recall_sum[i] += acc.recall_sum[i - 1];
+	}
+}
+
+// Labels passed from Python. Integer arrays of any width and signedness are read as they are, with any strides.
+// In and_mode labels are bitmasks, either a vector or an array of shape (N, words)
+struct label_array
+{
+	label_array(py::handle x, bool and_mode): and_mode(and_mode)
+	{
+		if (py::isinstance<py::array>(x) && is_native_integer(py::reinterpret_borrow<py::array>(x).dtype()))
+		{
+			array = py::reinterpret_borrow<py::array>(x);
+		}
+		else if (and_mode)
+		{
+			array = as_array<uint64_t>(x, "Labels");
+		}
+		else
+		{
+			array = as_array<uint32_t>(x, "Labels");
+		}
+
+		is_signed = dtype_kind(array.dtype()) == 'i';
+		itemsize = (int)array.itemsize();
+		ndim = array.ndim();
+		size = ndim > 0 ? array.shape(0) : 0;
+		words = ndim > 1 ? (int)array.shape(1) : 1;
+		stride = ndim > 0 ? array.strides(0) : 0;
+		word_stride = ndim > 1 ? array.strides(1) : 0;
+		ptr = array.data();
+	}
+
+	// Fills similarity of the q-th label of `query` to all labels of this array. Does not need GIL
+	void similarity(const label_array& query, ssize_t q, uint8_t* __restrict out) const
+	{
+		switch (itemsize)
+		{
+		case 1: is_signed ? similarity<int8_t>(query, q, out) : similarity<uint8_t>(query, q, out); break;
+		case 2: is_signed ? similarity<int16_t>(query, q, out) : similarity<uint16_t>(query, q, out); break;
+		case 4: is_signed ? similarity<int32_t>(query, q, out) : similarity<uint32_t>(query, q, out); break;
+		default: is_signed ? similarity<int64_t>(query, q, out) : similarity<uint64_t>(query, q, out); break;
+		}
+	}
+
+	py::array array;
+	bool and_mode;
+	bool is_signed;
+	// Size of labels in bytes
+	uint64_t bytes() const
+	{
+		return (uint64_t)size * words * itemsize;
+	}
+
+	int itemsize;
+	ssize_t ndim;
+	ssize_t size;
+	int words;
+	ssize_t stride;
+	ssize_t word_stride;
+	const void* ptr;
+
+private:
+	static bool is_native_integer(const py::dtype& d)
+	{
+		char kind = dtype_kind(d);
+		return (kind == 'i' || kind == 'u') && d.attr("isnative").cast<bool>();
+	}
+
+	// Returns k-th word of i-th label, sign extended to 64 bits
+	uint64_t raw(ssize_t i, int k) const
+	{
+		const char* p = (const char*)ptr + i * stride + k * word_stride;
+		switch (itemsize)
+		{
+		case 1: return is_signed ? (uint64_t)(int64_t)*(const int8_t*)p : *(const uint8_t*)p;
+		case 2: return is_signed ? (uint64_t)(int64_t)*(const int16_t*)p : *(const uint16_t*)p;
+		case 4: return is_signed ? (uint64_t)(int64_t)*(const int32_t*)p : *(const uint32_t*)p;
+		default: return *(const uint64_t*)p;
+		}
+	}
+
+	// Converts i-th label to type L. Returns false if L can not represent it, then it is not equal to any label of type L
+	template<typename L>
+	bool label_as(ssize_t i, L& out) const
+	{
+		uint64_t v = raw(i, 0);
+		if (is_signed && (int64_t)v < 0)
+		{
+			if (!std::numeric_limits<L>::is_signed || (int64_t)v < (int64_t)std::numeric_limits<L>::min())
+				return false;
+		}
+		else if (v > (uint64_t)std::numeric_limits<L>::max())
+		{
+			return false;
+		}
+		out = (L)v;
+		return true;
+	}
+
+	template<typename L>
+	void similarity(const label_array& query, ssize_t q, uint8_t* __restrict out) const
+	{
+		const char* base = (const char*)ptr;
+		if (!and_mode)
+		{
+			L label;
+			if (!query.label_as<L>(q, label))
+			{
+				memset(out, 0, size);
+			}
+			else if (stride == (ssize_t)sizeof(L))
+			{
+				const L* __restrict labels = (const L*)base;
+				for (ssize_t i = 0; i < size; ++i)
+				{
+					out[i] = labels[i] == label;
+				}
+			}
+			else
+			{
+				for (ssize_t i = 0; i < size; ++i)
+				{
+					out[i] = *(const L*)(base + i * stride) == label;
+				}
+			}
+		}
+		else if (words == 1)
+		{
+			uint64_t label = query.raw(q, 0);
+			for (ssize_t i = 0; i < size; ++i)
+			{
+				out[i] = ((uint64_t)*(const L*)(base + i * stride) & label) != 0;
+			}
+		}
+		else
+		{
+			std::vector<uint64_t> label(words);
+			for (int k = 0; k < words; ++k)
+			{
+				label[k] = query.raw(q, k);
+			}
+			for (ssize_t i = 0; i < size; ++i)
+			{
+				uint64_t common = 0;
+				for (int k = 0; k < words; ++k)
+				{
+					common |= (uint64_t)*(const L*)(base + i * stride + k * word_stride) & label[k];
+				}
+				out[i] = common != 0;
+			}
+		}
+	}
+};
+
+template<typename T, typename D>
+std::tuple<double, ndarray_float, ndarray_float> _compute_map_from_hashes(const hash_array& hashes_db, const hash_array& hashes_query, const label_array& labels_db, const label_array& labels_query, int top_n, int num_threads, Workspace& ws)
+{
+
+	ssize_t Q = hashes_query.size;
+	ssize_t N = hashes_db.size;
+	int words = words_per_hash<T>(std::max(hashes_db.bits, hashes_query.bits));
+	int buckets = (int)(8 * sizeof(T) * words) + 1;
+
+	if (top_n == 0)
+	{
+		top_n = (int)N;
+	}
+
+	int hash_threads = num_threads;
+	num_threads = (int)std::max<ssize_t>(std::min<ssize_t>(num_threads, Q), 1);
+
+	std::vector<double> ap(Q);
+	std::vector<APAccumulator> acc(num_threads, APAccumulator(top_n));
+
+	{
+		py::gil_scoped_release release;
+		std::lock_guard<std::mutex> lock(ws.mutex);
+
+		const T* __restrict hashes_db_int = hashes_db.int_hashes<T>(ws.storage<T>(0), words, hash_threads);
+		const T* __restrict hashes_query_int = hashes_query.int_hashes<T>(ws.storage<T>(1), words, hash_threads);
+		ws.reserve(num_threads);
+
+		parallel_for(Q, num_threads, [&](ssize_t begin, ssize_t end, int thread_id)
+		{
+			uint8_t* similarity = ws.scratch<uint8_t>(thread_id, Workspace::SIMILARITY, N);
+			D* dist = ws.scratch<D>(thread_id, Workspace::DISTANCE, N);
+			uint32_t* position = ws.scratch<uint32_t>(thread_id, Workspace::POSITION, buckets);
+			uint32_t* relevant = ws.scratch<uint32_t>(thread_id, Workspace::RELEVANT, buckets);
+			APAccumulator& a = acc[thread_id];
+
+			for (ssize_t q = begin; q < end; ++q)
+			{
+				const T* query = hashes_query_int + q * words;
+				{
+					stage_timer timer(STAGE_DISTANCE, N * words * sizeof(T));
+					_hamming_distance<T, D>(hashes_db_int, N, words, query, dist);
+				}
+				{
+					stage_timer timer(STAGE_SIMILARITY, labels_db.bytes());
+					labels_db.similarity(labels_query, q, similarity);
+				}
+				int max_relevant;
+				{
+					stage_timer timer(STAGE_HISTOGRAM, N * (sizeof(D) + 1));
+					std::fill(position, position + buckets, 0);
+					std::fill(relevant, relevant + buckets, 0);
+					count_relevant<D>(dist, similarity, N, position, relevant);
+					max_relevant = (int)std::min<uint32_t>(histogram_to_positions(position, relevant, buckets), top_n);
+				}
+				if (max_relevant == 0)
+				{
+					ap[q] = 0.0;
+					continue;
+				}
+
+				// precision_sum and recall_sum hold steps of the curves until all queries are done
+				stage_timer timer(STAGE_RANK, N * (sizeof(D) + 1));
+				fixed_point_sum ap_sum;
+				rank_relevant<D>(dist, similarity, N, position, relevant, top_n, max_relevant,
+					ap_sum, a.precision_sum.data(), a.recall_sum.data());
+				ap[q] = ap_sum.value() / max_relevant;
+			}
+
+			steps_to_sums(a, top_n);
+		});
+	}
+
+	return reduce_average_precision(ap, acc, top_n, ws);
+}
+
+// Checks shapes of inputs of compute_map_from_hashes and compute_metrics. Returns true if hashes fit into 32 bits
+bool check_map_inputs(const hash_array& hashes_db, const hash_array& hashes_query, const label_array& labels_db, const label_array& labels_query, bool and_mode)
+{
+	if (hashes_db.ndim != 2 || hashes_query.ndim != 2)
+		throw std::runtime_error("Number of dimensions for hashes must be two");
+
+	if (!and_mode && (labels_db.ndim != 1 || labels_query.ndim != 1))
+		throw std::runtime_error("Number of dimensions for labels must be one");
+
+	if (and_mode && (labels_db.ndim < 1 || labels_db.ndim > 2 || labels_query.ndim != labels_db.ndim))
+		throw std::runtime_error("Number of dimensions for labels must be one or two and must match");
+
+	if (labels_db.words != labels_query.words)
+		throw std::runtime_error("Second dimension of labels must match");
+
+	if (hashes_db.size != labels_db.size)
+		throw std::runtime_error("Size of hashes_db and labels_db must match");
+
+	if (hashes_query.size != labels_query.size)
+		throw std::runtime_error("Size of hashes_db and labels_db must match");
+
+	return check_hash_length(hashes_db, hashes_query);
+}
+
+std::tuple<double, ndarray_float, ndarray_float> compute_map_from_hashes(py::object hashes_db_obj, py::object hashes_query_obj, py::object labels_db_obj, py::object labels_query_obj, int top_n, bool and_mode, int num_threads, Workspace* workspace)
+{
+	hash_array hashes_db(hashes_db_obj), hashes_query(hashes_query_obj);
+	label_array labels_db(labels_db_obj, and_mode), labels_query(labels_query_obj, and_mode);
+	bool hash32 = check_map_inputs(hashes_db, hashes_query, labels_db, labels_query, and_mode);
+
+	if (top_n > labels_db.size)
+		throw py::value_error("top_n must not be greater than size of labels_db");
+
+	num_threads = get_num_threads(num_threads);
+	Workspace local;
+	Workspace& ws = workspace ? *workspace : local;
+
+	if (hash32)
+	{
+		return _compute_map_from_hashes<uint32_t, uint8_t>(hashes_db, hashes_query, labels_db, labels_query, top_n, num_threads, ws);
+	}
+	else if (!is_wide_distance<uint64_t>(words_per_hash<uint64_t>(hashes_db.bits)))
+	{
+		return _compute_map_from_hashes<uint64_t, uint8_t>(hashes_db, hashes_query, labels_db, labels_query, top_n, num_threads, ws);
+	}
+	else
+	{
+		return _compute_map_from_hashes<uint64_t, uint16_t>(hashes_db, hashes_query, labels_db, labels_query, top_n, num_threads, ws);
+	}
+}
+
+
+// Cutoffs of metrics computed by compute_metrics. Zero cutoff means the whole database
+struct metric_set
+{
+	std::vector<int> map_at;
+	std::vector<int> precision_at;
+	std::vector<int> ndcg_at;
+	std::vector<int> radius;
+
+	// Largest cutoff, relevant items are ranked up to it
+	int depth(int N) const
+	{
+		int k = 0;
+		for (const std::vector<int>* cutoffs : {&map_at, &precision_at, &ndcg_at})
+		{
+			for (int c : *cutoffs)
+			{
+				k = std::max(k, c == 0 ? N : c);
+			}
+		}
+		return k;
+	}
+};
+
+// Same as rank_relevant, but records position of each relevant item within top_n. Relevant items are numbered in the
+// order of the rank, so positions come out sorted. Returns number of relevant items within top_n
+template<typename D>
+inline uint32_t rank_relevant_positions(const D* __restrict d, const uint8_t* __restrict s, ssize_t n, uint32_t* __restrict position,
+	uint32_t* __restrict relevant, int top_n, uint32_t* __restrict relevant_position)
+{
+	uint32_t count = 0;
+	int taken = 0;
+
+	for (ssize_t i = 0; i < n && taken < top_n; ++i)
+	{
+		uint32_t p = position[d[i]];
+		if (p >= (uint32_t)top_n)
+			continue;
+		position[d[i]]++;
+		++taken;
+		if (s[i])
+		{
+			uint32_t cumulative = ++relevant[d[i]];
+			relevant_position[cumulative - 1] = p;
+			count = std::max(count, cumulative);
+		}
+	}
+	return count;
+}
+
+template<typename T, typename D>
+py::dict _compute_metrics(const hash_array& hashes_db, const hash_array& hashes_query, const label_array& labels_db, const label_array& labels_query,
+	const metric_set& metrics, bool per_query, int num_threads, Workspace& ws)
+{
+	ssize_t Q = hashes_query.size;
+	ssize_t N = hashes_db.size;
+	int words = words_per_hash<T>(std::max(hashes_db.bits, hashes_query.bits));
+	int buckets = (int)(8 * sizeof(T) * words) + 1;
+	int depth = metrics.depth((int)N);
+
+	int hash_threads = num_threads;
+	num_threads = (int)std::max<ssize_t>(std::min<ssize_t>(num_threads, Q), 1);
+
+	// Per-query values, one row per metric
+	size_t M = metrics.map_at.size(), P = metrics.precision_at.size(), G = metrics.ndcg_at.size(), R = metrics.radius.size();
+	std::vector<double> ap(M * Q), precision(P * Q), ndcg(G * Q), radius_precision(R * Q), radius_recall(R * Q);
+
+	// Discount of NDCG at each position and DCG of the ideal rank with given number of relevant items
+	std::vector<double> discount(G ? depth : 0), ideal(G ? depth + 1 : 0, 0.0);
+	for (size_t i = 0; i < discount.size(); ++i)
+	{
+		discount[i] = 1.0 / std::log2(i + 2.0);
+		ideal[i + 1] = ideal[i] + discount[i];
+	}
+
+	{
+		py::gil_scoped_release release;
+		std::lock_guard<std::mutex> lock(ws.mutex);
+
+		const T* __restrict hashes_db_int = hashes_db.int_hashes<T>(ws.storage<T>(0), words, hash_threads);
+		const T* __restrict hashes_query_int = hashes_query.int_hashes<T>(ws.storage<T>(1), words, hash_threads);
+		ws.reserve(num_threads);
+
+		parallel_for(Q, num_threads, [&](ssize_t begin, ssize_t end, int thread_id)
+		{
+			uint8_t* similarity = ws.scratch<uint8_t>(thread_id, Workspace::SIMILARITY, N);
+			D* dist = ws.scratch<D>(thread_id, Workspace::DISTANCE, N);
+			uint32_t* position = ws.scratch<uint32_t>(thread_id, Workspace::POSITION, buckets);
+			uint32_t* relevant = ws.scratch<uint32_t>(thread_id, Workspace::RELEVANT, buckets);
+			uint32_t* relevant_position = ws.scratch<uint32_t>(thread_id, Workspace::CANDIDATES, depth);
+
+			for (ssize_t q = begin; q < end; ++q)
+			{
+				const T* query = hashes_query_int + q * words;
+				{
+					stage_timer timer(STAGE_DISTANCE, N * words * sizeof(T));
+					_hamming_distance<T, D>(hashes_db_int, N, words, query, dist);
+				}
+				{
+					stage_timer timer(STAGE_SIMILARITY, labels_db.bytes());
+					labels_db.similarity(labels_query, q, similarity);
+				}
+				uint32_t total_relevant;
+				{
+					stage_timer timer(STAGE_HISTOGRAM, N * (sizeof(D) + 1));
+					std::fill(position, position + buckets, 0);
+					std::fill(relevant, relevant + buckets, 0);
+					count_relevant<D>(dist, similarity, N, position, relevant);
+					total_relevant = histogram_to_positions(position, relevant, buckets);
+				}
+
+				// Items within radius r are all items with distance below r + 1
+				for (size_t i = 0; i < R; ++i)
+				{
+					int r = std::min(metrics.radius[i] + 1, buckets);
+					uint32_t retrieved = r < buckets ? position[r] : (uint32_t)N;
+					uint32_t retrieved_relevant = r < buckets ? relevant[r] : total_relevant;
+					radius_precision[i * Q + q] = retrieved ? (double)retrieved_relevant / retrieved : 0.0;
+					radius_recall[i * Q + q] = total_relevant ? (double)retrieved_relevant / total_relevant : 0.0;
+				}
+
+				if (depth == 0)
+					continue;
+
+				stage_timer timer(STAGE_RANK, N * (sizeof(D) + 1));
+				const uint32_t* p = relevant_position;
+				uint32_t count = rank_relevant_positions<D>(dist, similarity, N, position, relevant, depth, relevant_position);
+
+				for (size_t i = 0; i < M; ++i)
+				{
+					int k = metrics.map_at[i] == 0 ? (int)N : metrics.map_at[i];
+					int max_relevant = (int)std::min<uint32_t>(total_relevant, k);
+					uint32_t m = (uint32_t)(std::lower_bound(p, p + count, (uint32_t)k) - p);
+					fixed_point_sum ap_sum;
+					for (uint32_t c = 0; c < m; ++c)
+					{
+						ap_sum.add((c + 1) / float(p[c] + 1));
+					}
+					ap[i * Q + q] = max_relevant ? ap_sum.value() / max_relevant : 0.0;
+				}
+
+				for (size_t i = 0; i < P; ++i)
+				{
+					int k = metrics.precision_at[i] == 0 ? (int)N : metrics.precision_at[i];
+					uint32_t m = (uint32_t)(std::lower_bound(p, p + count, (uint32_t)k) - p);
+					precision[i * Q + q] = (double)m / k;
+				}
+
+				for (size_t i = 0; i < G; ++i)
+				{
+					int k = metrics.ndcg_at[i] == 0 ? (int)N : metrics.ndcg_at[i];
+					uint32_t m = (uint32_t)(std::lower_bound(p, p + count, (uint32_t)k) - p);
+					double dcg = 0.0;
+					for (uint32_t c = 0; c < m; ++c)
+					{
+						dcg += discount[p[c]];
+					}
+					ndcg[i * Q + q] = total_relevant ? dcg / ideal[std::min<uint32_t>(total_relevant, k)] : 0.0;
+				}
+			}
+		});
+	}
+
+	// Means are summed in the order of queries, so they do not depend on the number of threads
+	py::dict result;
+	auto key = [](const std::string& name, int k)
+	{
+		return k == 0 ? name : name + "@" + std::to_string(k);
+	};
+	auto add = [&](const std::string& name, const std::vector<double>& values, size_t i)
+	{
+		double mean = 0.0;
+		for (ssize_t q = 0; q < Q; ++q)
+		{
+			mean += values[i * Q + q];
+		}
+		result[py::str(name)] = mean / Q;
+	};
+	for (size_t i = 0; i < M; ++i)
+	{
+		add(key("map", metrics.map_at[i]), ap, i);
+		if (per_query)
+		{
+			py::array_t<double, py::array::c_style> a = ws.output<double>(key("ap", metrics.map_at[i]), std::vector<ssize_t>{Q});
+			std::copy(ap.begin() + i * Q, ap.begin() + (i + 1) * Q, a.mutable_data());
+			result[py::str(key("ap", metrics.map_at[i]))] = a;
+		}
+	}
+	for (size_t i = 0; i < P; ++i) add(key("precision", metrics.precision_at[i]), precision, i);
+	for (size_t i = 0; i < G; ++i) add(key("ndcg", metrics.ndcg_at[i]), ndcg, i);
+	for (size_t i = 0; i < R; ++i)
+	{
+		add("precision_radius@" + std::to_string(metrics.radius[i]), radius_precision, i);
+		add("recall_radius@" + std::to_string(metrics.radius[i]), radius_recall, i);
+	}
+	return result;
+}
+
+py::dict compute_metrics(py::object hashes_db_obj, py::object hashes_query_obj, py::object labels_db_obj, py::object labels_query_obj,
+	std::vector<int> map_at, std::vector<int> precision_at, std::vector<int> ndcg_at, std::vector<int> radius, bool per_query, bool and_mode, int num_threads,
+	Workspace* workspace)
+{
+	hash_array hashes_db(hashes_db_obj), hashes_query(hashes_query_obj);
+	label_array labels_db(labels_db_obj, and_mode), labels_query(labels_query_obj, and_mode);
+	bool hash32 = check_map_inputs(hashes_db, hashes_query, labels_db, labels_query, and_mode);
+
+	metric_set metrics = {map_at, precision_at, ndcg_at, radius};
+	for (const std::vector<int>* cutoffs : {&map_at, &precision_at, &ndcg_at})
+	{
+		for (int k : *cutoffs)
+		{
+			if (k < 0 || k > labels_db.size)
+				throw py::value_error("Cutoffs must not be negative or greater than size of labels_db");
+		}
+	}
+	for (int r : radius)
+	{
+		if (r < 0)
+			throw py::value_error("Radius must not be negative");
+	}
+
+	num_threads = get_num_threads(num_threads);
+	Workspace local;
+	Workspace& ws = workspace ? *workspace : local;
+
+	if (hash32)
+	{
+		return _compute_metrics<uint32_t, uint8_t>(hashes_db, hashes_query, labels_db, labels_query, metrics, per_query, num_threads, ws);
+	}
+	else if (!is_wide_distance<uint64_t>(words_per_hash<uint64_t>(hashes_db.bits)))
+	{
+		return _compute_metrics<uint64_t, uint8_t>(hashes_db, hashes_query, labels_db, labels_query, metrics, per_query, num_threads, ws);
+	}
+	else
+	{
+		return _compute_metrics<uint64_t, uint16_t>(hashes_db, hashes_query, labels_db, labels_query, metrics, per_query, num_threads, ws);
+	}
+}
+
+// Computes the same mAP as compute_map_from_hashes, while the database is given in chunks, which are passed twice.
+// Distances are small integers, so the first pass only builds per-query histograms of distances and of relevant items
+// at each distance. From them, the position of an item in the rank is known in the second pass: it is the number of items
+// with smaller distance plus the number of items with the same distance that came before it
+class StreamingMap
+{
+public:
+	StreamingMap(py::object hashes_query_obj, py::object labels_query_obj, int top_n, bool and_mode, int num_threads):
+		hashes_query(hashes_query_obj), labels_query(labels_query_obj, and_mode), top_n(top_n), and_mode(and_mode), N(0), ranked(0), second_pass(false),
+		skipped(false)
+	{
+		if (hashes_query.ndim != 2)
+			throw std::runtime_error("Number of dimensions for hashes must be two");
+
+		if (!and_mode && labels_query.ndim != 1)
+			throw std::runtime_error("Number of dimensions for labels must be one");
+
+		if (and_mode && (labels_query.ndim < 1 || labels_query.ndim > 2))
+			throw std::runtime_error("Number of dimensions for labels must be one or two");
+
+		if (hashes_query.size != labels_query.size)
+			throw std::runtime_error("Size of hashes_query and labels_query must match");
+
+		if (top_n < 0)
+			throw py::value_error("top_n must not be negative");
+
+		Q = hashes_query.size;
+		words = words_per_hash<uint64_t>(hashes_query.bits);
+		buckets = 64 * words + 1;
+		num_threads = get_num_threads(num_threads);
+		threads = (int)std::max<ssize_t>(std::min<ssize_t>(num_threads, Q), 1);
+
+		const uint64_t* h = hashes_query.int_hashes<uint64_t>(query_storage, words, num_threads);
+		if (h != query_storage.data())
+		{
+			query_storage.assign(h, h + Q * words);
+		}
+
+		position.assign(Q * buckets, 0);
+		relevant.assign(Q * buckets, 0);
+	}
+
+	// First pass, adds chunk to the histograms
+	void count(py::object hashes_db_obj, py::object labels_db_obj)
+	{
+		if (second_pass)
+			throw std::runtime_error("All chunks must be counted before ranking starts");
+
+		hash_array hashes_db(hashes_db_obj);
+		label_array labels_db(labels_db_obj, and_mode);
+		check_chunk(hashes_db, labels_db);
+
+		if (!is_wide_distance<uint64_t>(words))
+			pass<uint8_t, false>(hashes_db, labels_db);
+		else
+			pass<uint16_t, false>(hashes_db, labels_db);
+
+		N += hashes_db.size;
+	}
+
+	// Second pass, chunks must come in the same order as in the first pass
+	void rank(py::object hashes_db_obj, py::object labels_db_obj)
+	{
+		if (!second_pass)
+			start_second_pass();
+
+		hash_array hashes_db(hashes_db_obj);
+		label_array labels_db(labels_db_obj, and_mode);
+		check_chunk(hashes_db, labels_db);
+
+		if (ranked + hashes_db.size > N)
+			throw std::runtime_error("Ranked more items than were counted");
+
+		if (!is_wide_distance<uint64_t>(words))
+			pass<uint8_t, true>(hashes_db, labels_db);
+		else
+			pass<uint16_t, true>(hashes_db, labels_db);
+
+		ranked += hashes_db.size;
+	}
+
+	std::tuple<double, ndarray_float, ndarray_float> result()
+	{
+		if (!second_pass)
+			start_second_pass();
+
+		if (ranked != N)
+			throw std::runtime_error("Not all counted items were ranked");
+
+		if (skipped)
+			throw std::runtime_error("Some chunks were skipped, partial sums of all evaluators must be added and reduced");
+
+		partial_sums_t sums = partial_sums();
+		return reduce(std::get<0>(sums), std::get<1>(sums), std::get<2>(sums), std::get<3>(sums));
+	}
+
+	// Histograms of distances and of relevant items at each distance of all chunks counted so far, of shape (Q, buckets)
+	std::tuple<ndarray_uint32, ndarray_uint32> histograms() const
+	{
+		if (second_pass)
+			throw std::runtime_error("Histograms are only available before ranking starts");
+
+		ndarray_uint32 p(std::vector<ssize_t>{Q, buckets});
+		ndarray_uint32 r(std::vector<ssize_t>{Q, buckets});
+		std::copy(position.begin(), position.end(), p.mutable_data());
+		std::copy(relevant.begin(), relevant.end(), r.mutable_data());
+		return std::make_tuple(p, r);
+	}
+
+	// First pass, adds histograms of chunks counted elsewhere, as returned by histograms
+	void add_histograms(ndarray_uint32 p, ndarray_uint32 r)
+	{
+		if (second_pass)
+			throw std::runtime_error("All chunks must be counted before ranking starts");
+
+		N += check_histograms(p, r);
+		const uint32_t* p_ptr = p.data();
+		const uint32_t* r_ptr = r.data();
+		for (size_t i = 0; i < position.size(); ++i)
+		{
+			position[i] += p_ptr[i];
+			relevant[i] += r_ptr[i];
+		}
+	}
+
+	// Second pass, advances past chunks ranked elsewhere, given their histograms. Together with chunks passed to rank,
+	// they must come in the same order as in the first pass
+	void skip(ndarray_uint32 p, ndarray_uint32 r)
+	{
+		if (!second_pass)
+			start_second_pass();
+
+		ssize_t n = check_histograms(p, r);
+		if (ranked + n > N)
+			throw std::runtime_error("Ranked more items than were counted");
+
+		// Positions that reach top_n are not used anymore, so counts of a chunk can be added whether or not its items
+		// would have been taken
+		const uint32_t* p_ptr = p.data();
+		const uint32_t* r_ptr = r.data();
+		for (size_t i = 0; i < position.size(); ++i)
+		{
+			position[i] += p_ptr[i];
+			relevant[i] += r_ptr[i];
+		}
+		ranked += n;
+		skipped = true;
+	}
+
+	typedef std::tuple<ndarray_uint64, ndarray_int32, ndarray_uint64, ndarray_uint64> partial_sums_t;
+
+	// Exact sums of the chunks ranked so far: sums of precision terms of average precision of each query as (Q, 2) array
+	// of integer and fractional 64-bit words, number of relevant items of each query within top_n, and partial sums
+	// of precision and recall curves over queries. Sums of different chunks or queries can be added up and passed to reduce
+	partial_sums_t partial_sums()
+	{
+		if (!second_pass)
+			start_second_pass();
+
+		ndarray_uint64 ap(std::vector<ssize_t>{Q, 2});
+		ndarray_int32 max_rel(Q);
+		ndarray_uint64 p(top_n);
+		ndarray_uint64 r(top_n);
+		uint64_t* ap_ptr = ap.mutable_data();
+		for (ssize_t q = 0; q < Q; ++q)
+		{
+			ap_ptr[2 * q] = ap_sum[q].hi;
+			ap_ptr[2 * q + 1] = ap_sum[q].lo;
+		}
+		std::copy(max_relevant.begin(), max_relevant.end(), max_rel.mutable_data());
+
+		uint64_t* p_ptr = p.mutable_data();
+		uint64_t* r_ptr = r.mutable_data();
+		uint64_t p_sum = 0;
+		uint64_t r_sum = 0;
+		for (int i = 0; i < top_n; ++i)
+		{
+			for (int t = 0; t < threads; ++t)
+			{
+				p_sum += precision_step[t][i];
+				r_sum += recall_step[t][i];
+			}
+			p_ptr[i] = p_sum;
+			r_ptr[i] = r_sum;
+		}
+		return std::make_tuple(ap, max_rel, p, r);
+	}
+
+	// Returns mAP, precision and recall curves from sums returned by partial_sums
+	static std::tuple<double, ndarray_float, ndarray_float> reduce(ndarray_uint64 ap_sums, ndarray_int32 max_rel,
+		ndarray_uint64 precision_sum, ndarray_uint64 recall_sum)
+	{
+		ssize_t Q = max_rel.size();
+		int top_n = (int)precision_sum.size();
+		if (ap_sums.ndim() != 2 || ap_sums.shape(0) != Q || ap_sums.shape(1) != 2 || recall_sum.size() != top_n)
+			throw std::runtime_error("Shapes of partial sums do not match");
+
+		const uint64_t* ap_ptr = ap_sums.data();
+		const int32_t* max_rel_ptr = max_rel.data();
+		std::vector<double> ap(Q);
+		for (ssize_t q = 0; q < Q; ++q)
+		{
+			fixed_point_sum s;
+			s.hi = ap_ptr[2 * q];
+			s.lo = ap_ptr[2 * q + 1];
+			ap[q] = max_rel_ptr[q] != 0 ? s.value() / max_rel_ptr[q] : 0.0;
+		}
+
+		std::vector<APAccumulator> acc(1, APAccumulator(top_n));
+		std::copy(precision_sum.data(), precision_sum.data() + top_n, acc[0].precision_sum.begin());
+		std::copy(recall_sum.data(), recall_sum.data() + top_n, acc[0].recall_sum.begin());
+
+		Workspace ws;
+		return reduce_average_precision(ap, acc, top_n, ws);
+	}
+
+private:
+	void check_chunk(const hash_array& hashes_db, const label_array& labels_db) const
+	{
+		if (hashes_db.ndim != 2)
+			throw std::runtime_error("Number of dimensions for hashes must be two");
+
+		if (labels_db.ndim != labels_query.ndim || labels_db.words != labels_query.words)
+			throw std::runtime_error("Shape of labels_db must match labels_query");
+
+		check_hash_length(hashes_db, hashes_query);
+
+		if (hashes_db.size != labels_db.size)
+			throw std::runtime_error("Size of hashes_db and labels_db must match");
+	}
+
+	// Checks shape of histograms of a chunk and returns its size
+	ssize_t check_histograms(const ndarray_uint32& p, const ndarray_uint32& r) const
+	{
+		if (p.ndim() != 2 || p.shape(0) != Q || p.shape(1) != buckets || r.ndim() != 2 || r.shape(0) != Q || r.shape(1) != buckets)
+			throw std::runtime_error("Histograms must be of shape (len(hashes_query), " + std::to_string(buckets) + ")");
+
+		ssize_t n = 0;
+		for (int d = 0; d < buckets && Q > 0; ++d)
+		{
+			n += p.data()[d];
+		}
+		return n;
+	}
+
+	// Turns histograms into positions of the first item and number of relevant items before each distance
+	void start_second_pass()
+	{
+		if (top_n == 0)
+		{
+			top_n = (int)N;
+		}
+
+		if (top_n > N)
+			throw py::value_error("top_n must not be greater than size of labels_db");
+
+		max_relevant.assign(Q, 0);
+		ap_sum.assign(Q, fixed_point_sum());
+		precision_step.assign(threads, std::vector<uint64_t>(top_n, 0));
+		recall_step.assign(threads, std::vector<uint64_t>(top_n, 0));
+
+		for (ssize_t q = 0; q < Q; ++q)
+		{
+			uint32_t rel = histogram_to_positions(position.data() + q * buckets, relevant.data() + q * buckets, buckets);
+			max_relevant[q] = (int)std::min<uint32_t>(rel, top_n);
+		}
+
+		second_pass = true;
+	}
+
+	template<typename D, bool second>
+	void pass(const hash_array& hashes_db, const label_array& labels_db)
+	{
+		ssize_t n = hashes_db.size;
+		if (n == 0)
+			return;
+
+		py::gil_scoped_release release;
+
+		std::vector<uint64_t> hashes_db_storage;
+		const uint64_t* __restrict hashes_db_int = hashes_db.int_hashes<uint64_t>(hashes_db_storage, words, threads);
+
+		parallel_for(Q, threads, [&](ssize_t begin, ssize_t end, int thread_id)
+		{
+			std::vector<D> dist(n);
+			std::vector<uint8_t> similarity(n);
+
+			for (ssize_t q = begin; q < end; ++q)
+			{
+				if (second && max_relevant[q] == 0)
+					continue;
+
+				{
+					stage_timer timer(STAGE_DISTANCE, n * words * sizeof(uint64_t));
+					_hamming_distance<uint64_t, D>(hashes_db_int, n, words, query_storage.data() + q * words, dist.data());
+				}
+				{
+					stage_timer timer(STAGE_SIMILARITY, labels_db.bytes());
+					labels_db.similarity(labels_query, q, similarity.data());
+				}
+
+				uint32_t* pos = position.data() + q * buckets;
+				uint32_t* rel = relevant.data() + q * buckets;
+
+				stage_timer timer(second ? STAGE_RANK : STAGE_HISTOGRAM, n * (sizeof(D) + 1));
+				if (!second)
+				{
+					count_relevant<D>(dist.data(), similarity.data(), n, pos, rel);
+				}
+				else
+				{
+					rank_relevant<D>(dist.data(), similarity.data(), n, pos, rel, top_n, max_relevant[q], ap_sum[q],
+						precision_step[thread_id].data(), recall_step[thread_id].data());
+				}
+			}
+		});
+	}
+
+	hash_array hashes_query;
+	label_array labels_query;
+	int top_n;
+	bool and_mode;
+	ssize_t Q;
+	int words;
+	int buckets;
+	int threads;
+	ssize_t N;
+	ssize_t ranked;
+	bool second_pass;
+	bool skipped;
+
+	std::vector<uint64_t> query_storage;
+
+	// Per-query histograms of shape (Q, buckets), during the second pass they are positions of the next item
+	// and number of relevant items before it
+	std::vector<uint32_t> position;
+	std::vector<uint32_t> relevant;
+
+	std::vector<int> max_relevant;
+	std::vector<fixed_point_sum> ap_sum;
+	std::vector<std::vector<uint64_t> > precision_step;
+	std::vector<std::vector<uint64_t> > recall_step;
+};
+
+
+// Multi-index hashing (Norouzi et al., "Fast Exact Search in Hamming Space with Multi-Index Hashing").
+// Hashes are split into m substrings and each substring is kept in its own hash table. If two hashes are within distance r,
+// at least one of their substrings is within distance r / m, so only hashes that fall into table buckets near the query
+// need to be compared to it
+class MultiIndexHash
+{
+public:
+	MultiIndexHash(py::object hashes_obj, int substrings): N(0)
+	{
+		hash_array hashes(hashes_obj);
+		if (hashes.ndim != 2)
+			throw std::runtime_error("Number of dimensions must be two");
+		if (hashes.bits == 0)
+			throw std::runtime_error("Hashes must not be empty");
+
+		bits = (int)hashes.bits;
+		words = words_per_hash<uint64_t>(bits);
+		packed = hashes.packed;
+
+		// Substrings of about log2(N) bits are recommended, but tables keyed by more than 32 bits are never useful
+		if (substrings <= 0)
+		{
+			double log_n = std::log2((double)std::max<ssize_t>(hashes.size, 1));
+			substrings = (int)std::ceil(bits / std::max(log_n, 16.0));
+		}
+		substrings = std::max(substrings, (bits + 31) / 32);
+		substrings = std::min(substrings, bits);
+
+		int offset = 0;
+		for (int i = 0; i < substrings; ++i)
+		{
+			int length = bits / substrings + (i < bits % substrings ? 1 : 0);
+			substring_offset.push_back(offset);
+			substring_length.push_back(length);
+			offset += length;
+		}
+		tables.resize(substrings);
+
+		add(hashes_obj);
+	}
+
+	// Appends hashes to the index, their indices continue from the current size
+	void add(py::object hashes_obj)
+	{
+		hash_array hashes(hashes_obj);
+		check(hashes);
+		if ((ssize_t)N + hashes.size > (ssize_t)std::numeric_limits<uint32_t>::max())
+			throw std::runtime_error("Index can not hold more than 2^32 - 1 hashes");
+
+		py::gil_scoped_release release;
+		std::lock_guard<std::mutex> lock(mutex);
+
+		std::vector<uint64_t> storage;
+		const uint64_t* h = hashes.int_hashes<uint64_t>(storage, words, get_num_threads(0));
+		codes.insert(codes.end(), h, h + hashes.size * words);
+
+		for (ssize_t i = 0; i < hashes.size; ++i)
+		{
+			for (size_t s = 0; s < tables.size(); ++s)
+			{
+				tables[s][substring(h + i * words, (int)s)].push_back(N + (uint32_t)i);
+			}
+		}
+		N += (uint32_t)hashes.size;
+	}
+
+	// Returns list of (indices, distances) of all hashes within distance r of each query, ordered by distance and then by index
+	std::vector<std::tuple<ndarray_uint32, py::array> > radius_search(py::object queries_obj, int r, int num_threads)
+	{
+		if (r < 0)
+			throw py::value_error("Radius must not be negative");
+
+		std::vector<std::vector<std::pair<int, uint32_t> > > results = search(queries_obj, num_threads,
+			[&](const uint64_t* query, std::vector<std::pair<int, uint32_t> >& result)
+		{
+			std::vector<uint32_t> candidates;
+			int radius = r / (int)tables.size();
+			for (size_t s = 0; s < tables.size(); ++s)
+			{
+				for (int e = 0; e <= std::min(radius, substring_length[s]); ++e)
+				{
+					for_each_bucket((int)s, substring(query, (int)s), e, [&](const std::vector<uint32_t>& bucket)
+					{
+						candidates.insert(candidates.end(), bucket.begin(), bucket.end());
+					});
+				}
+			}
+			std::sort(candidates.begin(), candidates.end());
+			candidates.erase(std::unique(candidates.begin(), candidates.end()), candidates.end());
+
+			for (uint32_t i: candidates)
+			{
+				int d = hamming_distance<uint64_t>(query, codes.data() + (size_t)i * words, words);
+				if (d <= r)
+					result.emplace_back(d, i);
+			}
+			std::sort(result.begin(), result.end());
+		});
+
+		std::vector<std::tuple<ndarray_uint32, py::array> > out;
+		for (const auto& result: results)
+		{
+			std::vector<std::vector<std::pair<int, uint32_t> > > one(1, result);
+			ssize_t n = result.size();
+			ndarray_uint32 indices(n);
+			if (wide())
+			{
+				ndarray_uint16 distances(n);
+				copy_results(one, indices.mutable_data(), distances.mutable_data());
+				out.emplace_back(indices, distances);
+			}
+			else
+			{
+				ndarray_uint8 distances(n);
+				copy_results(one, indices.mutable_data(), distances.mutable_data());
+				out.emplace_back(indices, distances);
+			}
+		}
+		return out;
+	}
+
+	// Returns indices and distances of k nearest hashes of shape (len(queries), k), same as hamming_topk does
+	std::tuple<ndarray_uint32, py::array> knn(py::object queries_obj, int k, int num_threads)
+	{
+		if (k < 0 || k > (int)N)
+			throw py::value_error("k must be in [0, size of the index]");
+
+		std::vector<std::vector<std::pair<int, uint32_t> > > results = search(queries_obj, num_threads,
+			[&](const uint64_t* query, std::vector<std::pair<int, uint32_t> >& result)
+		{
+			// Buckets at distance e from the query substrings are visited in rounds of increasing e. Hashes that were
+			// not found after round e differ in every substring by at least e + 1 bits, so all hashes closer than
+			// m * (e + 1) are already found
+			int shortest = *std::min_element(substring_length.begin(), substring_length.end());
+			std::vector<uint64_t> query_substrings(tables.size());
+			for (size_t s = 0; s < tables.size(); ++s)
+			{
+				query_substrings[s] = substring(query, (int)s);
+			}
+
+			for (int e = 0; ; ++e)
+			{
+				for (size_t s = 0; s < tables.size(); ++s)
+				{
+					for_each_bucket((int)s, query_substrings[s], e, [&](const std::vector<uint32_t>& bucket)
+					{
+						for (uint32_t i: bucket)
+						{
+							const uint64_t* code = codes.data() + (size_t)i * words;
+							if (found_first_in(code, query_substrings.data(), (int)s, e))
+								result.emplace_back(hamming_distance<uint64_t>(query, code, words), i);
+						}
+					});
+				}
+
+				int bound = (int)tables.size() * (e + 1);
+				ssize_t found = std::count_if(result.begin(), result.end(), [&](const std::pair<int, uint32_t>& x) { return x.first < bound; });
+				if (found >= k || e >= shortest || result.size() == N)
+					break;
+			}
+			std::partial_sort(result.begin(), result.begin() + k, result.end());
+			result.resize(k);
+		});
+
+		ssize_t Q = results.size();
+		ndarray_uint32 indices(std::vector<ssize_t>{Q, k});
+		if (wide())
+		{
+			ndarray_uint16 distances(std::vector<ssize_t>{Q, k});
+			copy_results(results, indices.mutable_data(), distances.mutable_data());
+			return std::make_tuple(indices, (py::array)distances);
+		}
+		ndarray_uint8 distances(std::vector<ssize_t>{Q, k});
+		copy_results(results, indices.mutable_data(), distances.mutable_data());
+		return std::make_tuple(indices, (py::array)distances);
+	}
+
+	ssize_t size() const
+	{
+		return N;
+	}
+
+	int num_substrings() const
+	{
+		return (int)tables.size();
+	}
+
+private:
+	typedef std::unordered_map<uint64_t, std::vector<uint32_t> > table_t;
+
+	void check(const hash_array& hashes) const
+	{
+		if (hashes.ndim != 2)
+			throw std::runtime_error("Number of dimensions must be two");
+		if (words_per_hash<uint64_t>(hashes.bits) != words || (!packed && !hashes.packed && hashes.bits != bits))
+			throw std::runtime_error("Length of hashes must match the index");
+	}
+
+	bool wide() const
+	{
+		return is_wide_distance<uint64_t>(words);
+	}
+
+	uint64_t substring(const uint64_t* code, int s) const
+	{
+		int offset = substring_offset[s];
+		int length = substring_length[s];
+		int word = offset / 64;
+		int shift = offset % 64;
+		uint64_t v = code[word] >> shift;
+		if (shift + length > 64)
+			v |= code[word + 1] << (64 - shift);
+		return v & ((uint64_t(1) << length) - 1);
+	}
+
+	// Returns true if a hash found in table s in round e was not found before, that is if all its substrings in previous
+	// tables are farther than e from the query and all substrings in next tables are not closer than e
+	bool found_first_in(const uint64_t* code, const uint64_t* query_substrings, int s, int e) const
+	{
+		for (int t = 0; t < (int)tables.size(); ++t)
+		{
+			if (t == s)
+				continue;
+			int d = popcount64(substring(code, t) ^ query_substrings[t]);
+			if (d < e || (d == e && t < s))
+				return false;
+		}
+		return true;
+	}
+
+	// Calls f for every non-empty bucket of table s whose key is at distance e from key
+	template<typename F>
+	void for_each_bucket(int s, uint64_t key, int e, F f) const
+	{
+		const table_t& table = tables[s];
+		int length = substring_length[s];
+		if (e > length)
+			return;
+
+		double combinations = 1.0;
+		for (int i = 0; i < e; ++i)
+		{
+			combinations = combinations * (length - i) / (i + 1);
+		}
+
+		if (combinations > (double)table.size())
+		{
+			// Fewer buckets than keys at distance e, check all of them
+			for (const auto& bucket: table)
+			{
+				if (popcount64(bucket.first ^ key) == e)
+					f(bucket.second);
+			}
+			return;
+		}
+
+		// Enumerates masks of `length` bits with `e` bits set in increasing order (Gosper's hack)
+		uint64_t mask = (uint64_t(1) << e) - 1;
+		uint64_t end = uint64_t(1) << length;
+		while (mask < end)
+		{
+			auto it = table.find(key ^ mask);
+			if (it != table.end())
+				f(it->second);
+			if (mask == 0)
+				break;
+			uint64_t c = mask & (~mask + 1);
+			uint64_t r = mask + c;
+			mask = (((r ^ mask) >> 2) / c) | r;
+		}
+	}
+
+	template<typename F>
+	std::vector<std::vector<std::pair<int, uint32_t> > > search(py::object queries_obj, int num_threads, F f)
+	{
+		hash_array queries(queries_obj);
+		check(queries);
+		ssize_t Q = queries.size;
+		num_threads = get_num_threads(num_threads);
+
+		std::vector<std::vector<std::pair<int, uint32_t> > > results(Q);
+
+		py::gil_scoped_release release;
+		std::lock_guard<std::mutex> lock(mutex);
+
+		std::vector<uint64_t> storage;
+		const uint64_t* q = queries.int_hashes<uint64_t>(storage, words, num_threads);
+
+		parallel_for(Q, num_threads, [&](ssize_t begin, ssize_t end, int)
+		{
+			for (ssize_t i = begin; i < end; ++i)
+			{
+				f(q + i * words, results[i]);
+			}
+		});
+		return results;
+	}
+
+	// Writes results one after another
+	template<typename D>
+	static void copy_results(const std::vector<std::vector<std::pair<int, uint32_t> > >& results, uint32_t* indices, D* distances)
+	{
+		for (const auto& result: results)
+		{
+			for (const auto& x: result)
+			{
+				*indices++ = x.second;
+				*distances++ = (D)x.first;
+			}
+		}
+	}
+
+	int bits;
+	int words;
+	bool packed;
+	uint32_t N;
+	std::vector<int> substring_offset;
+	std::vector<int> substring_length;
+	std::vector<table_t> tables;
+	std::vector<uint64_t> codes;
+
+	// Held while hashes are added or searched, as both release GIL
+	std::mutex mutex;
+};
+
 
 PYBIND11_MODULE(hashranking_cpp, m) {
 	m.doc() = "C++ Python extension that implements fast procedures for working with hashes";
-	m.def("hamming_distance", static_cast<ndarray_uint8(*)(ndarray_float, ndarray_float)>(&hamming_distance), R"(
-		Long doc string goes here
+	select_best_simd_kernel();
+	m.def("simd_kernel", &simd_kernel, "Returns name of the popcount kernel in use: scalar, popcnt, avx2 or avx512_vpopcntdq");
+	m.def("supported_simd_kernels", &supported_simd_kernels, "Returns names of popcount kernels supported by this CPU");
+	m.def("set_simd_kernel", &set_simd_kernel, "Switches to the given popcount kernel. The fastest supported one is selected on import",
+		py::arg("name"));
+	m.def("enable_stats", &enable_stats, R"(
+		Enables or disables profiling counters. While enabled, time in nanoseconds, bytes processed and number of calls of
+		each stage of the computation are added up, see stats. When disabled, the overhead is one check of a flag per stage
+	)", py::arg("enabled") = true);
+	m.def("is_stats_enabled", &is_stats_enabled, "Returns True if profiling counters are enabled");
+	m.def("stats", &stats, R"(
+		Returns dict of profiling counters of each stage: pack, distance, sort, similarity, histogram, rank,
+		average_precision, asymmetric and rerank. Counters of a stage are dict of calls, nanoseconds and bytes.
+		Stages running in several threads add up time of all threads, calls are counted per query or per block of queries
 	)");
-	m.def("argsort", &argsort, "Argsort of distance matrix along second dimention");
-	m.def("compute_map_from_rank", &compute_map_from_rank, "Compute mAP given rank and labels");
-	m.def("compute_map_from_hashes", &compute_map_from_hashes, "Compute mAP given float hashes and labels");
+	m.def("reset_stats", &reset_stats, "Sets all profiling counters to zero");
+	m.def("set_strict", &set_strict, R"(
+		Enables or disables strict mode. By default, inputs of other dtypes or with a layout the kernels can not read
+		are converted silently. In strict mode such inputs raise TypeError, so that no hidden copy is ever made
+	)", py::arg("strict"));
+	m.def("is_strict", &is_strict, "Returns True if strict mode is enabled");
+	py::class_<Workspace>(m, "Workspace", R"(
+		Reusable buffers, which can be passed as workspace to all functions, so that repeated calls do not allocate.
+		Holds scratch buffers of each thread, packed float hashes and output arrays. Arrays returned by a call with
+		a workspace are overwritten by the next call of the same function with the same workspace and output shapes,
+		copy them to keep. A workspace must not be shared between threads: output arrays are handed to a call before
+		calls are serialized, so concurrent calls would write into the same arrays. Use a workspace per thread
+	)")
+		.def(py::init<>())
+		.def_property_readonly("nbytes", &Workspace::nbytes, "Number of bytes held by the workspace")
+		.def("clear", &Workspace::clear, "Frees all buffers, arrays returned earlier stay valid");
+	m.def("pack_hashes", &pack_hashes, R"(
+		Packs float hashes into uint64 words, bit i of a hash is set if its i-th element is positive.
+		Returns uint64 array of shape (N, ceil(bits / 64)), which can be passed instead of float hashes to all functions.
+		float32, float16 and bfloat16 hashes are read without conversion, dtype set to 'float16' or 'bfloat16' makes
+		16-bit integer arrays, such as views of framework tensors, to be read as that format
+	)", py::arg("hashes"), py::arg("num_threads") = 0, py::arg("dtype") = "", py::arg("workspace") = py::none());
+	m.def("hamming_distance", static_cast<py::array(*)(py::object, py::object, int, py::object, Workspace*)>(&hamming_distance), R"(
+		Computes hamming distance between every pair of hashes in b1 and b2. Hashes can be of arbitrary length,
+		given either as float arrays or as packed arrays returned by pack_hashes.
+		Returns matrix of uint8 distances, or uint16 if hashes are longer than 192 bits (four or more uint64 words).
+		If out is given, distances are written into it and it is returned, it must be a C-contiguous array of that dtype.
+		Queries are split between num_threads threads, zero means use all cores
+	)", py::arg("b1"), py::arg("b2"), py::arg("num_threads") = 0, py::arg("out") = py::none(), py::arg("workspace") = py::none());
+	m.def("argsort", &argsort, "Argsort of uint8 or uint16 distance matrix along second dimention", py::arg("distance"), py::arg("num_threads") = 0,
+		py::arg("workspace") = py::none());
+	m.def("hamming_topk", &hamming_topk, R"(
+		Finds k nearest hashes in b2 for each hash in b1. Returns indices and hamming distances of shape (len(b1), k),
+		ordered by distance and then by index, which is the same as first k columns of hamming_rank.
+		Full distance or rank matrices are never created
+	)", py::arg("b1"), py::arg("b2"), py::arg("k"), py::arg("num_threads") = 0, py::arg("workspace") = py::none());
+	m.def("asymmetric_score", &asymmetric_score, R"(
+		Computes inner product of each real-valued query with each hash in hashes, taken as a vector of +1 and -1.
+		Hashes are float or packed, queries are float arrays of shape (Q, bits). Larger score means closer.
+		Returns float32 matrix of shape (len(queries), len(hashes))
+	)", py::arg("queries"), py::arg("hashes"), py::arg("num_threads") = 0, py::arg("workspace") = py::none());
+	m.def("asymmetric_topk", &asymmetric_topk, R"(
+		Finds k hashes with the largest asymmetric_score for each query. Returns indices and scores of shape (len(queries), k),
+		ordered by score and then by index. Full score matrix is never created
+	)", py::arg("queries"), py::arg("hashes"), py::arg("k"), py::arg("num_threads") = 0, py::arg("workspace") = py::none());
+	m.def("hamming_rerank", &hamming_rerank, R"(
+		Two-stage search. For each query, selects `candidates` nearest hashes in hashes_db by hamming distance, same as
+		hamming_topk, then reranks them by similarity of float vectors_query and vectors_db and returns k best ones.
+		vectors_db can be a memory mapped array, only rows of candidates are read. Metric is 'dot', 'cosine' or 'l2',
+		which is squared euclidean distance. Returns indices and scores of shape (len(hashes_query), k), ordered from
+		the closest and then by index. Zero candidates means the whole database
+	)", py::arg("hashes_query"), py::arg("hashes_db"), py::arg("vectors_query"), py::arg("vectors_db"), py::arg("k"),
+		py::arg("candidates"), py::arg("metric") = "dot", py::arg("num_threads") = 0, py::arg("workspace") = py::none());
+	m.def("compute_map_from_rank", &compute_map_from_rank, "Compute mAP given rank and labels. Rank can be uint32 or int64, similarity uint8 or bool",
+		py::arg("rank"), py::arg("similarity"), py::arg("top_n"), py::arg("num_threads") = 0, py::arg("workspace") = py::none());
+	m.def("compute_map_from_hashes", &compute_map_from_hashes, R"(
+		Compute mAP given float or packed hashes and labels.
+		If and_mode is set, labels are multi-label bitmasks, either a vector of integers or a uint64 array of shape (N, words),
+		and two items are relevant when their bitmasks share at least one bit
+	)", py::arg("hashes_db"), py::arg("hashes_query"), py::arg("labels_db"), py::arg("labels_query"), py::arg("top_n") = 0,
+		py::arg("and_mode") = false, py::arg("num_threads") = 0, py::arg("workspace") = py::none());
+	m.def("compute_metrics", &compute_metrics, R"(
+		Computes several retrieval metrics in one pass over distances of each query, without creating the rank.
+		Returns dict with mean over queries of each requested metric:
+		'map@k' for k in map_at, the same as mAP returned by compute_map_from_hashes with top_n=k;
+		'precision@k' for k in precision_at; 'ndcg@k' for k in ndcg_at, with binary relevance;
+		'precision_radius@r' and 'recall_radius@r' for r in radius, of all items within hamming distance r,
+		precision is zero when there are no such items. Cutoff k=0 means the whole database, and the key has no suffix.
+		If per_query is set, per-query average precisions are added as float64 arrays under 'ap@k'.
+		Ties are ordered by index, same as in hamming_rank
+	)", py::arg("hashes_db"), py::arg("hashes_query"), py::arg("labels_db"), py::arg("labels_query"),
+		py::arg("map_at") = std::vector<int>(), py::arg("precision_at") = std::vector<int>(), py::arg("ndcg_at") = std::vector<int>(),
+		py::arg("radius") = std::vector<int>(), py::arg("per_query") = false, py::arg("and_mode") = false, py::arg("num_threads") = 0,
+		py::arg("workspace") = py::none());
+	py::class_<StreamingMap>(m, "StreamingMap", R"(
+		Computes the same mAP, precision and recall as compute_map_from_hashes for a database given in chunks.
+		Every chunk is first passed to count, then all of them in the same order to rank, then result returns mAP
+	)")
+		.def(py::init<py::object, py::object, int, bool, int>(), py::arg("hashes_query"), py::arg("labels_query"),
+			py::arg("top_n") = 0, py::arg("and_mode") = false, py::arg("num_threads") = 0)
+		.def("count", &StreamingMap::count, "First pass, adds chunk of the database to distance histograms",
+			py::arg("hashes_db"), py::arg("labels_db"))
+		.def("rank", &StreamingMap::rank, "Second pass, chunks must be given in the same order as to count",
+			py::arg("hashes_db"), py::arg("labels_db"))
+		.def("result", &StreamingMap::result, "Returns mAP, precision and recall curves")
+		.def("histograms", &StreamingMap::histograms,
+			"Returns histograms of distances and of relevant items of the counted chunks, of shape (len(hashes_query), bits + 1)")
+		.def("add_histograms", &StreamingMap::add_histograms,
+			"First pass, adds histograms of chunks counted elsewhere, for example in another process, instead of the chunks",
+			py::arg("position"), py::arg("relevant"))
+		.def("skip", &StreamingMap::skip,
+			"Second pass, skips chunks ranked elsewhere, given their histograms. Order of chunks is the same as in count",
+			py::arg("position"), py::arg("relevant"))
+		.def("partial_sums", &StreamingMap::partial_sums, R"(
+			Returns exact sums of the chunks ranked so far: (ap_sums, max_relevant, precision_sum, recall_sum).
+			ap_sums of different chunks and precision_sum and recall_sum of different chunks or queries can be added up
+			as integers and passed to reduce, which gives the same result as if they were ranked by one StreamingMap
+		)")
+		.def_static("reduce", &StreamingMap::reduce, "Returns mAP, precision and recall curves from partial sums",
+			py::arg("ap_sums"), py::arg("max_relevant"), py::arg("precision_sum"), py::arg("recall_sum"));
+	py::class_<MultiIndexHash>(m, "MultiIndexHash", R"(
+		Multi-index hashing for exact sub-linear radius and k nearest neighbour search. Hashes are split into substrings,
+		each kept in a hash table. By default substrings are about log2(N) bits long, but not longer than 32 bits.
+		Results are ordered by distance and then by index, the same as hamming_rank gives
+	)")
+		.def(py::init<py::object, int>(), py::arg("hashes"), py::arg("substrings") = 0)
+		.def("add", &MultiIndexHash::add, "Appends float or packed hashes, their indices continue from the current size",
+			py::arg("hashes"))
+		.def("radius_search", &MultiIndexHash::radius_search,
+			"Returns list of (indices, distances) of all hashes within distance r, one for each query",
+			py::arg("queries"), py::arg("r"), py::arg("num_threads") = 0)
+		.def("knn", &MultiIndexHash::knn, "Returns indices and distances of k nearest hashes of shape (len(queries), k)",
+			py::arg("queries"), py::arg("k"), py::arg("num_threads") = 0)
+		.def_property_readonly("substrings", &MultiIndexHash::num_substrings)
+		.def("__len__", &MultiIndexHash::size);
 }
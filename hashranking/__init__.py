@@ -1,3 +1,171 @@
-from hashranking.hashranking_cpp import *
-from .cpp_extension_wrapper import *
-from . import numpy_implementation
+# Copyright 2017-2019 Stanislav Pidhorskyi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Fast procedures for working with hashes.
+
+Nothing is imported until it is used. Functions that both backends implement are taken from the C++ extension, if it
+can be imported, otherwise from numpy_implementation, see backend and set_backend. The backend can also be chosen with
+HASHRANKING_BACKEND environment variable before the first call.
+"""
+
+import functools
+import importlib
+import os
+
+# Functions implemented by both backends
+_DISPATCHED = ['pack_hashes', 'hamming_distance', 'hamming_rank', 'hamming_topk', 'hamming_rerank', 'asymmetric_score',
+               'asymmetric_topk', 'compute_map_from_rank', 'compute_map_from_hashes', 'compute_metrics']
+
+# Names that only the C++ extension has
+_CPP_ONLY = ['argsort', 'Workspace', 'StreamingMap', 'MultiIndexHash', 'set_strict', 'is_strict', 'simd_kernel',
+             'supported_simd_kernels', 'set_simd_kernel', 'enable_stats', 'is_stats_enabled', 'stats', 'reset_stats']
+
+# Names defined in Python modules of the package, all of them use the C++ extension
+_MODULE_OF = {
+    'HashIndex': 'index',
+    'compute_map_streaming': 'streaming',
+    'ShardedEvaluator': 'sharded',
+    'compute_map_sharded': 'sharded',
+    'profile': 'profiling',
+}
+
+_SUBMODULES = ['hashranking_cpp', 'numpy_implementation', 'cpp_extension_wrapper', 'index', 'streaming', 'sharded',
+               'profiling', 'benchmarks']
+
+# Arguments of the C++ functions that do not change the result, numpy_implementation does not take them
+_EXECUTION_ARGUMENTS = ('num_threads', 'workspace')
+
+# Parameters of the C++ functions in their order. Calls of numpy_implementation are bound to them, so that arguments
+# are passed by position and by name in the same way to both backends
+_PARAMETERS = {
+    'pack_hashes': ('hashes', 'num_threads', 'dtype', 'workspace'),
+    'hamming_distance': ('b1', 'b2', 'num_threads', 'out', 'workspace'),
+    'hamming_rank': ('b1', 'b2', 'num_threads', 'workspace'),
+    'hamming_topk': ('b1', 'b2', 'k', 'num_threads', 'workspace'),
+    'hamming_rerank': ('hashes_query', 'hashes_db', 'vectors_query', 'vectors_db', 'k', 'candidates', 'metric',
+                       'num_threads', 'workspace'),
+    'asymmetric_score': ('queries', 'hashes', 'num_threads', 'workspace'),
+    'asymmetric_topk': ('queries', 'hashes', 'k', 'num_threads', 'workspace'),
+    'compute_map_from_rank': ('rank', 'similarity', 'top_n', 'num_threads', 'workspace'),
+    'compute_map_from_hashes': ('hashes_db', 'hashes_query', 'labels_db', 'labels_query', 'top_n', 'and_mode',
+                                'num_threads', 'workspace'),
+    'compute_metrics': ('hashes_db', 'hashes_query', 'labels_db', 'labels_query', 'map_at', 'precision_at', 'ndcg_at',
+                        'radius', 'per_query', 'and_mode', 'num_threads', 'workspace'),
+}
+
+_backend = None
+_cpp_error = None
+
+
+def backend():
+    """Returns the backend that functions are taken from: 'numpy', or 'cpp:' followed by the SIMD kernel in use,
+    for example 'cpp:avx2'. The backend is selected on the first call if it was not yet
+    """
+    if _select_backend() == 'numpy':
+        return 'numpy'
+    return 'cpp:' + _cpp().simd_kernel()
+
+
+def set_backend(name):
+    """Selects the backend: 'cpp', 'numpy', or a SIMD kernel of the C++ extension, one of supported_simd_kernels,
+    which selects C++ with that kernel. 'auto' selects C++, if the extension can be imported, otherwise NumPy.
+    The C++ extension uses the fastest kernel unless set_simd_kernel was called.
+    Functions imported with `from hashranking import ...` before the switch are not affected
+    """
+    global _backend
+    if name == 'auto':
+        name = 'cpp' if _cpp_available() else 'numpy'
+
+    if name == 'numpy':
+        _backend = 'numpy'
+    else:
+        cpp = _cpp()
+        if name != 'cpp':
+            cpp.set_simd_kernel(name)
+        _backend = 'cpp'
+
+    for function in _DISPATCHED:
+        globals().pop(function, None)
+
+
+def _select_backend():
+    if _backend is None:
+        set_backend(os.environ.get('HASHRANKING_BACKEND') or 'auto')
+    return _backend
+
+
+def _cpp_available():
+    try:
+        _cpp()
+        return True
+    except ImportError:
+        return False
+
+
+def _cpp():
+    global _cpp_error
+    if _cpp_error is not None:
+        raise ImportError("C++ extension of hashranking can not be imported: %s" % _cpp_error)
+    try:
+        return importlib.import_module('.hashranking_cpp', __name__)
+    except ImportError as e:
+        _cpp_error = e
+        raise ImportError("C++ extension of hashranking can not be imported: %s" % e)
+
+
+def _numpy_function(name):
+    f = getattr(importlib.import_module('.numpy_implementation', __name__), name)
+    parameters = _PARAMETERS[name]
+
+    @functools.wraps(f)
+    def call(*args, **kwargs):
+        if len(args) > len(parameters):
+            raise TypeError("%s() takes at most %d positional arguments, %d given" % (name, len(parameters), len(args)))
+        for parameter, value in zip(parameters, args):
+            if parameter in kwargs:
+                raise TypeError("%s() got multiple values for argument '%s'" % (name, parameter))
+            kwargs[parameter] = value
+        for argument in _EXECUTION_ARGUMENTS:
+            kwargs.pop(argument, None)
+        return f(**kwargs)
+    return call
+
+
+def __getattr__(name):
+    if name == '__all__':
+        return _DISPATCHED + ['backend', 'set_backend'] + (_CPP_ONLY + sorted(_MODULE_OF) if _cpp_available() else [])
+
+    if name in _SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+
+    if name in _DISPATCHED:
+        if _select_backend() == 'numpy':
+            value = _numpy_function(name)
+        elif name == 'hamming_rank':
+            value = importlib.import_module('.cpp_extension_wrapper', __name__).hamming_rank
+        else:
+            value = getattr(_cpp(), name)
+    elif name in _MODULE_OF:
+        value = getattr(importlib.import_module('.' + _MODULE_OF[name], __name__), name)
+    elif name in _CPP_ONLY:
+        value = getattr(_cpp(), name)
+    else:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_DISPATCHED + _CPP_ONLY + _SUBMODULES) | set(_MODULE_OF))
@@ -0,0 +1,271 @@
+# Copyright 2017-2019 Stanislav Pidhorskyi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Benchmarks of both backends with regression tracking.
+
+Run as ``python -m hashranking.benchmarks``, for example::
+
+    python -m hashranking.benchmarks --output baseline.json
+    python -m hashranking.benchmarks --baseline baseline.json --threshold 0.1
+
+Each case runs in a separate process, so that its peak RSS can be measured. Where the system allows, peak RSS covers
+only the timed calls and not generation of the inputs. With --baseline, exit code is 1 if any case got slower than in
+the baseline by more than the threshold.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+FUNCTIONS = ['hamming_distance', 'argsort', 'hamming_rank', 'compute_map_from_rank', 'compute_map_from_hashes']
+BACKENDS = ['cpp', 'numpy']
+
+# Case is identified by these fields when results are compared
+_KEY = ('function', 'backend', 'db_size', 'queries', 'bits', 'top_n')
+
+
+def make_cases(functions=FUNCTIONS, backends=BACKENDS, db_sizes=(10000, 50000), queries=(100, 1000),
+               bits=(32, 64, 256), top_n=(100, 0)):
+    """Returns list of cases for the grid of parameters. top_n is only varied for mAP functions"""
+    cases = []
+    for function, backend, n, q, b in itertools.product(functions, backends, db_sizes, queries, bits):
+        for t in (top_n if function.startswith('compute_map') else [0]):
+            cases.append(dict(function=function, backend=backend, db_size=n, queries=q, bits=b, top_n=t))
+    return cases
+
+
+def _make_data(db_size, queries, bits, class_count=10, seed=0):
+    rng = np.random.RandomState(seed)
+    labels_db = rng.randint(class_count, size=db_size).astype(np.uint32)
+    labels_query = rng.randint(class_count, size=queries).astype(np.uint32)
+
+    hashes_class = rng.rand(class_count, bits).astype(np.float32) - 0.5
+    hashes_db = hashes_class[labels_db] + 0.3 * rng.randn(db_size, bits).astype(np.float32)
+    hashes_query = hashes_class[labels_query] + 0.3 * rng.randn(queries, bits).astype(np.float32)
+    return hashes_db, hashes_query, labels_db, labels_query
+
+
+def _prepare(case):
+    """Returns function of the case with all its inputs bound"""
+    import hashranking
+    from hashranking import numpy_implementation
+
+    hashes_db, hashes_query, labels_db, labels_query = _make_data(case['db_size'], case['queries'], case['bits'])
+    top_n = case['top_n']
+    function = case['function']
+
+    if case['backend'] == 'cpp':
+        hashranking.set_backend('cpp')
+        if function == 'argsort':
+            distance = hashranking.hamming_distance(hashes_query, hashes_db)
+            return lambda: hashranking.argsort(distance)
+        if function == 'compute_map_from_rank':
+            rank = hashranking.hamming_rank(hashes_query, hashes_db)
+            s = numpy_implementation._compute_similarity(labels_db, labels_query).astype(np.uint8)
+            return lambda: hashranking.compute_map_from_rank(rank, s, top_n)
+        backend = hashranking
+    elif case['backend'] == 'numpy':
+        if function == 'argsort':
+            distance = numpy_implementation.hamming_distance(hashes_query, hashes_db)
+            return lambda: np.argsort(distance, 1, kind='mergesort')
+        if function == 'compute_map_from_rank':
+            rank = numpy_implementation.hamming_rank(hashes_query, hashes_db)
+            s = numpy_implementation._compute_similarity(labels_db, labels_query)
+            return lambda: numpy_implementation.compute_map_from_rank(rank, s, top_n)
+        backend = numpy_implementation
+    else:
+        raise ValueError("Unknown backend: %s" % case['backend'])
+
+    if function in ('hamming_distance', 'hamming_rank'):
+        f = getattr(backend, function)
+        return lambda: f(hashes_query, hashes_db)
+    if function == 'compute_map_from_hashes':
+        return lambda: backend.compute_map_from_hashes(hashes_db, hashes_query, labels_db, labels_query, top_n)
+    raise ValueError("Unknown function: %s" % function)
+
+
+def _reset_peak_rss():
+    """Resets peak RSS of the process, which Linux allows. Returns False if it can not be reset"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+
+def run_case(case, repeat=3):
+    """Runs one case in this process and returns it with measurements added. Best time of `repeat` runs is reported.
+    Peak RSS is measured over the timed runs, so it includes the inputs but not the memory used to generate them.
+    Where peak RSS can not be reset, it is of the whole process, which peak_rss_scope tells
+    """
+    f = _prepare(case)
+    scope = 'timed' if _reset_peak_rss() else 'process'
+    seconds = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        seconds = min(seconds, time.perf_counter() - start)
+
+    result = dict(case)
+    result['seconds'] = seconds
+    result['pairs_per_second'] = case['queries'] * case['db_size'] / seconds
+    result['queries_per_second'] = case['queries'] / seconds
+    result['peak_rss_mb'] = _peak_rss_mb()
+    result['peak_rss_scope'] = scope
+    return result
+
+
+def _run_isolated(case, repeat):
+    command = [sys.executable, '-m', 'hashranking.benchmarks', '--run-case', json.dumps(case), '--repeat', str(repeat)]
+    # Child process must import the same package, even if it is not installed
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([root] + [p for p in [os.environ.get('PYTHONPATH')] if p]))
+    output = subprocess.check_output(command, env=env)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def run(cases, repeat=3, isolate=True, log=None):
+    """Runs cases and returns list of results. If isolate is set, each case runs in a new process, otherwise peak RSS
+    is of the current process and, where it can not be reset, includes all previous cases. Speedup is relative to the numpy backend, when it is
+    among the cases
+    """
+    results = []
+    for case in cases:
+        result = _run_isolated(case, repeat) if isolate else run_case(case, repeat)
+        results.append(result)
+        if log is not None:
+            log(_format(result))
+
+    numpy_seconds = {_key(r, backend='numpy'): r['seconds'] for r in results if r['backend'] == 'numpy'}
+    for r in results:
+        reference = numpy_seconds.get(_key(r, backend='numpy'))
+        r['speedup'] = reference / r['seconds'] if reference is not None else None
+    return results
+
+
+def _key(result, **override):
+    result = dict(result, **override)
+    return tuple(result[k] for k in _KEY)
+
+
+def _format(result):
+    rss = '%.1f' % result['peak_rss_mb'] if result['peak_rss_mb'] is not None else '-'
+    return ('%-24s %-6s db=%-8d q=%-6d bits=%-5d top_n=%-6d %9.4f s %12.4g pairs/s %10.4g queries/s  rss %s MB' %
+            (tuple(result[k] for k in _KEY + ('seconds', 'pairs_per_second', 'queries_per_second')) + (rss,)))
+
+
+def environment():
+    """Information about the machine and build the results were obtained on"""
+    import hashranking
+    try:
+        simd_kernel = hashranking.simd_kernel()
+    except ImportError:
+        simd_kernel = None
+    return dict(
+        python=platform.python_version(),
+        numpy=np.__version__,
+        platform=platform.platform(),
+        processor=platform.processor(),
+        cpu_count=os.cpu_count(),
+        simd_kernel=simd_kernel,
+    )
+
+
+def compare(results, baseline, threshold=0.1):
+    """Compares results against baseline results. Returns list of (result, baseline_seconds) for cases that are slower
+    than in the baseline by more than `threshold`, which is a fraction of the baseline time
+    """
+    baseline_seconds = {_key(r): r['seconds'] for r in baseline}
+    regressions = []
+    for r in results:
+        reference = baseline_seconds.get(_key(r))
+        if reference is not None and r['seconds'] > reference * (1.0 + threshold):
+            regressions.append((r, reference))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m hashranking.benchmarks', description="Benchmarks of hashranking")
+    parser.add_argument('--functions', nargs='+', default=FUNCTIONS, choices=FUNCTIONS)
+    parser.add_argument('--backends', nargs='+', default=BACKENDS, choices=BACKENDS)
+    parser.add_argument('--db-sizes', nargs='+', type=int, default=[10000, 50000])
+    parser.add_argument('--queries', nargs='+', type=int, default=[100, 1000])
+    parser.add_argument('--bits', nargs='+', type=int, default=[32, 64, 256])
+    parser.add_argument('--top-n', nargs='+', type=int, default=[100, 0])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-isolate', action='store_true', help="Run all cases in this process")
+    parser.add_argument('--output', help="Write results to this JSON file")
+    parser.add_argument('--baseline', help="Compare results against this JSON file written with --output")
+    parser.add_argument('--threshold', type=float, default=0.1, help="Allowed slowdown relative to the baseline")
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_case:
+        print(json.dumps(run_case(json.loads(args.run_case), args.repeat)))
+        return 0
+
+    cases = make_cases(args.functions, args.backends, args.db_sizes, args.queries, args.bits, args.top_n)
+    results = run(cases, args.repeat, isolate=not args.no_isolate, log=print)
+
+    for r in results:
+        if r['backend'] != 'numpy' and r['speedup'] is not None:
+            print('%-24s db=%-8d q=%-6d bits=%-5d top_n=%-6d speedup x%.2f' %
+                  (r['function'], r['db_size'], r['queries'], r['bits'], r['top_n'], r['speedup']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(environment=environment(), results=results), f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline['results'], args.threshold)
+        for r, reference in regressions:
+            print('REGRESSION %-24s %-6s db=%-8d q=%-6d bits=%-5d top_n=%-6d %.4f s, baseline %.4f s' %
+                  (tuple(r[k] for k in _KEY) + (r['seconds'], reference)))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
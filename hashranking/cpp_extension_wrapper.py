@@ -1,8 +1,8 @@
 from hashranking import hashranking_cpp
 
 
-def hamming_rank(b1, b2):
+def hamming_rank(b1, b2, num_threads=0, workspace=None):
     """Return rank of pairs. Takes vector of hashes b1 and b2 and returns correspondence rank of b1 to b2
     """
-    dist_h = hashranking_cpp.hamming_distance(b1, b2)
-    return hashranking_cpp.argsort(dist_h)
+    dist_h = hashranking_cpp.hamming_distance(b1, b2, num_threads, workspace=workspace)
+    return hashranking_cpp.argsort(dist_h, num_threads, workspace=workspace)
@@ -0,0 +1,142 @@
+# Copyright 2017-2019 Stanislav Pidhorskyi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Persistent index of packed hashes"""
+
+import numpy as np
+from hashranking import hashranking_cpp
+
+
+_MAGIC = b'HASHRANK'
+_VERSION = 1
+_ALIGNMENT = 64
+
+# File starts with this header, followed by packed hashes and then by labels, each aligned to 64 bytes.
+# Everything is stored in little-endian byte order
+_HEADER = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('words', '<u4'),
+    ('size', '<u8'),
+    ('label_dtype', 'S8'),
+    ('label_width', '<u8'),
+])
+
+
+def _align(offset):
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+class HashIndex(object):
+    """Database of packed hashes and their labels.
+
+    Can be saved to a binary file and opened back with memory mapping, in which case hashes are not copied into
+    process memory and are shared between all processes that open the same file.
+    """
+
+    def __init__(self, hashes, labels=None):
+        """Takes float hashes or hashes packed with pack_hashes and optional vector of labels"""
+        self.hashes = hashranking_cpp.pack_hashes(hashes)
+        self.labels = None
+        if labels is not None:
+            self.labels = np.asarray(labels)
+            if self.labels.shape[0] != self.hashes.shape[0]:
+                raise ValueError("Size of hashes and labels must match")
+
+    def __len__(self):
+        return self.hashes.shape[0]
+
+    @property
+    def words(self):
+        """Number of uint64 words per hash"""
+        return self.hashes.shape[1]
+
+    def save(self, path):
+        """Save index to a binary file"""
+        header = np.zeros((), dtype=_HEADER)
+        header['magic'] = _MAGIC
+        header['version'] = _VERSION
+        header['words'] = self.words
+        header['size'] = len(self)
+        if self.labels is not None:
+            labels = self.labels.astype(self.labels.dtype.newbyteorder('<'), copy=False)
+            header['label_dtype'] = labels.dtype.str.encode('ascii')
+            header['label_width'] = labels.shape[1] if labels.ndim > 1 else 0
+
+        with open(path, 'wb') as f:
+            f.write(header.tobytes())
+            f.write(b'\0' * (_align(f.tell()) - f.tell()))
+            f.write(np.ascontiguousarray(self.hashes, dtype='<u8').tobytes())
+            if self.labels is not None:
+                f.write(b'\0' * (_align(f.tell()) - f.tell()))
+                f.write(np.ascontiguousarray(labels).tobytes())
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Open index saved with save. If mmap is True, hashes and labels are memory mapped read only,
+        otherwise they are read into memory
+        """
+        header = np.fromfile(path, dtype=_HEADER, count=1)
+        if header.shape[0] != 1 or header['magic'][0] != _MAGIC:
+            raise ValueError("%s is not a hash index file" % path)
+        if header['version'][0] != _VERSION:
+            raise ValueError("Unsupported hash index version: %d" % header['version'][0])
+
+        words = int(header['words'][0])
+        size = int(header['size'][0])
+        offset = _align(_HEADER.itemsize)
+
+        index = cls.__new__(cls)
+        index.hashes = _read_array(path, '<u8', (size, words), offset, mmap)
+        index.labels = None
+
+        label_dtype = header['label_dtype'][0].decode('ascii')
+        if label_dtype:
+            label_width = int(header['label_width'][0])
+            shape = (size, label_width) if label_width > 0 else (size,)
+            offset = _align(offset + size * words * 8)
+            index.labels = _read_array(path, label_dtype, shape, offset, mmap)
+
+        return index
+
+    def rank(self, hashes_query, num_threads=0):
+        """Return rank of all hashes in the index for each query"""
+        return hashranking_cpp.argsort(hashranking_cpp.hamming_distance(hashes_query, self.hashes, num_threads), num_threads)
+
+    def search(self, hashes_query, k, num_threads=0):
+        """Return indices and hamming distances of k nearest hashes for each query. Ties are ordered by index"""
+        return hashranking_cpp.hamming_topk(hashes_query, self.hashes, k, num_threads)
+
+    def compute_map(self, hashes_query, labels_query, top_n=0, and_mode=False, num_threads=0):
+        """Compute mAP of retrieval from the index, labels of the index are used as ground truth.
+        If and_mode is set, labels are multi-label bitmasks
+        """
+        if self.labels is None:
+            raise ValueError("Index has no labels")
+        return hashranking_cpp.compute_map_from_hashes(self.hashes, hashes_query, self.labels, labels_query, top_n,
+                                                       and_mode=and_mode, num_threads=num_threads)
+
+
+def _read_array(path, dtype, shape, offset, mmap):
+    dtype = np.dtype(dtype)
+    if shape[0] == 0:
+        return np.zeros(shape, dtype=dtype.newbyteorder('='))
+    if mmap:
+        array = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+    else:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            array = np.fromfile(f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+    # No copy on little-endian machines
+    return array.astype(dtype.newbyteorder('='), copy=False)
@@ -14,16 +14,73 @@
 # ==============================================================================
 """Methods to work with hashes"""
 
+import math
 import numpy as np
 
+# Number of elements of the largest temporary array, queries are processed in blocks that fit into it
+_BATCH_ELEMENTS = 1 << 22
 
-def hamming_distance(b1, b2):
-    """Compute the hamming distance between every pair of data points represented in each row of b1 and b2"""
-    p1 = np.sign(b1).astype(np.int8)
-    p2 = np.sign(b2).astype(np.int8)
+# Recall is summed in fixed point with 32 fractional bits, as in C++ extension
+_RECALL_SCALE = 2.0 ** 32
 
-    r = p1.shape[1]
-    d = (r - np.matmul(p1, np.transpose(p2))) // 2
+# Raw bits of the largest positive value, which is infinity, of 16-bit float formats
+_POSITIVE_MAX = {'float16': np.uint16(0x7c00), 'bfloat16': np.uint16(0x7f80)}
+
+# Number of set bits of every byte, used where numpy has no bitwise_count
+_POPCOUNT_TABLE = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1).sum(axis=1).astype(np.uint8)
+
+
+def pack_hashes(hashes, dtype=''):
+    """Pack float hashes into uint64 words, bit i of a hash is set if its i-th element is positive.
+    dtype set to 'float16' or 'bfloat16' makes 16-bit integer arrays to be read as that format.
+    Gives the same result as C++ extension
+    """
+    b = np.asarray(hashes)
+    if dtype:
+        if dtype not in _POSITIVE_MAX or b.dtype.itemsize != 2:
+            raise ValueError("dtype must be float16 or bfloat16 and hashes must be a 16-bit array")
+        # Positive numbers, including infinity and excluding NaN, are the range [1, positive_max] of raw bits
+        bits = (b.view(np.uint16) - np.uint16(1)) < _POSITIVE_MAX[dtype]
+    elif b.dtype == np.uint64:
+        return b
+    else:
+        bits = b > 0
+    words = (b.shape[1] + 63) // 64
+    packed = np.packbits(bits, axis=1, bitorder='little')
+    packed = np.pad(packed, ((0, 0), (0, words * 8 - packed.shape[1])), mode='constant')
+    return packed.view('<u8').astype(np.uint64, copy=False)
+
+
+def _unpack_hashes(b):
+    """Unpack hashes packed with pack_hashes into array of +1.0/-1.0"""
+    bits = np.unpackbits(np.ascontiguousarray(b).astype('<u8', copy=False).view(np.uint8), axis=1, bitorder='little')
+    return bits.astype(np.float32) * 2.0 - 1.0
+
+
+def hamming_distance(b1, b2, out=None):
+    """Compute the hamming distance between every pair of data points represented in each row of b1 and b2.
+    Hashes can be given either as float arrays or as packed hashes returned by pack_hashes.
+    Distances are computed on packed hashes in blocks of queries, the dtype is the same as of C++ extension.
+    If out is given, distances are written into it and it is returned, it must be a C-contiguous array of that dtype
+    """
+    p1 = pack_hashes(b1)
+    p2 = pack_hashes(b2)
+    if p1.shape[1] != p2.shape[1]:
+        raise ValueError("Length of hashes must match")
+
+    words = p1.shape[1]
+    dtype = _distance_dtype(words)
+    shape = (p1.shape[0], p2.shape[0])
+    if out is None:
+        d = np.empty(shape, dtype=dtype)
+    else:
+        if not isinstance(out, np.ndarray) or out.dtype != dtype or not out.flags.c_contiguous:
+            raise TypeError("out must be a C-contiguous %s array" % np.dtype(dtype).name)
+        if out.shape != shape:
+            raise RuntimeError("Shape of out must be (len(b1), len(b2))")
+        d = out
+    for q in _batches(p1.shape[0], p2.shape[0] * words):
+        d[q] = _popcount(p1[q, np.newaxis, :] ^ p2[np.newaxis, :, :]).sum(axis=2, dtype=dtype)
     return d
 
 
@@ -31,50 +88,260 @@ def hamming_rank(b1, b2):
     """Return rank of pairs. Takes vector of hashes b1 and b2 and returns correspondence rank of b1 to b2
     """
     dist_h = hamming_distance(b1, b2)
-    return np.argsort(dist_h, 1, kind='mergesort')
+    return np.argsort(dist_h, 1, kind='stable')
+
+
+def hamming_topk(b1, b2, k):
+    """Return indices and hamming distances of k nearest hashes in b2 for each hash in b1
+    """
+    p1 = pack_hashes(b1)
+    p2 = pack_hashes(b2)
+    if k < 0 or k > p2.shape[0]:
+        raise ValueError("k must be in [0, size of b2]")
+    rank = np.empty((p1.shape[0], k), dtype=np.uint32)
+    distance = np.empty(rank.shape, dtype=_distance_dtype(p2.shape[1]))
+    for q in _batches(p1.shape[0], p2.shape[0]):
+        dist_h = hamming_distance(p1[q], p2)
+        rank[q] = np.argsort(dist_h, 1, kind='stable')[:, :k]
+        distance[q] = np.take_along_axis(dist_h, rank[q], axis=1)
+    return rank, distance
+
+
+def hamming_rerank(hashes_query, hashes_db, vectors_query, vectors_db, k, candidates, metric='dot'):
+    """Select `candidates` nearest hashes by hamming distance and return indices and scores of k of them, that are the
+    closest by similarity of float vectors. Metric is 'dot', 'cosine' or 'l2', which is squared euclidean distance
+    """
+    candidates = candidates or np.shape(hashes_db)[0]
+    if k < 0 or k > candidates or candidates > np.shape(hashes_db)[0]:
+        raise ValueError("k must be in [0, candidates] and candidates must not be greater than size of hashes_db")
+    rank, _ = hamming_topk(hashes_query, hashes_db, candidates)
+    x = np.asarray(vectors_query, dtype=np.float32)[:, np.newaxis, :]
+    y = np.asarray(vectors_db, dtype=np.float32)[rank]
+    if metric == 'l2':
+        score = -((x - y) ** 2).sum(axis=2)
+    else:
+        score = (x * y).sum(axis=2)
+        if metric == 'cosine':
+            norm = np.sqrt((x ** 2).sum(axis=2)) * np.sqrt((y ** 2).sum(axis=2))
+            score = np.where(norm > 0, score / np.where(norm > 0, norm, 1), 0)
+        elif metric != 'dot':
+            raise ValueError("Unknown metric %s, must be dot, cosine or l2" % metric)
+    # Closest first, ties ordered by index
+    order = np.lexsort((rank, -score), axis=1)[:, :k]
+    score = np.take_along_axis(score, order, axis=1).astype(np.float32)
+    return np.take_along_axis(rank, order, axis=1).astype(np.uint32), -score if metric == 'l2' else score
+
+
+def asymmetric_score(queries, hashes):
+    """Compute inner product of each real-valued query with each hash taken as a vector of +1 and -1.
+    Larger score means closer
+    """
+    queries = np.asarray(queries, dtype=np.float32)
+    if np.asarray(hashes).dtype == np.uint64:
+        codes = _unpack_hashes(hashes)[:, :queries.shape[1]]
+    else:
+        codes = np.where(np.asarray(hashes) > 0, 1.0, -1.0).astype(np.float32)
+    return np.matmul(queries, np.transpose(codes))
+
+
+def asymmetric_topk(queries, hashes, k):
+    """Return indices and scores of k hashes with the largest asymmetric_score for each query
+    """
+    score = asymmetric_score(queries, hashes)
+    if k < 0 or k > score.shape[1]:
+        raise ValueError("k must be in [0, size of hashes]")
+    rank = np.argsort(-score, 1, kind='mergesort')[:, :k]
+    return rank.astype(np.uint32), np.take_along_axis(score, rank, axis=1)
+
+
+def compute_map_from_hashes(hashes_db, hashes_query, labels_db, labels_query, top_n=0, and_mode=False):
+    """Compute MAP for given set of hashes and labels.
+    If and_mode is set, labels are multi-label bitmasks, given as vectors of integers or arrays of shape (N, words)
+    """
+    hashes_db = pack_hashes(hashes_db)
+    hashes_query = pack_hashes(hashes_query)
+    labels_query = np.asarray(labels_query)
+    Q, N = hashes_query.shape[0], hashes_db.shape[0]
+    top_n = top_n or N
+    if top_n > N:
+        raise ValueError("top_n must not be greater than size of labels_db")
+
+    ap = np.zeros(Q)
+    sums = _CurveSums(top_n)
+    for q in _batches(Q, N):
+        rank = hamming_rank(hashes_query[q], hashes_db)[:, :top_n]
+        s = _compute_similarity(labels_db, labels_query[q], and_mode)
+        ap[q] = _average_precision(np.take_along_axis(s, rank, axis=1), s.sum(axis=1), sums)
+    return sums.result(ap)
+
+
+def compute_metrics(hashes_db, hashes_query, labels_db, labels_query, map_at=(), precision_at=(), ndcg_at=(), radius=(),
+                    per_query=False, and_mode=False):
+    """Compute several retrieval metrics, returns dict with the same keys and values as C++ extension"""
+    hashes_db = pack_hashes(hashes_db)
+    hashes_query = pack_hashes(hashes_query)
+    labels_query = np.asarray(labels_query)
+    Q, N = hashes_query.shape[0], hashes_db.shape[0]
+    for k in list(map_at) + list(precision_at) + list(ndcg_at):
+        if k < 0 or k > N:
+            raise ValueError("Cutoffs must not be negative or greater than size of labels_db")
+    for r in radius:
+        if r < 0:
+            raise ValueError("Radius must not be negative")
+
+    def key(name, k):
+        return name if k == 0 else '%s@%d' % (name, k)
+
+    # Discounts are taken with libm and summed in order, as in C++ extension, so that NDCG is the same to the last bit
+    discount = np.array([1.0 / math.log2(i + 2.0) for i in range(max([k or N for k in ndcg_at], default=0))])
+    ideal = np.concatenate([[0.0], np.cumsum(discount)])
+
+    # Values of every query are computed in blocks of queries, means are taken at the end
+    values = {}
+    for q in _batches(Q, N):
+        distance = hamming_distance(hashes_query[q], hashes_db)
+        rank = np.argsort(distance, 1, kind='stable')
+        s = _compute_similarity(labels_db, labels_query[q], and_mode)
+        relevance = np.take_along_axis(s, rank, axis=1)
+        cumulative = np.cumsum(relevance, axis=1, dtype=np.int64)
+        total = s.sum(axis=1)
 
+        def put(name, value):
+            values.setdefault(name, np.zeros(Q))[q] = value
 
-def compute_map_from_hashes(hashes_db, hashes_query, labels_db, labels_query, top_n=0):
-    """Compute MAP for given set of hashes and labels"""
-    rank = hamming_rank(hashes_query, hashes_db)
-    s = _compute_similarity(labels_db, labels_query)
-    return compute_map_from_rank(rank, s, top_n)
+        for k in map_at:
+            put(key('map', k), _average_precision(relevance[:, :k or N], total))
+        for k in precision_at:
+            put(key('precision', k), cumulative[:, (k or N) - 1] / float(k or N))
+        for k in ndcg_at:
+            gain = np.where(relevance[:, :k or N], discount[:k or N], 0.0)
+            dcg = np.cumsum(gain, axis=1)[:, -1] if gain.shape[1] else np.zeros(gain.shape[0])
+            put(key('ndcg', k), np.divide(dcg, ideal[np.minimum(total, k or N)], out=np.zeros_like(dcg),
+                                          where=total > 0))
+        for r in radius:
+            within = distance <= r
+            retrieved = within.sum(axis=1)
+            retrieved_relevant = (within & s).sum(axis=1)
+            put('precision_radius@%d' % r, np.where(retrieved > 0, retrieved_relevant / np.maximum(retrieved, 1), 0.0))
+            put('recall_radius@%d' % r, np.where(total > 0, retrieved_relevant / np.maximum(total, 1), 0.0))
+
+    result = {}
+    for name, value in values.items():
+        result[name] = _mean(value)
+        if per_query and name.startswith('map'):
+            result['ap' + name[3:]] = value
+    return result
+
+
+def _mean(values):
+    """Mean summed in order, same as in C++ extension"""
+    return sum(values.tolist()) / len(values)
 
 
 def _compute_similarity(labels_db, labels_query, and_mode=False):
     """Return similarity matrix between two label vectors
-    The output is binary matrix of size n_train x n_test
+    The output is binary matrix of size n_test x n_train
     """
+    labels_db = np.asarray(labels_db)
+    labels_query = np.asarray(labels_query)
     if and_mode:
-        return np.bitwise_and(labels_db, np.transpose(labels_query)).astype(dtype=np.bool)
+        if labels_db.ndim == 1:
+            labels_db = labels_db[:, np.newaxis]
+            labels_query = labels_query[:, np.newaxis]
+        common = np.bitwise_and(labels_query[:, np.newaxis, :], labels_db[np.newaxis, :, :])
+        return np.any(common != 0, axis=2)
     else:
         return np.equal(labels_db, labels_query[:, np.newaxis])
 
 
-def compute_map_from_rank(rank, s, top_n):
-    """compute mean average precision (MAP)"""
+def compute_map_from_rank(rank, similarity, top_n):
+    """compute mean average precision (MAP). Queries are processed in blocks, results are bit-exact the same as of
+    C++ extension
+    """
+    rank = np.asarray(rank)
+    s = np.asarray(similarity)
     Q, N = s.shape
-    if top_n == 0:
-        top_n = N
-    pos = np.asarray(range(1, top_n + 1), dtype=np.float32)
-    mAP = 0
-    av_precision = np.zeros(top_n)
-    av_recall = np.zeros(top_n)
-    for q in range(Q):
-        relevance = s[q, rank[q, :top_n]]
-        cumulative = np.cumsum(relevance)
-        max_number_of_relevant_documents = min(np.sum(s[q]), top_n)
-        if max_number_of_relevant_documents != 0:
-            precision = cumulative.astype(np.float32) / pos
-            recall = cumulative / max_number_of_relevant_documents
-            av_precision += precision
-            av_recall += recall
-            ap = np.dot(precision.astype(np.float64), relevance)
-            ap /= max_number_of_relevant_documents
-            mAP += ap
-    mAP /= Q
-    av_precision /= Q
-    av_recall /= Q
-
-    return float(mAP), av_precision, av_recall
+    top_n = top_n or N
+    if top_n > rank.shape[1]:
+        raise ValueError("top_n must not be greater than second dimension of rank")
+
+    # Only the first top_n columns of rank are used, the number of relevant items is counted over the whole row
+    ap = np.zeros(Q)
+    sums = _CurveSums(top_n)
+    for q in _batches(Q, N):
+        relevance = np.take_along_axis(s[q], rank[q, :top_n], axis=1)
+        ap[q] = _average_precision(relevance, s[q].sum(axis=1), sums)
+    return sums.result(ap)
+
+
+def _batches(count, size):
+    """Yield slices of `count` rows, such that each slice has no more than _BATCH_ELEMENTS of rows of `size` elements"""
+    step = max(1, _BATCH_ELEMENTS // max(size, 1))
+    for begin in range(0, count, step):
+        yield slice(begin, min(begin + step, count))
+
+
+def _distance_dtype(words):
+    """Distances are uint8 while hash takes less than four words, up to 192 bits, otherwise uint16, as in C++ extension"""
+    return np.uint16 if 64 * words >= 256 else np.uint8
+
+
+def _popcount(x):
+    """Count set bits of uint64 array x, either per word or per byte. The sum over the last axis is the same"""
+    x = np.ascontiguousarray(x)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x)
+    return _POPCOUNT_TABLE[x.view(np.uint8)]
+
+
+class _CurveSums(object):
+    """Sums of cumulative number of relevant items and of recall at each position, they are integers as in C++
+    extension, so that the result does not depend on the order of queries
+    """
+    def __init__(self, top_n):
+        self.precision = np.zeros(top_n, dtype=np.uint64)
+        self.recall = np.zeros(top_n, dtype=np.uint64)
+
+    def add(self, cumulative, max_relevant):
+        scale = _RECALL_SCALE / max_relevant
+        self.precision += cumulative.sum(axis=0, dtype=np.uint64)
+        self.recall += np.floor(cumulative * scale[:, np.newaxis] + 0.5).astype(np.uint64).sum(axis=0)
+
+    def result(self, ap):
+        """Returns mAP and curves of precision and recall averaged over the queries"""
+        Q = len(ap)
+        pos = np.arange(1, len(self.precision) + 1, dtype=np.float64)
+        av_precision = (self.precision.astype(np.float64) / pos / Q).astype(np.float32)
+        av_recall = (self.recall.astype(np.float64) / _RECALL_SCALE / Q).astype(np.float32)
+        return _mean(ap), av_precision, av_recall
+
+
+def _average_precision(relevance, total, sums=None):
+    """Return average precision of each row of relevance, which are items of a block of queries in the order of rank.
+    Total is the number of relevant items of each query. Precision is summed exactly in fixed point 64.64, as in C++
+    extension, so that AP does not depend on the order of summation
+    """
+    top_n = relevance.shape[1]
+    relevance = relevance != 0
+    cumulative = np.cumsum(relevance, axis=1, dtype=np.int64)
+    max_relevant = np.minimum(total, top_n)
+    valid = max_relevant > 0
+
+    ap = np.zeros(relevance.shape[0])
+    relevance, cumulative, max_relevant = relevance[valid], cumulative[valid], max_relevant[valid]
+    if sums is not None:
+        sums.add(cumulative, max_relevant)
+
+    # Precision is a float32 not smaller than 2^-31, so x has at most 32 fractional bits and hi and lo are integers
+    precision = cumulative.astype(np.float32) / np.arange(1, top_n + 1, dtype=np.float32)
+    x = np.where(relevance, precision, 0).astype(np.float64) * 2.0 ** 32
+    hi = np.floor(x)
+    hi_sum = hi.astype(np.uint64).sum(axis=1)
+    lo_sum = ((x - hi) * 2.0 ** 32).astype(np.uint64).sum(axis=1)
 
+    # Sum is hi_sum * 2^32 + lo_sum, split into the integer part and 64 fractional bits
+    shift, mask = np.uint64(32), np.uint64(0xFFFFFFFF)
+    t = hi_sum + (lo_sum >> shift)
+    fraction = ((t & mask) << shift) | (lo_sum & mask)
+    ap[valid] = ((t >> shift).astype(np.float64) + fraction.astype(np.float64) * 2.0 ** -64) / max_relevant
+    return ap
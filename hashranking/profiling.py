@@ -0,0 +1,57 @@
+# Copyright 2017-2019 Stanislav Pidhorskyi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Profiling of the stages of the C++ extension"""
+
+from hashranking import hashranking_cpp
+
+
+class profile(object):
+    """Context manager that enables profiling counters for the duration of the block, for example::
+
+        with hashranking.profile() as p:
+            hashranking.compute_map_from_hashes(hashes_db, hashes_query, labels_db, labels_query)
+        print(p.report())
+
+    After the block, `stats` holds counters of the work done inside it, in the same format as hashranking.stats().
+    Work done in other threads at the same time is counted as well
+    """
+
+    def __init__(self):
+        self.stats = None
+        self._before = None
+        self._was_enabled = False
+
+    def __enter__(self):
+        self._was_enabled = hashranking_cpp.is_stats_enabled()
+        self._before = hashranking_cpp.stats()
+        hashranking_cpp.enable_stats(True)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        after = hashranking_cpp.stats()
+        hashranking_cpp.enable_stats(self._was_enabled)
+        self.stats = {stage: {k: after[stage][k] - self._before[stage][k] for k in after[stage]} for stage in after}
+        return False
+
+    def report(self):
+        """Returns table of stages that ran, with their time, number of calls and throughput"""
+        lines = ['%-18s %8s %12s %12s' % ('stage', 'calls', 'seconds', 'GB/s')]
+        for stage, s in sorted(self.stats.items(), key=lambda x: -x[1]['nanoseconds']):
+            if s['calls'] == 0:
+                continue
+            seconds = s['nanoseconds'] * 1e-9
+            throughput = s['bytes'] / s['nanoseconds'] if s['nanoseconds'] else 0.0
+            lines.append('%-18s %8d %12.6f %12.3f' % (stage, s['calls'], seconds, throughput))
+        return '\n'.join(lines)
@@ -0,0 +1,190 @@
+# Copyright 2017-2019 Stanislav Pidhorskyi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""mAP evaluation in a pool of processes that share one copy of the database"""
+
+import multiprocessing
+import numpy as np
+from hashranking import hashranking_cpp
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+
+class ShardedEvaluator(object):
+    """Evaluates mAP of queries against one database in a pool of processes.
+
+    Packed hashes and labels of the database are placed in shared memory once, so that the machine holds one copy of
+    them regardless of the number of processes and of how many sets of queries are evaluated. Queries are split into
+    shards and the database into db_shards ranges, every pair of them is one task of the pool. Tasks return exact
+    integer sums, so results are exactly the same as compute_map_from_hashes returns.
+
+    Can be used as a context manager, otherwise close must be called to stop the pool and free shared memory.
+    """
+
+    def __init__(self, hashes_db, labels_db, and_mode=False, processes=None, db_shards=1, num_threads=1):
+        """Takes float or packed hashes and labels of the database. Each of `processes` workers runs with num_threads
+        threads, by default there is a worker per core
+        """
+        if shared_memory is None:
+            raise RuntimeError("ShardedEvaluator requires multiprocessing.shared_memory, which is Python 3.8 or newer")
+
+        hashes = hashranking_cpp.pack_hashes(hashes_db)
+        labels = np.ascontiguousarray(labels_db)
+        if labels.dtype.kind not in 'iu':
+            labels = labels.astype(np.uint64 if and_mode else np.uint32)
+        labels = labels.astype(labels.dtype.newbyteorder('='), copy=False)
+        if labels.shape[0] != hashes.shape[0]:
+            raise ValueError("Size of hashes_db and labels_db must match")
+
+        self.size = hashes.shape[0]
+        self.and_mode = and_mode
+        self.num_threads = num_threads
+        self.processes = processes or multiprocessing.cpu_count()
+        bounds = np.linspace(0, self.size, max(min(db_shards, self.size), 1) + 1).astype(int).tolist()
+        self.ranges = list(zip(bounds[:-1], bounds[1:]))
+
+        self._memory = []
+        self._pool = None
+        try:
+            specs = dict(hashes=self._share(hashes), labels=self._share(labels))
+            self._pool = multiprocessing.Pool(self.processes, initializer=_attach, initargs=(specs,))
+        except BaseException:
+            self.close()
+            raise
+
+    def compute_map(self, hashes_query, labels_query, top_n=0, query_shards=None):
+        """Compute mAP, precision and recall curves of the queries, the same as compute_map_from_hashes.
+        Queries are split into query_shards shards, by default one per process
+        """
+        if self._pool is None:
+            raise ValueError("Evaluator is closed")
+
+        hashes_query = hashranking_cpp.pack_hashes(hashes_query)
+        labels_query = np.asarray(labels_query)
+        if labels_query.shape[0] != hashes_query.shape[0]:
+            raise ValueError("Size of hashes_query and labels_query must match")
+
+        if hashes_query.shape[0] == 0:
+            raise ValueError("hashes_query must not be empty")
+
+        bounds = np.linspace(0, hashes_query.shape[0], (query_shards or self.processes) + 1).astype(int)
+        shards = [(hashes_query[b:e], labels_query[b:e]) for b, e in zip(bounds[:-1], bounds[1:]) if e > b]
+        args = (top_n, self.and_mode, self.num_threads)
+
+        # With several ranges, positions of items in a range depend on histograms of all of them, so they go first
+        histograms = [[None] * len(self.ranges) for _ in shards]
+        if len(self.ranges) > 1:
+            tasks = [(shard, r) + args for shard in shards for r in self.ranges]
+            counted = self._pool.map(_count, tasks)
+            histograms = [counted[i * len(self.ranges):(i + 1) * len(self.ranges)] for i in range(len(shards))]
+
+        tasks = [(shard, self.ranges, j, h) + args
+                 for shard, h in zip(shards, histograms) for j in range(len(self.ranges))]
+        ranked = self._pool.map(_rank, tasks)
+
+        # Sums of precision terms are added per query, curves are summed over all tasks
+        ap_sums, max_relevant = [], []
+        precision_sum, recall_sum = ranked[0][2], ranked[0][3]
+        for part in ranked[1:]:
+            precision_sum = precision_sum + part[2]
+            recall_sum = recall_sum + part[3]
+        for i in range(len(shards)):
+            parts = ranked[i * len(self.ranges):(i + 1) * len(self.ranges)]
+            ap = parts[0][0]
+            for part in parts[1:]:
+                ap = _add_fixed_point(ap, part[0])
+            ap_sums.append(ap)
+            max_relevant.append(parts[0][1])
+
+        return hashranking_cpp.StreamingMap.reduce(np.concatenate(ap_sums), np.concatenate(max_relevant),
+                                                   precision_sum, recall_sum)
+
+    def close(self):
+        """Stops the pool and frees shared memory"""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        for shm in self._memory:
+            shm.close()
+            shm.unlink()
+        self._memory = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _share(self, array):
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self._memory.append(shm)
+        np.ndarray(array.shape, array.dtype, buffer=shm.buf)[...] = array
+        return shm.name, array.shape, array.dtype.str
+
+
+def compute_map_sharded(hashes_db, hashes_query, labels_db, labels_query, top_n=0, and_mode=False, processes=None,
+                        db_shards=1, num_threads=1):
+    """Compute mAP in a pool of processes with the database in shared memory, see ShardedEvaluator.
+    Returns exactly the same mAP, precision and recall as compute_map_from_hashes
+    """
+    with ShardedEvaluator(hashes_db, labels_db, and_mode, processes, db_shards, num_threads) as evaluator:
+        return evaluator.compute_map(hashes_query, labels_query, top_n)
+
+
+def _add_fixed_point(a, b):
+    """Adds sums of precision terms returned by StreamingMap.partial_sums, high words are in the first column"""
+    lo = a[:, 1] + b[:, 1]
+    carry = (lo < a[:, 1]).astype(np.uint64)
+    return np.stack([a[:, 0] + b[:, 0] + carry, lo], axis=1)
+
+
+# Database of a worker process, attached to shared memory by the pool initializer
+_shared = {}
+
+
+def _attach(specs):
+    for key, (name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        _shared[key] = (shm, np.ndarray(shape, dtype, buffer=shm.buf))
+
+
+def _db(begin, end):
+    return _shared['hashes'][1][begin:end], _shared['labels'][1][begin:end]
+
+
+def _count(task):
+    (hashes_query, labels_query), (begin, end), top_n, and_mode, num_threads = task
+    evaluator = hashranking_cpp.StreamingMap(hashes_query, labels_query, top_n, and_mode=and_mode,
+                                             num_threads=num_threads)
+    evaluator.count(*_db(begin, end))
+    return evaluator.histograms()
+
+
+def _rank(task):
+    (hashes_query, labels_query), ranges, j, histograms, top_n, and_mode, num_threads = task
+    evaluator = hashranking_cpp.StreamingMap(hashes_query, labels_query, top_n, and_mode=and_mode,
+                                             num_threads=num_threads)
+    if histograms[j] is None:
+        evaluator.count(*_db(*ranges[j]))
+    else:
+        for h in histograms:
+            evaluator.add_histograms(*h)
+        for h in histograms[:j]:
+            evaluator.skip(*h)
+    evaluator.rank(*_db(*ranges[j]))
+    return evaluator.partial_sums()
@@ -0,0 +1,51 @@
+# Copyright 2017-2019 Stanislav Pidhorskyi
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""mAP evaluation over databases that do not fit into memory"""
+
+from hashranking import hashranking_cpp
+
+
+def compute_map_streaming(db, hashes_query, labels_query, top_n=0, and_mode=False, chunk_size=1 << 20, num_threads=0):
+    """Compute mAP over a database given in chunks. Returns exactly the same mAP, precision and recall as
+    compute_map_from_hashes does for the whole database.
+
+    db is either a pair (hashes_db, labels_db), for example of memory mapped arrays, or a sequence of such pairs, for
+    example shards loaded with np.load(path, mmap_mode='r'), or a function that returns an iterator over such pairs.
+    Database is read twice, in slices of at most chunk_size items, so an iterator can not be passed directly.
+    """
+    evaluator = hashranking_cpp.StreamingMap(hashes_query, labels_query, top_n, and_mode=and_mode,
+                                             num_threads=num_threads)
+    for hashes_db, labels_db in _chunks(db, chunk_size):
+        evaluator.count(hashes_db, labels_db)
+    for hashes_db, labels_db in _chunks(db, chunk_size):
+        evaluator.rank(hashes_db, labels_db)
+    return evaluator.result()
+
+
+def _chunks(db, chunk_size):
+    if callable(db):
+        shards = db()
+    elif isinstance(db, tuple) and len(db) == 2 and hasattr(db[0], 'shape'):
+        shards = [db]
+    elif iter(db) is db:
+        raise ValueError("Database is read twice and can not be an iterator, pass a function that returns it instead")
+    else:
+        shards = db
+
+    for hashes_db, labels_db in shards:
+        if len(hashes_db) != len(labels_db):
+            raise ValueError("Size of hashes_db and labels_db must match")
+        for begin in range(0, len(hashes_db), chunk_size):
+            yield hashes_db[begin:begin + chunk_size], labels_db[begin:begin + chunk_size]
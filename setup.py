@@ -128,7 +128,7 @@ definitions = {
 
 extra_compile_args = {
     'darwin': [],
-    'posix': ['-O3', '-funroll-loops', '-march=native', '-mfpmath=sse'],
+    'posix': ['-O3', '-funroll-loops', '-mfpmath=sse', '-fvisibility=hidden'],
     'win32': ['/MT', '/GL', '/GR-'],
 }
 
@@ -166,10 +166,19 @@ setup(
     classifiers=[
         'Development Status :: 3 - Alpha',
         'License :: OSI Approved :: MIT License',
-        'Programming Language :: Python :: 2.7',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
     ],
 
+    # Lazy import of the package relies on module level __getattr__
+    python_requires='>=3.7',
+
     packages=['hashranking'],
 
     ext_modules=[extension],
@@ -16,3 +16,11 @@ class ArgSortTests(unittest.TestCase):
         dist = np.random.randint(0, 64, size=(500, 1000), dtype=np.uint8)
         self.assertTrue((hashranking.argsort(dist) == np.argsort(dist, 1, kind='mergesort')).all())
 
+
+    def test_on_random_uint8(self):
+        dist = np.random.randint(0, 256, size=(500, 1000)).astype(np.uint8)
+        self.assertTrue((hashranking.argsort(dist) == np.argsort(dist, 1, kind='mergesort')).all())
+
+    def test_on_random_uint16(self):
+        dist = np.random.randint(0, 1025, size=(500, 1000)).astype(np.uint16)
+        self.assertTrue((hashranking.argsort(dist) == np.argsort(dist, 1, kind='mergesort')).all())
@@ -0,0 +1,99 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import hashranking
+import numpy as np
+import unittest
+from tests import timer
+
+
+class AsymmetricTests(unittest.TestCase):
+    def test_score(self):
+        for hash_size in [5, 24, 64, 100, 256]:
+            queries = np.random.randn(50, hash_size).astype(np.float32)
+            hashes = np.random.randn(300, hash_size).astype(np.float32)
+
+            s_py = hashranking.numpy_implementation.asymmetric_score(queries, hashes)
+            s_cpp = hashranking.asymmetric_score(queries, hashes)
+            self.assertEqual(s_cpp.dtype, np.float32)
+            self.assertTrue(np.allclose(s_py, s_cpp, rtol=1e-5, atol=1e-4))
+
+            packed = hashranking.pack_hashes(hashes)
+            self.assertTrue((hashranking.asymmetric_score(queries, packed) == s_cpp).all())
+            self.assertTrue(np.allclose(hashranking.numpy_implementation.asymmetric_score(queries, packed), s_py))
+
+    def test_topk(self):
+        # Integer valued queries give exact scores with many ties
+        for hash_size in [8, 64, 130]:
+            queries = np.random.randint(-3, 4, size=(40, hash_size)).astype(np.float32)
+            hashes = hashranking.pack_hashes(np.random.randn(500, hash_size))
+
+            for k in [0, 1, 10, 500]:
+                r_py, s_py = hashranking.numpy_implementation.asymmetric_topk(queries, hashes, k)
+                r_cpp, s_cpp = hashranking.asymmetric_topk(queries, hashes, k)
+                self.assertTrue((r_py == r_cpp).all())
+                self.assertTrue((s_py == s_cpp).all())
+                self.assertEqual((r_py.dtype, s_py.dtype), (r_cpp.dtype, s_cpp.dtype))
+
+        for f in [hashranking.asymmetric_topk, hashranking.numpy_implementation.asymmetric_topk]:
+            for k in [501, -1]:
+                with self.assertRaisesRegex(ValueError, r'k must be in \[0, size of hashes\]'):
+                    f(queries, hashes, k)
+        with self.assertRaises(RuntimeError):
+            hashranking.asymmetric_score(queries[:, :60], hashes)
+
+    def test_non_finite(self):
+        # Sum of -1e38 taken eight times overflows, so that the third query scores -inf with every hash
+        hashes = np.random.randn(300, 64).astype(np.float32)
+        hashes[:, ::8] = 1.0
+        queries = np.random.randint(-3, 4, size=(4, 64)).astype(np.float32)
+        queries[1, 5] = np.nan
+        queries[2, :] = 0.0
+        queries[2, ::8] = -1e38
+        queries[3, :] = np.nan
+
+        for k in [3, 100, 300]:
+            with np.errstate(over='ignore'):
+                r_py, s_py = hashranking.numpy_implementation.asymmetric_topk(queries, hashes, k)
+            for num_threads in [1, 2]:
+                r_cpp, s_cpp = hashranking.asymmetric_topk(queries, hashes, k, num_threads=num_threads)
+                self.assertTrue((r_py == r_cpp).all())
+                self.assertTrue(np.array_equal(s_py, s_cpp, equal_nan=True))
+        self.assertTrue(np.isneginf(s_cpp[2]).all())
+
+    def test_all_kernels(self):
+        default = hashranking.simd_kernel()
+        try:
+            for kernel in hashranking.supported_simd_kernels():
+                hashranking.set_simd_kernel(kernel)
+                for hash_size in [1, 7, 33, 64, 100, 257]:
+                    for db_size in [1, 15, 17, 100]:
+                        queries = np.random.randint(-3, 4, size=(10, hash_size)).astype(np.float32)
+                        hashes = np.random.randn(db_size, hash_size).astype(np.float32)
+                        s_py = hashranking.numpy_implementation.asymmetric_score(queries, hashes)
+                        self.assertTrue((hashranking.asymmetric_score(queries, hashes) == s_py).all())
+        finally:
+            hashranking.set_simd_kernel(default)
+
+    def test_performance(self):
+        queries = np.random.randn(200, 64).astype(np.float32)
+        hashes = np.random.randn(100000, 64).astype(np.float32)
+        packed = hashranking.pack_hashes(hashes)
+
+        @timer.timer
+        def numpy():
+            return hashranking.numpy_implementation.asymmetric_topk(queries, hashes, 100)
+
+        @timer.timer
+        def cpp_extension():
+            return hashranking.asymmetric_topk(queries, packed, 100)
+
+        numpy()
+        cpp_extension()
+
+        print("\n")
+
+        print("numpy implementation: %f sec" %(numpy.time))
+        print("cpp implementation: %f sec" %(cpp_extension.time))
+
+        print("\n Speedup: x%.2f" % (numpy.time / cpp_extension.time))
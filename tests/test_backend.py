@@ -0,0 +1,115 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import hashranking
+import inspect
+import numpy as np
+import re
+import subprocess
+import unittest
+
+
+def run_python(code):
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    env = dict(os.environ, PYTHONPATH=root)
+    env.pop('HASHRANKING_BACKEND', None)
+    return subprocess.check_output([sys.executable, '-c', code], env=env).decode('utf-8').split()
+
+
+class BackendTests(unittest.TestCase):
+    def setUp(self):
+        self.default_kernel = hashranking.simd_kernel()
+
+    def tearDown(self):
+        hashranking.set_backend('auto')
+        hashranking.set_simd_kernel(self.default_kernel)
+
+    def test_dispatch(self):
+        self.assertEqual(hashranking.backend(), 'cpp:' + self.default_kernel)
+        self.assertIs(hashranking.compute_map_from_hashes, hashranking.hashranking_cpp.compute_map_from_hashes)
+
+        labels = np.random.randint(10, size=200).astype(np.uint32)
+        hashes = np.random.randn(200, 32).astype(np.float32)
+        expected = hashranking.compute_map_from_hashes(hashes, hashes[:20], labels, labels[:20], 100, num_threads=2)
+
+        hashranking.set_backend('numpy')
+        self.assertEqual(hashranking.backend(), 'numpy')
+        result = hashranking.compute_map_from_hashes(hashes, hashes[:20], labels, labels[:20], 100, num_threads=2)
+        self.assertAlmostEqual(result[0], expected[0], places=5)
+        self.assertEqual(hashranking.hamming_topk.__name__, 'hamming_topk')
+
+        hashranking.set_backend('scalar')
+        self.assertEqual(hashranking.backend(), 'cpp:scalar')
+        self.assertIs(hashranking.pack_hashes, hashranking.hashranking_cpp.pack_hashes)
+
+        with self.assertRaises(ValueError):
+            hashranking.set_backend('sse9')
+
+    def test_arguments(self):
+        # Arguments are passed to both backends in the same way, by position and by name
+        b1 = np.random.randn(20, 64).astype(np.float32)
+        b2 = np.random.randn(50, 64).astype(np.float32)
+        expected = hashranking.hamming_distance(b1, b2)
+        for name in ['cpp', 'numpy']:
+            hashranking.set_backend(name)
+            self.assertTrue((hashranking.hamming_distance(b1, b2, 4) == expected).all())
+            out = np.zeros((20, 50), dtype=np.uint8)
+            self.assertIs(hashranking.hamming_distance(b1, b2, 2, out=out), out)
+            self.assertTrue((out == expected).all())
+            with self.assertRaises(TypeError):
+                hashranking.hamming_distance(b1, b2, out=np.zeros((20, 50), dtype=np.uint16))
+            with self.assertRaises(TypeError):
+                hashranking.hamming_distance(b1, b2, 1, num_threads=1)
+
+            half = b1[:, :32].astype(np.float16)
+            self.assertTrue((hashranking.pack_hashes(half.view(np.uint16), 1, 'float16') ==
+                             hashranking.pack_hashes(half)).all())
+
+    def test_errors(self):
+        # Invalid values of arguments raise ValueError with both backends
+        labels = np.random.randint(10, size=200).astype(np.uint32)
+        hashes = np.random.randn(200, 32).astype(np.float32)
+        for name in ['cpp', 'numpy']:
+            hashranking.set_backend(name)
+            with self.assertRaises(ValueError):
+                hashranking.compute_map_from_hashes(hashes, hashes[:20], labels, labels[:20], 201)
+            with self.assertRaises(ValueError):
+                hashranking.compute_metrics(hashes, hashes[:20], labels, labels[:20], map_at=[201])
+            with self.assertRaises(ValueError):
+                hashranking.compute_metrics(hashes, hashes[:20], labels, labels[:20], radius=[-1])
+            with self.assertRaises(ValueError):
+                hashranking.hamming_topk(hashes[:20], hashes, 201)
+
+    def test_parameters(self):
+        # Parameters that calls of numpy_implementation are bound to are the ones of the C++ functions
+        for name, parameters in hashranking._PARAMETERS.items():
+            if name == 'hamming_rank':
+                f = hashranking.cpp_extension_wrapper.hamming_rank
+                self.assertEqual(tuple(inspect.signature(f).parameters), parameters)
+            else:
+                signature = getattr(hashranking.hashranking_cpp, name).__doc__.splitlines()[0]
+                self.assertEqual(tuple(re.findall(r'(?:\(|, )(\w+):', signature)), parameters)
+
+    def test_lazy_import(self):
+        loaded = run_python("import sys, hashranking\n"
+                            "print('numpy' in sys.modules, 'hashranking.hashranking_cpp' in sys.modules)")
+        self.assertEqual(loaded, ['False', 'False'])
+
+    def test_fallback(self):
+        # Import of the extension fails when its entry in sys.modules is None
+        result = run_python("import sys\n"
+                            "sys.modules['hashranking.hashranking_cpp'] = None\n"
+                            "import numpy as np\n"
+                            "from hashranking import *\n"
+                            "import hashranking\n"
+                            "h = np.sign(np.random.randn(50, 16))\n"
+                            "print(hashranking.backend(), hamming_distance(h, h, num_threads=1).trace())\n"
+                            "try:\n"
+                            "    hashranking.StreamingMap\n"
+                            "except ImportError:\n"
+                            "    print('ImportError')\n")
+        self.assertEqual(result, ['numpy', '0', 'ImportError'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from hashranking import benchmarks
+from tests.test_backend import run_python
+import unittest
+
+
+class BenchmarkTests(unittest.TestCase):
+    def test_run_and_compare(self):
+        cases = benchmarks.make_cases(db_sizes=[200], queries=[10], bits=[32, 100], top_n=[5, 0])
+        self.assertEqual(len(cases), 2 * 2 * (3 + 2 * 2))
+
+        results = benchmarks.run(cases, repeat=1, isolate=False)
+        for r in results:
+            self.assertGreater(r['seconds'], 0)
+            self.assertGreater(r['pairs_per_second'], 0)
+            if r['backend'] == 'cpp':
+                self.assertIsNotNone(r['speedup'])
+
+        self.assertEqual(benchmarks.compare(results, results), [])
+
+        baseline = [dict(r, seconds=r['seconds'] / 2) for r in results]
+        self.assertEqual(len(benchmarks.compare(results, baseline, threshold=0.5)), len(results))
+
+    def test_isolated(self):
+        case = benchmarks.make_cases(['hamming_distance'], ['cpp'], db_sizes=[100], queries=[10], bits=[64])
+        results = benchmarks.run(case, repeat=1)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['function'], 'hamming_distance')
+
+    def test_numpy_only(self):
+        # The extension can not be imported, only the numpy backend is benchmarked
+        result = run_python("import sys\n"
+                            "sys.modules['hashranking.hashranking_cpp'] = None\n"
+                            "from hashranking import benchmarks\n"
+                            "case = benchmarks.make_cases(['hamming_distance'], ['numpy'], db_sizes=[100], queries=[10],"
+                            " bits=[64])\n"
+                            "r = benchmarks.run(case, repeat=1, isolate=False)[0]\n"
+                            "print(benchmarks.environment()['simd_kernel'], r['peak_rss_mb'] > 0)\n")
+        self.assertEqual(result, ['None', 'True'])
+
+
+if __name__ == '__main__':
+    unittest.main()
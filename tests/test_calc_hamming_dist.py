@@ -60,3 +60,62 @@ class HammingDistTests(unittest.TestCase):
         d2 = hashranking.numpy_implementation.hamming_distance(b1, b2)
 
         self.assertTrue((d1 == d2).all())
+
+    def test_on_random_128(self):
+        b1 = np.random.rand(200, 128).astype(np.float32) - 0.5
+        b2 = np.random.rand(500, 128).astype(np.float32) - 0.5
+        d1 = hashranking.hamming_distance(b1, b2)
+        d2 = hashranking.numpy_implementation.hamming_distance(b1, b2)
+
+        self.assertTrue((d1 == d2).all())
+
+    def test_on_random_200(self):
+        b1 = np.random.rand(200, 200).astype(np.float32) - 0.5
+        b2 = np.random.rand(500, 200).astype(np.float32) - 0.5
+        d1 = hashranking.hamming_distance(b1, b2)
+        d2 = hashranking.numpy_implementation.hamming_distance(b1, b2)
+
+        self.assertEqual(d1.dtype, np.uint16)
+        self.assertTrue((d1 == d2).all())
+
+    def test_on_random_1024(self):
+        b1 = np.random.rand(20, 1024).astype(np.float32) - 0.5
+        b2 = np.random.rand(50, 1024).astype(np.float32) - 0.5
+        d1 = hashranking.hamming_distance(b1, b2)
+        d2 = hashranking.numpy_implementation.hamming_distance(b1, b2)
+
+        self.assertEqual(d1.dtype, np.uint16)
+        self.assertTrue((d1 == d2).all())
+        self.assertTrue((hashranking.hamming_distance(b1, -b1).diagonal() == 1024).all())
+
+    def test_tiles(self):
+        # Database is split into several tiles, the last one is incomplete
+        b1 = np.random.rand(30, 1024).astype(np.float32) - 0.5
+        b2 = np.random.rand(1000, 1024).astype(np.float32) - 0.5
+        d1 = hashranking.hamming_distance(b1, b2)
+        d2 = hashranking.numpy_implementation.hamming_distance(b1, b2)
+
+        self.assertTrue((d1 == d2).all())
+
+    def test_out(self):
+        b1 = np.random.rand(20, 64).astype(np.float32) - 0.5
+        b2 = np.random.rand(50, 64).astype(np.float32) - 0.5
+        out = np.zeros((20, 50), dtype=np.uint8)
+        d = hashranking.hamming_distance(b1, b2, out=out)
+
+        self.assertIs(d, out)
+        self.assertTrue((out == hashranking.numpy_implementation.hamming_distance(b1, b2)).all())
+
+        with self.assertRaises(TypeError):
+            hashranking.hamming_distance(b1, b2, out=np.zeros((20, 50), dtype=np.uint16))
+        with self.assertRaises(TypeError):
+            hashranking.hamming_distance(b1, b2, out=np.zeros((50, 20), dtype=np.uint8).T)
+        with self.assertRaises(RuntimeError):
+            hashranking.hamming_distance(b1, b2, out=np.zeros((20, 49), dtype=np.uint8))
+
+    def test_dtype(self):
+        # uint16 is used from four uint64 words, that is for hashes longer than 192 bits
+        for bits, dtype in [(64, np.uint8), (192, np.uint8), (193, np.uint16), (256, np.uint16)]:
+            b = np.random.rand(3, bits).astype(np.float32) - 0.5
+            self.assertEqual(hashranking.hamming_distance(b, b).dtype, dtype)
+            self.assertEqual(hashranking.hamming_distance(hashranking.pack_hashes(b), b).dtype, dtype)
@@ -0,0 +1,80 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import hashranking
+import numpy as np
+import shutil
+import tempfile
+import unittest
+
+
+class HashIndexTests(unittest.TestCase):
+    def setUp(self):
+        db_size = 1000
+        query_size = 200
+        class_count = 10
+        hash_size = 96
+
+        self.db = np.random.randint(class_count, size=db_size, dtype=np.uint32)
+        self.query = np.random.randint(class_count, size=query_size, dtype=np.uint32)
+
+        hashes_class = np.random.rand(class_count, hash_size).astype(np.float32) - 0.5
+
+        self.hashes_db = hashes_class[self.db] + 0.3 * np.random.randn(db_size, hash_size).astype(np.float32)
+        self.hashes_query = hashes_class[self.query] + 0.3 * np.random.randn(query_size, hash_size).astype(np.float32)
+
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'index.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_save_load(self):
+        index = hashranking.HashIndex(self.hashes_db, self.db)
+        index.save(self.path)
+
+        for mmap in [True, False]:
+            loaded = hashranking.HashIndex.load(self.path, mmap=mmap)
+            self.assertEqual(len(loaded), len(index))
+            self.assertEqual(loaded.words, 2)
+            self.assertTrue((loaded.hashes == index.hashes).all())
+            self.assertTrue((loaded.labels == index.labels).all())
+            self.assertEqual(loaded.labels.dtype, np.uint32)
+            self.assertEqual(isinstance(loaded.hashes, np.memmap), mmap)
+            del loaded
+
+    def test_without_labels(self):
+        hashranking.HashIndex(self.hashes_db).save(self.path)
+        loaded = hashranking.HashIndex.load(self.path)
+        self.assertIsNone(loaded.labels)
+        with self.assertRaises(ValueError):
+            loaded.compute_map(self.hashes_query, self.query)
+
+    def test_not_an_index(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'\0' * 100)
+        with self.assertRaises(ValueError):
+            hashranking.HashIndex.load(self.path)
+
+    def test_search(self):
+        hashranking.HashIndex(self.hashes_db, self.db).save(self.path)
+        index = hashranking.HashIndex.load(self.path)
+
+        rank = hashranking.hamming_rank(self.hashes_query, self.hashes_db)
+        distance = hashranking.hamming_distance(self.hashes_query, self.hashes_db)
+
+        self.assertTrue((index.rank(self.hashes_query) == rank).all())
+
+        indices, distances = index.search(self.hashes_query, 10)
+        self.assertTrue((indices == rank[:, :10]).all())
+        self.assertTrue((distances == np.take_along_axis(distance, rank[:, :10].astype(np.intp), axis=1)).all())
+
+    def test_compute_map(self):
+        hashranking.HashIndex(self.hashes_db, self.db).save(self.path)
+        index = hashranking.HashIndex.load(self.path)
+
+        mAP, p, r = index.compute_map(self.hashes_query, self.query, 500)
+        mAP_ref, p_ref, r_ref = hashranking.compute_map_from_hashes(self.hashes_db, self.hashes_query, self.db, self.query, 500)
+        self.assertEqual(mAP, mAP_ref)
+        self.assertTrue((p == p_ref).all())
+        self.assertTrue((r == r_ref).all())
@@ -0,0 +1,113 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import hashranking
+import numpy as np
+import pickle
+import unittest
+
+
+class InputsTests(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        class_count = 10
+        self.labels_db = rng.randint(class_count, size=500).astype(np.uint32)
+        self.labels_query = rng.randint(class_count, size=50).astype(np.uint32)
+        hashes_class = rng.rand(class_count, 48).astype(np.float32) - 0.5
+        self.hashes_db = hashes_class[self.labels_db] + 0.3 * rng.randn(500, 48).astype(np.float32)
+        self.hashes_query = hashes_class[self.labels_query] + 0.3 * rng.randn(50, 48).astype(np.float32)
+
+    def tearDown(self):
+        hashranking.set_strict(False)
+
+    def test_hash_layouts(self):
+        expected = hashranking.pack_hashes(self.hashes_db)
+        wide = np.zeros((1000, 96), dtype=np.float32)
+        wide[::2, 1::2] = self.hashes_db
+
+        for h in [self.hashes_db.astype(np.float64), np.asfortranarray(self.hashes_db), wide[::2, 1::2],
+                  self.hashes_db.astype('>f4'), self.hashes_db.tolist()]:
+            self.assertTrue((hashranking.pack_hashes(h) == expected).all())
+
+        d = hashranking.hamming_distance(self.hashes_query, self.hashes_db)
+        self.assertTrue((hashranking.hamming_distance(self.hashes_query.T.copy().T, wide[::2, 1::2]) == d).all())
+
+    def test_label_dtypes(self):
+        expected = hashranking.compute_map_from_hashes(self.hashes_db, self.hashes_query, self.labels_db,
+                                                       self.labels_query, 100)
+        wide = np.zeros((1000, 2), dtype=np.int64)
+        wide[::2, 1] = self.labels_db
+
+        for dtype in [np.int8, np.uint16, np.int32, np.int64, np.uint64]:
+            mAP, p, r = hashranking.compute_map_from_hashes(self.hashes_db, self.hashes_query,
+                                                            self.labels_db.astype(dtype),
+                                                            self.labels_query.astype(dtype), 100)
+            self.assertEqual(mAP, expected[0])
+            self.assertTrue((p == expected[1]).all())
+            self.assertTrue((r == expected[2]).all())
+
+        mAP, p, r = hashranking.compute_map_from_hashes(self.hashes_db, self.hashes_query, wide[::2, 1],
+                                                        self.labels_query.astype(np.int16), 100)
+        self.assertEqual(mAP, expected[0])
+
+        # Negative labels compare by value
+        mAP, p, r = hashranking.compute_map_from_hashes(self.hashes_db, self.hashes_query,
+                                                        self.labels_db.astype(np.int8) - 5,
+                                                        self.labels_query.astype(np.int64) - 5, 100)
+        self.assertEqual(mAP, expected[0])
+
+    def test_rank_dtypes(self):
+        s = hashranking.numpy_implementation._compute_similarity(self.labels_db, self.labels_query)
+        rank = hashranking.hamming_rank(self.hashes_query, self.hashes_db)
+        expected = hashranking.compute_map_from_rank(rank, s.astype(np.uint8), 100)
+
+        mAP, p, r = hashranking.compute_map_from_rank(rank.astype(np.int64), s, 100)
+        self.assertEqual(mAP, expected[0])
+        self.assertTrue((p == expected[1]).all())
+
+        distance = hashranking.hamming_distance(self.hashes_query, self.hashes_db)
+        self.assertTrue((hashranking.argsort(distance.astype(np.uint16)) == rank).all())
+        self.assertTrue((hashranking.argsort(np.asfortranarray(distance)) == rank).all())
+
+    def test_pickled(self):
+        # Dtypes of unpickled arrays are equal to, but not the same objects as, the builtin ones
+        s = hashranking.numpy_implementation._compute_similarity(self.labels_db, self.labels_query)
+        rank = hashranking.hamming_rank(self.hashes_query, self.hashes_db)
+        expected = hashranking.compute_map_from_rank(rank, s, 100)
+        for r in [rank, rank.astype(np.int64)]:
+            mAP, p, _ = hashranking.compute_map_from_rank(pickle.loads(pickle.dumps(r)), pickle.loads(pickle.dumps(s)), 100)
+            self.assertEqual(mAP, expected[0])
+            self.assertTrue((p == expected[1]).all())
+
+        b = np.random.rand(20, 300).astype(np.float32) - 0.5
+        distance = hashranking.hamming_distance(b, b)
+        self.assertEqual(distance.dtype, np.uint16)
+        expected = hashranking.argsort(distance)
+        self.assertTrue((hashranking.argsort(pickle.loads(pickle.dumps(distance))) == expected).all())
+        self.assertTrue((hashranking.argsort(distance.astype('>u2')) == expected).all())
+
+    def test_strict(self):
+        hashranking.set_strict(True)
+        self.assertTrue(hashranking.is_strict())
+
+        packed = hashranking.pack_hashes(self.hashes_db)
+        hashranking.pack_hashes(self.hashes_db[:, 1:])
+        hashranking.pack_hashes(self.hashes_db.astype(np.float64))
+        hashranking.compute_map_from_hashes(self.hashes_db, self.hashes_query, self.labels_db.astype(np.int8),
+                                            self.labels_query, 100)
+
+        with self.assertRaises(TypeError):
+            hashranking.pack_hashes(self.hashes_db.tolist())
+        with self.assertRaises(TypeError):
+            hashranking.pack_hashes(self.hashes_db.astype(np.int32))
+        with self.assertRaises(TypeError):
+            hashranking.hamming_distance(self.hashes_query, packed[::2])
+        with self.assertRaises(TypeError):
+            hashranking.compute_map_from_hashes(self.hashes_db, self.hashes_query, self.labels_db.astype(np.float32),
+                                                self.labels_query, 100)
+        with self.assertRaises(TypeError):
+            hashranking.argsort(np.asfortranarray(hashranking.hamming_distance(self.hashes_query, self.hashes_db)))
+
+        hashranking.set_strict(False)
+        self.assertFalse(hashranking.is_strict())
+        hashranking.pack_hashes(self.hashes_db.tolist())
@@ -104,6 +104,93 @@ class HammingDistTests(unittest.TestCase):
 
         self.assertEqual(mAP_py, mAP_cpp)
 
+    def test_on_random_256(self):
+        db_size = 1000
+        query_size = 200
+        class_count = 10
+        hash_size = 256
+        top_n = 500
+
+        db = np.random.randint(class_count, size=db_size, dtype=np.uint32)
+        query = np.random.randint(class_count, size=query_size, dtype=np.uint32)
+
+        hashes_class = np.random.rand(class_count, hash_size).astype(np.float32) - 0.5
+
+        hashes_db = hashes_class[db] + 0.3 * np.random.randn(db_size, hash_size).astype(np.float32)
+        hashes_query = hashes_class[query] + 0.3 * np.random.randn(query_size, hash_size).astype(np.float32)
+
+        mAP_py, p, r = hashranking.numpy_implementation.compute_map_from_hashes(hashes_db, hashes_query, db, query, top_n)
+        mAP_cpp, p, r = hashranking.compute_map_from_hashes(hashes_db, hashes_query, db, query, top_n)
+
+        self.assertEqual(mAP_py, mAP_cpp)
+
+    def test_ties(self):
+        db_size = 1000
+        query_size = 200
+        class_count = 10
+        hash_size = 8
+
+        db = np.random.randint(class_count, size=db_size, dtype=np.uint32)
+        query = np.random.randint(class_count, size=query_size, dtype=np.uint32)
+
+        hashes_db = np.random.rand(db_size, hash_size).astype(np.float32) - 0.5
+        hashes_query = np.random.rand(query_size, hash_size).astype(np.float32) - 0.5
+
+        s = hashranking.numpy_implementation._compute_similarity(db, query).astype(np.uint8)
+        rank = hashranking.hamming_rank(hashes_query, hashes_db)
+
+        for top_n in [0, 1, 100, 1000]:
+            mAP_rank, p_rank, r_rank = hashranking.compute_map_from_rank(rank, s, top_n)
+            mAP_cpp, p, r = hashranking.compute_map_from_hashes(hashes_db, hashes_query, db, query, top_n)
+
+            self.assertEqual(mAP_rank, mAP_cpp)
+            self.assertTrue((p_rank == p).all())
+            self.assertTrue((r_rank == r).all())
+
+    def test_numpy_batches(self):
+        db = np.random.randint(10, size=1000, dtype=np.uint32)
+        query = np.random.randint(10, size=200, dtype=np.uint32)
+
+        # Zeros give a zero bit, as in C++ extension
+        hashes_db = np.round(np.random.randn(1000, 48)).astype(np.float32)
+        hashes_query = np.round(np.random.randn(200, 48)).astype(np.float32)
+
+        batch_elements = hashranking.numpy_implementation._BATCH_ELEMENTS
+        try:
+            for elements in [batch_elements, 5000]:
+                hashranking.numpy_implementation._BATCH_ELEMENTS = elements
+                self.assertTrue((hashranking.numpy_implementation.hamming_distance(hashes_query, hashes_db) ==
+                                 hashranking.hamming_distance(hashes_query, hashes_db)).all())
+                for top_n in [0, 1, 100]:
+                    mAP_py, p_py, r_py = hashranking.numpy_implementation.compute_map_from_hashes(
+                        hashes_db, hashes_query, db, query, top_n)
+                    mAP_cpp, p_cpp, r_cpp = hashranking.compute_map_from_hashes(hashes_db, hashes_query, db, query, top_n)
+
+                    self.assertEqual(mAP_py, mAP_cpp)
+                    self.assertTrue((p_py == p_cpp).all())
+                    self.assertTrue((r_py == r_cpp).all())
+        finally:
+            hashranking.numpy_implementation._BATCH_ELEMENTS = batch_elements
+
+    def test_truncated_rank(self):
+        db = np.random.randint(10, size=1000, dtype=np.uint32)
+        query = np.random.randint(10, size=200, dtype=np.uint32)
+        hashes_db = np.random.rand(1000, 32).astype(np.float32) - 0.5
+        hashes_query = np.random.rand(200, 32).astype(np.float32) - 0.5
+
+        # Relevant items are counted over the whole row of similarity, so the first top_n columns of rank are enough
+        s = hashranking.numpy_implementation._compute_similarity(db, query)
+        rank = hashranking.hamming_rank(hashes_query, hashes_db)
+        mAP_cpp, p_cpp, r_cpp = hashranking.compute_map_from_rank(rank, s, 100)
+        mAP_py, p_py, r_py = hashranking.numpy_implementation.compute_map_from_rank(rank[:, :100], s, 100)
+
+        self.assertEqual(mAP_py, mAP_cpp)
+        self.assertTrue((p_py == p_cpp).all())
+        self.assertTrue((r_py == r_cpp).all())
+
+        with self.assertRaises(ValueError):
+            hashranking.numpy_implementation.compute_map_from_rank(rank[:, :100], s, 101)
+
     def test_performance(self):
         db_size = 10000
         query_size = 2000
@@ -0,0 +1,79 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import hashranking
+import numpy as np
+import unittest
+
+
+class MetricsTests(unittest.TestCase):
+    def make_data(self, hash_size, db_size=1000, query_size=200, class_count=10):
+        db = np.random.randint(class_count, size=db_size, dtype=np.uint32)
+        query = np.random.randint(class_count, size=query_size, dtype=np.uint32)
+
+        hashes_class = np.random.rand(class_count, hash_size).astype(np.float32) - 0.5
+
+        hashes_db = hashes_class[db] + 0.3 * np.random.randn(db_size, hash_size).astype(np.float32)
+        hashes_query = hashes_class[query] + 0.3 * np.random.randn(query_size, hash_size).astype(np.float32)
+        return hashes_db, hashes_query, db, query
+
+    def test_against_numpy(self):
+        for hash_size in [8, 24, 64, 256]:
+            data = self.make_data(hash_size)
+            kwargs = dict(map_at=[0, 1, 100], precision_at=[1, 10, 1000], ndcg_at=[0, 10], radius=[0, 2, 300],
+                          per_query=True)
+            m_py = hashranking.numpy_implementation.compute_metrics(*data, **kwargs)
+            m_cpp = hashranking.compute_metrics(*data, **kwargs)
+
+            self.assertEqual(sorted(m_py.keys()), sorted(m_cpp.keys()))
+            for key in m_py:
+                if key.startswith('ap'):
+                    self.assertTrue((m_py[key] == m_cpp[key]).all())
+                else:
+                    self.assertEqual(m_py[key], m_cpp[key], key)
+
+    def test_same_as_map(self):
+        data = self.make_data(32)
+        metrics = hashranking.compute_metrics(*data, map_at=[0, 50, 500], per_query=True)
+        for top_n in [0, 50, 500]:
+            key = 'map@%d' % top_n if top_n else 'map'
+            mAP, p, r = hashranking.compute_map_from_hashes(*data, top_n=top_n)
+            self.assertEqual(metrics[key], mAP)
+            self.assertEqual(metrics['ap' + key[3:]].shape, (200,))
+
+        # Results do not depend on the number of threads
+        self.assertEqual(hashranking.compute_metrics(*data, map_at=[50], ndcg_at=[50], num_threads=1),
+                         hashranking.compute_metrics(*data, map_at=[50], ndcg_at=[50], num_threads=3))
+
+    def test_no_relevant(self):
+        # NDCG of a query without relevant items is zero and is computed without division by zero
+        hashes_db, hashes_query, db, query = self.make_data(32)
+        query[:100] = 10
+        for f in [hashranking.compute_metrics, hashranking.numpy_implementation.compute_metrics]:
+            with np.errstate(all='raise'):
+                metrics = f(hashes_db, hashes_query, db, query, ndcg_at=[0, 10])
+            self.assertEqual(metrics, hashranking.compute_metrics(hashes_db, hashes_query, db, query, ndcg_at=[0, 10]))
+        self.assertLess(metrics['ndcg'], 0.5)
+
+    def test_radius(self):
+        hashes_db = np.asarray([[1, 1, 1], [1, 1, -1], [-1, -1, -1]], dtype=np.float32)
+        hashes_query = np.asarray([[1, 1, 1]], dtype=np.float32)
+        labels_db = np.asarray([0, 1, 0])
+        labels_query = np.asarray([0])
+
+        metrics = hashranking.compute_metrics(hashes_db, hashes_query, labels_db, labels_query, radius=[0, 1, 3],
+                                              precision_at=[2], ndcg_at=[3])
+        self.assertEqual(metrics['precision_radius@0'], 1.0)
+        self.assertEqual(metrics['recall_radius@0'], 0.5)
+        self.assertEqual(metrics['precision_radius@1'], 0.5)
+        self.assertEqual(metrics['precision_radius@3'], 2.0 / 3.0)
+        self.assertEqual(metrics['recall_radius@3'], 1.0)
+        self.assertEqual(metrics['precision@2'], 0.5)
+        self.assertAlmostEqual(metrics['ndcg@3'], (1.0 + 0.5) / (1.0 + 1.0 / np.log2(3)))
+
+        with self.assertRaises(ValueError):
+            hashranking.compute_metrics(hashes_db, hashes_query, labels_db, labels_query, map_at=[4])
+        for kwargs in [dict(map_at=[4]), dict(precision_at=[4]), dict(ndcg_at=[4]), dict(radius=[-1])]:
+            with self.assertRaises(ValueError):
+                hashranking.numpy_implementation.compute_metrics(hashes_db, hashes_query, labels_db, labels_query,
+                                                                 **kwargs)
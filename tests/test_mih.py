@@ -0,0 +1,60 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import hashranking
+import numpy as np
+import unittest
+
+
+class MultiIndexHashTests(unittest.TestCase):
+    def check(self, index, db, queries, r, k):
+        rank = hashranking.hamming_rank(queries, db)
+        distance = hashranking.hamming_distance(queries, db)
+
+        for i, (indices, distances) in enumerate(index.radius_search(queries, r)):
+            expected = rank[i][distance[i][rank[i]] <= r]
+            self.assertTrue((indices == expected).all())
+            self.assertTrue((distances == distance[i][expected]).all())
+            self.assertEqual(distances.dtype, distance.dtype)
+
+        indices, distances = index.knn(queries, k)
+        self.assertTrue((indices == rank[:, :k]).all())
+        self.assertTrue((distances == np.take_along_axis(distance, rank[:, :k], axis=1)).all())
+
+    def test_search(self):
+        for bits in [8, 24, 64, 100, 300]:
+            db = np.random.rand(2000, bits).astype(np.float32) - 0.5
+            queries = np.random.rand(30, bits).astype(np.float32) - 0.5
+            # Some queries are close to items of the database
+            queries[:10] = db[:10] + 0.1 * np.random.randn(10, bits).astype(np.float32)
+
+            index = hashranking.MultiIndexHash(db)
+            self.assertLessEqual(index.substrings, bits)
+            self.check(index, db, queries, bits // 5, 10)
+
+    def test_substrings(self):
+        db = np.random.rand(1000, 64).astype(np.float32) - 0.5
+        queries = np.random.rand(20, 64).astype(np.float32) - 0.5
+        for substrings in [1, 3, 5, 64]:
+            index = hashranking.MultiIndexHash(db, substrings)
+            self.assertEqual(index.substrings, max(substrings, 2))
+            self.check(index, db, queries, 20, 15)
+
+    def test_add(self):
+        db = hashranking.pack_hashes(np.random.rand(1500, 48).astype(np.float32) - 0.5)
+        queries = np.random.rand(20, 48).astype(np.float32) - 0.5
+
+        index = hashranking.MultiIndexHash(db[:0])
+        for begin in range(0, 1500, 400):
+            index.add(db[begin:begin + 400])
+        self.assertEqual(len(index), 1500)
+        self.check(index, db, queries, 12, 1500)
+
+        with self.assertRaises(ValueError):
+            index.knn(queries, 1501)
+        with self.assertRaises(RuntimeError):
+            index.add(np.random.rand(10, 200).astype(np.float32))
+
+
+if __name__ == '__main__':
+    unittest.main()
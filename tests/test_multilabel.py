@@ -0,0 +1,65 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import hashranking
+import numpy as np
+import unittest
+
+
+def make_dataset(db_size, query_size, class_count, hash_size):
+    """Random multi-label dataset, labels are returned as uint64 bitmasks of shape (N, words)"""
+    words = (class_count + 63) // 64
+    db = np.random.rand(db_size, class_count) < 2.0 / class_count
+    query = np.random.rand(query_size, class_count) < 2.0 / class_count
+
+    hashes_class = np.random.rand(class_count, hash_size).astype(np.float32) - 0.5
+
+    hashes_db = np.matmul(db.astype(np.float32), hashes_class) + 0.3 * np.random.randn(db_size, hash_size).astype(np.float32)
+    hashes_query = np.matmul(query.astype(np.float32), hashes_class) + 0.3 * np.random.randn(query_size, hash_size).astype(np.float32)
+
+    def to_bitmask(labels):
+        packed = np.packbits(labels, axis=1, bitorder='little')
+        packed = np.pad(packed, ((0, 0), (0, words * 8 - packed.shape[1])), mode='constant')
+        return packed.view('<u8').astype(np.uint64)
+
+    return to_bitmask(db), to_bitmask(query), hashes_db, hashes_query
+
+
+class MultiLabelTests(unittest.TestCase):
+    def test_similarity(self):
+        s = hashranking.numpy_implementation._compute_similarity(
+            np.asarray([1, 2, 3, 4], dtype=np.uint64), np.asarray([1, 6], dtype=np.uint64), and_mode=True)
+        self.assertTrue((s == [[1, 0, 1, 0], [0, 1, 1, 1]]).all())
+
+    def test_single_word(self):
+        db, query, hashes_db, hashes_query = make_dataset(1000, 200, 21, 48)
+        db = db[:, 0]
+        query = query[:, 0]
+
+        mAP_py, p_py, r_py = hashranking.numpy_implementation.compute_map_from_hashes(hashes_db, hashes_query, db, query, 500, and_mode=True)
+        mAP_cpp, p, r = hashranking.compute_map_from_hashes(hashes_db, hashes_query, db, query, 500, and_mode=True)
+        self.assertEqual(mAP_py, mAP_cpp)
+
+        # 32 bit labels are accepted as well
+        mAP_cpp32, _, _ = hashranking.compute_map_from_hashes(hashes_db, hashes_query, db.astype(np.uint32), query.astype(np.uint32), 500, and_mode=True)
+        self.assertEqual(mAP_cpp32, mAP_cpp)
+
+    def test_multiple_words(self):
+        db, query, hashes_db, hashes_query = make_dataset(1000, 200, 150, 64)
+        self.assertEqual(db.shape[1], 3)
+
+        mAP_py, p_py, r_py = hashranking.numpy_implementation.compute_map_from_hashes(hashes_db, hashes_query, db, query, 0, and_mode=True)
+        mAP_cpp, p, r = hashranking.compute_map_from_hashes(hashes_db, hashes_query, db, query, 0, and_mode=True)
+        self.assertEqual(mAP_py, mAP_cpp)
+        self.assertTrue(np.allclose(p_py, p))
+        self.assertTrue(np.allclose(r_py, r))
+
+        s = hashranking.numpy_implementation._compute_similarity(db, query, and_mode=True)
+        rank = hashranking.hamming_rank(hashes_query, hashes_db)
+        mAP_rank, _, _ = hashranking.compute_map_from_rank(rank, s, 0)
+        self.assertEqual(mAP_rank, mAP_cpp)
+
+    def test_width_mismatch(self):
+        db, query, hashes_db, hashes_query = make_dataset(100, 20, 150, 64)
+        with self.assertRaises(RuntimeError):
+            hashranking.compute_map_from_hashes(hashes_db, hashes_query, db, query[:, :2], 0, and_mode=True)
@@ -0,0 +1,117 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import hashranking
+import numpy as np
+import unittest
+
+try:
+    import ml_dtypes
+except ImportError:
+    ml_dtypes = None
+
+
+class PackHashesTests(unittest.TestCase):
+    def test_basic(self):
+        self.assertTrue((hashranking.pack_hashes([[1.0, -1.0, 1.0]]) == [[5]]).all())
+        self.assertTrue((hashranking.numpy_implementation.pack_hashes([[1.0, -1.0, 1.0]]) == [[5]]).all())
+
+        packed = hashranking.pack_hashes(np.ones((3, 65), dtype=np.float32))
+        self.assertEqual(packed.dtype, np.uint64)
+        self.assertEqual(packed.shape, (3, 2))
+        self.assertTrue((packed[:, 0] == np.uint64(2 ** 64 - 1)).all())
+        self.assertTrue((packed[:, 1] == 1).all())
+
+    def test_same_as_numpy(self):
+        for hash_size in [7, 32, 48, 64, 100, 256]:
+            b = np.random.rand(100, hash_size).astype(np.float32) - 0.5
+            p1 = hashranking.pack_hashes(b)
+            p2 = hashranking.numpy_implementation.pack_hashes(b)
+            self.assertTrue((p1 == p2).all())
+
+    def test_special_values(self):
+        values = np.asarray([0.0, -0.0, np.inf, -np.inf, np.nan, -np.nan, 1e-40, -1e-40, 1.0, -1.0], dtype=np.float32)
+        b = np.tile(values, (3, 20))
+        for dtype in [np.float32, np.float16]:
+            expected = hashranking.numpy_implementation.pack_hashes(b.astype(dtype))
+            self.assertTrue((hashranking.pack_hashes(b.astype(dtype)) == expected).all())
+
+    def test_all_kernels(self):
+        default = hashranking.simd_kernel()
+        try:
+            for kernel in hashranking.supported_simd_kernels():
+                hashranking.set_simd_kernel(kernel)
+                for hash_size in [1, 7, 16, 31, 32, 33, 64, 100, 128, 257]:
+                    b = np.random.randn(50, hash_size).astype(np.float32)
+                    expected = hashranking.numpy_implementation.pack_hashes(b)
+                    self.assertTrue((hashranking.pack_hashes(b) == expected).all())
+                    self.assertTrue((hashranking.pack_hashes(b.astype(np.float16)) == expected).all())
+                    # bfloat16 is the upper half of float32
+                    bf16 = (b.view(np.uint32) >> 16).astype(np.uint16)
+                    self.assertTrue((hashranking.pack_hashes(bf16, dtype='bfloat16') == expected).all())
+                    self.assertTrue((hashranking.pack_hashes(bf16.view(np.int16), dtype='bfloat16') == expected).all())
+        finally:
+            hashranking.set_simd_kernel(default)
+
+    @unittest.skipIf(ml_dtypes is None, "ml_dtypes is not installed")
+    def test_bfloat16(self):
+        b1 = np.random.randn(20, 100).astype(np.float32)
+        b2 = np.random.randn(50, 100).astype(np.float32)
+        d = hashranking.hamming_distance(b1, b2)
+        self.assertTrue((hashranking.pack_hashes(b1.astype(ml_dtypes.bfloat16)) == hashranking.pack_hashes(b1)).all())
+        self.assertTrue((hashranking.hamming_distance(b1.astype(ml_dtypes.bfloat16), b2.astype(np.float16)) == d).all())
+
+    def test_half_distance(self):
+        b1 = np.random.randn(20, 24).astype(np.float32)
+        b2 = np.random.randn(50, 24).astype(np.float32)
+        d = hashranking.hamming_distance(b1, b2)
+        self.assertTrue((hashranking.hamming_distance(b1.astype(np.float16), b2) == d).all())
+
+        with self.assertRaises(ValueError):
+            hashranking.pack_hashes(b1, dtype='bfloat16')
+
+    def test_hamming_distance(self):
+        for hash_size in [24, 64, 128, 300]:
+            b1 = np.random.rand(200, hash_size).astype(np.float32) - 0.5
+            b2 = np.random.rand(500, hash_size).astype(np.float32) - 0.5
+            p1 = hashranking.pack_hashes(b1)
+            p2 = hashranking.pack_hashes(b2)
+            d = hashranking.hamming_distance(b1, b2)
+
+            self.assertTrue((hashranking.hamming_distance(p1, p2) == d).all())
+            self.assertTrue((hashranking.hamming_distance(b1, p2) == d).all())
+            self.assertTrue((hashranking.hamming_distance(p1, b2) == d).all())
+            self.assertTrue((hashranking.numpy_implementation.hamming_distance(p1, p2) == d).all())
+            self.assertTrue((hashranking.numpy_implementation.hamming_distance(b1, p2) == d).all())
+            self.assertTrue((hashranking.hamming_rank(b1, p2) == hashranking.hamming_rank(b1, b2)).all())
+
+    def test_length_mismatch(self):
+        p1 = hashranking.pack_hashes(np.ones((3, 64), dtype=np.float32))
+        p2 = hashranking.pack_hashes(np.ones((3, 65), dtype=np.float32))
+        with self.assertRaises(RuntimeError):
+            hashranking.hamming_distance(p1, p2)
+
+    def test_map(self):
+        db_size = 1000
+        query_size = 200
+        class_count = 10
+        hash_size = 48
+        top_n = 500
+
+        db = np.random.randint(class_count, size=db_size, dtype=np.uint32)
+        query = np.random.randint(class_count, size=query_size, dtype=np.uint32)
+
+        hashes_class = np.random.rand(class_count, hash_size).astype(np.float32) - 0.5
+
+        hashes_db = hashes_class[db] + 0.3 * np.random.randn(db_size, hash_size).astype(np.float32)
+        hashes_query = hashes_class[query] + 0.3 * np.random.randn(query_size, hash_size).astype(np.float32)
+        packed_db = hashranking.pack_hashes(hashes_db)
+
+        mAP, p, r = hashranking.compute_map_from_hashes(hashes_db, hashes_query, db, query, top_n)
+        mAP_packed, p_packed, r_packed = hashranking.compute_map_from_hashes(packed_db, hashes_query, db, query, top_n)
+        mAP_py, _, _ = hashranking.numpy_implementation.compute_map_from_hashes(packed_db, hashes_query, db, query, top_n)
+
+        self.assertEqual(mAP, mAP_packed)
+        self.assertEqual(mAP, mAP_py)
+        self.assertTrue((p == p_packed).all())
+        self.assertTrue((r == r_packed).all())
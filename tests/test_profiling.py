@@ -0,0 +1,54 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import hashranking
+import numpy as np
+import unittest
+
+
+class ProfilingTests(unittest.TestCase):
+    def setUp(self):
+        self.labels_db = np.random.randint(10, size=1000).astype(np.uint32)
+        self.labels_query = np.random.randint(10, size=20).astype(np.uint32)
+        self.hashes_db = np.random.randn(1000, 64).astype(np.float32)
+        self.hashes_query = np.random.randn(20, 64).astype(np.float32)
+
+    def tearDown(self):
+        hashranking.enable_stats(False)
+
+    def test_counters(self):
+        hashranking.reset_stats()
+        hashranking.compute_map_from_hashes(self.hashes_db, self.hashes_query, self.labels_db, self.labels_query, 100)
+        self.assertTrue(all(s['calls'] == 0 for s in hashranking.stats().values()))
+
+        hashranking.enable_stats()
+        self.assertTrue(hashranking.is_stats_enabled())
+        hashranking.compute_map_from_hashes(self.hashes_db, self.hashes_query, self.labels_db, self.labels_query, 100,
+                                            num_threads=2)
+        stats = hashranking.stats()
+        for stage in ['distance', 'similarity', 'histogram', 'rank']:
+            self.assertEqual(stats[stage]['calls'], 20)
+            self.assertGreater(stats[stage]['nanoseconds'], 0)
+        self.assertEqual(stats['distance']['bytes'], 20 * 1000 * 8)
+        self.assertEqual(stats['pack']['calls'], 2)
+        self.assertEqual(stats['pack']['bytes'], 1020 * 64 * 4)
+        self.assertEqual(stats['sort']['calls'], 0)
+
+        hashranking.reset_stats()
+        self.assertTrue(all(s['calls'] == 0 and s['bytes'] == 0 for s in hashranking.stats().values()))
+
+    def test_profile(self):
+        hashranking.enable_stats(False)
+        with hashranking.profile() as outer:
+            hashranking.hamming_rank(self.hashes_query, self.hashes_db)
+            with hashranking.profile() as inner:
+                hashranking.hamming_topk(self.hashes_query, self.hashes_db, 10)
+            self.assertTrue(hashranking.is_stats_enabled())
+        self.assertFalse(hashranking.is_stats_enabled())
+
+        self.assertEqual(inner.stats['distance']['calls'], 20)
+        self.assertEqual(inner.stats['sort']['calls'], 20)
+        self.assertGreater(outer.stats['sort']['calls'], 20)
+        self.assertEqual(outer.stats['histogram']['calls'], 0)
+        self.assertIn('distance', inner.report())
+        self.assertNotIn('histogram', inner.report())
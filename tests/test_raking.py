@@ -54,3 +54,19 @@ class HammingDistTests(unittest.TestCase):
         d2 = hashranking.numpy_implementation.hamming_rank(b1, b2)
 
         self.assertTrue((d1 == d2).all())
+
+    def test_on_random_128(self):
+        b1 = np.random.rand(200, 128).astype(np.float32) - 0.5
+        b2 = np.random.rand(500, 128).astype(np.float32) - 0.5
+        d1 = hashranking.hamming_rank(b1, b2)
+        d2 = hashranking.numpy_implementation.hamming_rank(b1, b2)
+
+        self.assertTrue((d1 == d2).all())
+
+    def test_on_random_512(self):
+        b1 = np.random.rand(50, 512).astype(np.float32) - 0.5
+        b2 = np.random.rand(500, 512).astype(np.float32) - 0.5
+        d1 = hashranking.hamming_rank(b1, b2)
+        d2 = hashranking.numpy_implementation.hamming_rank(b1, b2)
+
+        self.assertTrue((d1 == d2).all())
@@ -0,0 +1,67 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import hashranking
+import numpy as np
+import shutil
+import tempfile
+import unittest
+
+
+class RerankTests(unittest.TestCase):
+    def make_data(self, hash_size, db_size=1000, query_size=50, dim=40):
+        # Integer valued vectors give exact scores in both backends
+        vectors_db = np.random.randint(-4, 5, size=(db_size, dim)).astype(np.float32)
+        vectors_query = np.random.randint(-4, 5, size=(query_size, dim)).astype(np.float32)
+        projection = np.random.randn(dim, hash_size).astype(np.float32)
+        return np.dot(vectors_query, projection), np.dot(vectors_db, projection), vectors_query, vectors_db
+
+    def test_against_numpy(self):
+        for hash_size in [16, 64, 300]:
+            data = self.make_data(hash_size)
+            for metric in ['dot', 'l2']:
+                for k, candidates in [(1, 1), (10, 100), (100, 1000), (0, 0)]:
+                    r_py, s_py = hashranking.numpy_implementation.hamming_rerank(*data, k, candidates, metric)
+                    r_cpp, s_cpp = hashranking.hamming_rerank(*data, k, candidates, metric)
+                    self.assertTrue((r_py == r_cpp).all())
+                    self.assertTrue((s_py == s_cpp).all())
+                    self.assertEqual((r_py.dtype, s_py.dtype), (r_cpp.dtype, s_cpp.dtype))
+
+            r_py, s_py = hashranking.numpy_implementation.hamming_rerank(*data, 10, 100, 'cosine')
+            r_cpp, s_cpp = hashranking.hamming_rerank(*data, 10, 100, 'cosine')
+            self.assertTrue(np.allclose(s_py, s_cpp))
+
+    def test_exhaustive(self):
+        hashes_query, hashes_db, vectors_query, vectors_db = self.make_data(32)
+        r, s = hashranking.hamming_rerank(hashes_query, hashes_db, vectors_query, vectors_db, 5, 0)
+        score = np.dot(vectors_query, vectors_db.T)
+        self.assertTrue((s == -np.sort(-score, axis=1)[:, :5]).all())
+        self.assertTrue((np.take_along_axis(score, r.astype(np.int64), axis=1) == s).all())
+
+        for f in [hashranking.hamming_rerank, hashranking.numpy_implementation.hamming_rerank]:
+            for k, candidates in [(11, 10), (-1, 10), (5, 1001), (0, -1)]:
+                with self.assertRaisesRegex(ValueError, r'k must be in \[0, candidates\]'):
+                    f(hashes_query, hashes_db, vectors_query, vectors_db, k, candidates)
+        with self.assertRaises(ValueError):
+            hashranking.hamming_rerank(hashes_query, hashes_db, vectors_query, vectors_db, 5, 10, 'l1')
+
+    def test_memmap(self):
+        hashes_query, hashes_db, vectors_query, vectors_db = self.make_data(64)
+        path = tempfile.mkdtemp()
+        try:
+            mapped = np.memmap(os.path.join(path, 'vectors'), dtype=np.float32, mode='w+', shape=vectors_db.shape)
+            mapped[:] = vectors_db
+            mapped.flush()
+            mapped = np.memmap(os.path.join(path, 'vectors'), dtype=np.float32, mode='r', shape=vectors_db.shape)
+
+            hashranking.set_strict(True)
+            r, s = hashranking.hamming_rerank(hashes_query, hashranking.pack_hashes(hashes_db), vectors_query, mapped,
+                                              10, 200)
+            hashranking.set_strict(False)
+            expected = hashranking.hamming_rerank(hashes_query, hashes_db, vectors_query, vectors_db, 10, 200)
+            self.assertTrue((r == expected[0]).all())
+            self.assertTrue((s == expected[1]).all())
+            del mapped
+        finally:
+            hashranking.set_strict(False)
+            shutil.rmtree(path)
@@ -0,0 +1,69 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import hashranking
+import numpy as np
+import unittest
+from tests.test_multilabel import make_dataset
+from tests.test_streaming import make_single_label_dataset
+
+
+class ShardedTests(unittest.TestCase):
+    def check_same(self, expected, result):
+        self.assertEqual(expected[0], result[0])
+        self.assertTrue((expected[1] == result[1]).all())
+        self.assertTrue((expected[2] == result[2]).all())
+
+    def test_shards(self):
+        db, query, hashes_db, hashes_query = make_single_label_dataset(2000, 101, 10, 64)
+        for db_shards in [1, 3]:
+            with hashranking.ShardedEvaluator(hashes_db, db, processes=2, db_shards=db_shards) as evaluator:
+                for top_n in [0, 100, 2000]:
+                    expected = hashranking.compute_map_from_hashes(hashes_db, hashes_query, db, query, top_n)
+                    for query_shards in [None, 1, 7]:
+                        self.check_same(expected, evaluator.compute_map(hashes_query, query, top_n, query_shards))
+
+                with self.assertRaises(ValueError):
+                    evaluator.compute_map(hashes_query, query, 2001)
+
+    def test_and_mode(self):
+        db, query, hashes_db, hashes_query = make_dataset(1000, 50, 150, 300)
+        expected = hashranking.compute_map_from_hashes(hashes_db, hashes_query, db, query, 300, and_mode=True)
+        result = hashranking.compute_map_sharded(hashes_db, hashes_query, db, query, 300, and_mode=True, processes=2,
+                                                 db_shards=4)
+        self.check_same(expected, result)
+
+    def test_partial_sums(self):
+        db, query, hashes_db, hashes_query = make_single_label_dataset(500, 20, 10, 32)
+        expected = hashranking.compute_map_from_hashes(hashes_db, hashes_query, db, query, 100)
+
+        # Each evaluator counts and ranks its own chunk, histograms are exchanged between the passes
+        first = hashranking.StreamingMap(hashes_query, query, 100)
+        second = hashranking.StreamingMap(hashes_query, query, 100)
+        first.count(hashes_db[:200], db[:200])
+        second.count(hashes_db[200:], db[200:])
+        first_histograms, second_histograms = first.histograms(), second.histograms()
+        first.add_histograms(*second_histograms)
+        second.add_histograms(*first_histograms)
+        first.rank(hashes_db[:200], db[:200])
+        second.skip(*first_histograms)
+        second.rank(hashes_db[200:], db[200:])
+
+        a, b = first.partial_sums(), second.partial_sums()
+        self.assertTrue((a[1] == b[1]).all())
+        ap_sums = hashranking.sharded._add_fixed_point(a[0], b[0])
+        self.check_same(expected, hashranking.StreamingMap.reduce(ap_sums, a[1], a[2] + b[2], a[3] + b[3]))
+
+        with self.assertRaises(RuntimeError):
+            second.result()
+        with self.assertRaises(RuntimeError):
+            second.histograms()
+        with self.assertRaises(RuntimeError):
+            second.skip(np.zeros((20, 10), np.uint32), np.zeros((20, 10), np.uint32))
+
+    def test_closed(self):
+        db, query, hashes_db, hashes_query = make_single_label_dataset(100, 10, 10, 32)
+        evaluator = hashranking.ShardedEvaluator(hashes_db, db, processes=1)
+        evaluator.close()
+        with self.assertRaises(ValueError):
+            evaluator.compute_map(hashes_query, query)
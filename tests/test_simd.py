@@ -0,0 +1,64 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import hashranking
+import numpy as np
+import unittest
+
+
+class SimdKernelTests(unittest.TestCase):
+    def setUp(self):
+        self.default_kernel = hashranking.simd_kernel()
+
+    def tearDown(self):
+        hashranking.set_simd_kernel(self.default_kernel)
+
+    def test_default_is_fastest(self):
+        self.assertEqual(self.default_kernel, hashranking.supported_simd_kernels()[-1])
+        self.assertIn('scalar', hashranking.supported_simd_kernels())
+
+    def test_unknown_kernel(self):
+        with self.assertRaises(ValueError):
+            hashranking.set_simd_kernel('sse9')
+
+    def test_zero_width_distance(self):
+        # Hashes of zero bits are rejected before a kernel is dispatched
+        for h in [np.zeros((5, 0), dtype=np.float32), np.zeros((5, 0), dtype=np.uint64)]:
+            for kernel in hashranking.supported_simd_kernels():
+                hashranking.set_simd_kernel(kernel)
+                with self.assertRaises(RuntimeError):
+                    hashranking.hamming_distance(h, h)
+                with self.assertRaises(RuntimeError):
+                    hashranking.hamming_rank(h, h)
+
+    def test_zero_width_search(self):
+        # 32 and 64-bit kernels read the first word of each hash, so empty hashes must not reach them
+        h = np.zeros((5, 0), dtype=np.float32)
+        vectors = np.ones((5, 4), dtype=np.float32)
+        labels = np.arange(5, dtype=np.uint32) % 2
+        for kernel in hashranking.supported_simd_kernels():
+            hashranking.set_simd_kernel(kernel)
+            with self.assertRaises(RuntimeError):
+                hashranking.hamming_topk(h, h, 2)
+            with self.assertRaises(RuntimeError):
+                hashranking.hamming_rerank(h, h, vectors, vectors, 2, 3)
+            with self.assertRaises(RuntimeError):
+                hashranking.compute_map_from_hashes(h, h, labels, labels)
+            with self.assertRaises(RuntimeError):
+                hashranking.compute_metrics(h, h, labels, labels, map_at=[0])
+            with self.assertRaises(RuntimeError):
+                hashranking.StreamingMap(h, labels).count(h, labels)
+
+    def test_all_kernels(self):
+        # Sizes are chosen to exercise both vectorized loops and scalar tails
+        for hash_size in [16, 32, 64, 100, 128, 192, 256, 320, 512, 600]:
+            b1 = np.random.rand(37, hash_size).astype(np.float32) - 0.5
+            b2 = np.random.rand(301, hash_size).astype(np.float32) - 0.5
+            d_ref = hashranking.numpy_implementation.hamming_distance(b1, b2)
+            for kernel in hashranking.supported_simd_kernels():
+                hashranking.set_simd_kernel(kernel)
+                self.assertEqual(hashranking.simd_kernel(), kernel)
+                d = hashranking.hamming_distance(b1, b2)
+                self.assertTrue((d == d_ref).all(), "kernel %s, %d bits" % (kernel, hash_size))
+                rank = hashranking.hamming_rank(b1, b2)
+                self.assertTrue((rank == np.argsort(d_ref, 1, kind='mergesort')).all())
@@ -0,0 +1,71 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import hashranking
+import numpy as np
+import unittest
+from tests.test_multilabel import make_dataset
+
+
+def make_single_label_dataset(db_size, query_size, class_count, hash_size):
+    db = np.random.randint(class_count, size=db_size, dtype=np.uint32)
+    query = np.random.randint(class_count, size=query_size, dtype=np.uint32)
+
+    hashes_class = np.random.rand(class_count, hash_size).astype(np.float32) - 0.5
+
+    hashes_db = hashes_class[db] + 0.3 * np.random.randn(db_size, hash_size).astype(np.float32)
+    hashes_query = hashes_class[query] + 0.3 * np.random.randn(query_size, hash_size).astype(np.float32)
+    return db, query, hashes_db, hashes_query
+
+
+class StreamingTests(unittest.TestCase):
+    def check_same(self, expected, result):
+        self.assertEqual(expected[0], result[0])
+        self.assertTrue((expected[1] == result[1]).all())
+        self.assertTrue((expected[2] == result[2]).all())
+
+    def test_chunk_sizes(self):
+        for hash_size in [24, 64, 300]:
+            db, query, hashes_db, hashes_query = make_single_label_dataset(1000, 100, 10, hash_size)
+            for top_n in [0, 50, 1000]:
+                expected = hashranking.compute_map_from_hashes(hashes_db, hashes_query, db, query, top_n)
+                for chunk_size in [1, 7, 256, 1000, 5000]:
+                    result = hashranking.compute_map_streaming((hashes_db, db), hashes_query, query, top_n,
+                                                               chunk_size=chunk_size)
+                    self.check_same(expected, result)
+
+    def test_shards(self):
+        db, query, hashes_db, hashes_query = make_single_label_dataset(1000, 100, 10, 96)
+        expected = hashranking.compute_map_from_hashes(hashes_db, hashes_query, db, query, 200)
+
+        packed = hashranking.pack_hashes(hashes_db)
+        shards = [(packed[:300], db[:300]), (hashes_db[300:310], db[300:310]), (packed[310:], db[310:])]
+
+        self.check_same(expected, hashranking.compute_map_streaming(shards, hashes_query, query, 200, chunk_size=128))
+        self.check_same(expected, hashranking.compute_map_streaming(lambda: iter(shards), hashes_query, query, 200))
+
+        with self.assertRaises(ValueError):
+            hashranking.compute_map_streaming(iter(shards), hashes_query, query, 200)
+
+    def test_and_mode(self):
+        db, query, hashes_db, hashes_query = make_dataset(1000, 100, 150, 64)
+        expected = hashranking.compute_map_from_hashes(hashes_db, hashes_query, db, query, 300, and_mode=True)
+        result = hashranking.compute_map_streaming((hashes_db, db), hashes_query, query, 300, and_mode=True,
+                                                   chunk_size=100)
+        self.check_same(expected, result)
+
+    def test_order_of_passes(self):
+        db, query, hashes_db, hashes_query = make_single_label_dataset(100, 10, 10, 32)
+        evaluator = hashranking.StreamingMap(hashes_query, query)
+        evaluator.count(hashes_db, db)
+        evaluator.rank(hashes_db[:50], db[:50])
+        with self.assertRaises(RuntimeError):
+            evaluator.count(hashes_db, db)
+        with self.assertRaises(RuntimeError):
+            evaluator.result()
+        evaluator.rank(hashes_db[50:], db[50:])
+        self.check_same(hashranking.compute_map_from_hashes(hashes_db, hashes_query, db, query), evaluator.result())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import hashranking
+import numpy as np
+import unittest
+
+
+class ThreadsTests(unittest.TestCase):
+    def setUp(self):
+        db_size = 1000
+        query_size = 201
+        class_count = 10
+        hash_size = 48
+
+        self.db = np.random.randint(class_count, size=db_size, dtype=np.uint32)
+        self.query = np.random.randint(class_count, size=query_size, dtype=np.uint32)
+
+        hashes_class = np.random.rand(class_count, hash_size).astype(np.float32) - 0.5
+
+        self.hashes_db = hashes_class[self.db] + 0.3 * np.random.randn(db_size, hash_size).astype(np.float32)
+        self.hashes_query = hashes_class[self.query] + 0.3 * np.random.randn(query_size, hash_size).astype(np.float32)
+
+    def test_distance_and_rank(self):
+        d1 = hashranking.hamming_distance(self.hashes_query, self.hashes_db, num_threads=1)
+        r1 = hashranking.hamming_rank(self.hashes_query, self.hashes_db, num_threads=1)
+        for num_threads in [2, 3, 8, 0]:
+            d = hashranking.hamming_distance(self.hashes_query, self.hashes_db, num_threads=num_threads)
+            r = hashranking.hamming_rank(self.hashes_query, self.hashes_db, num_threads=num_threads)
+            self.assertTrue((d1 == d).all())
+            self.assertTrue((r1 == r).all())
+
+    def test_map_from_rank(self):
+        s = hashranking.numpy_implementation._compute_similarity(self.db, self.query)
+        rank = hashranking.hamming_rank(self.hashes_query, self.hashes_db)
+        mAP_1, p_1, r_1 = hashranking.compute_map_from_rank(rank, s, 100, num_threads=1)
+        for num_threads in [2, 3, 8, 1000]:
+            mAP, p, r = hashranking.compute_map_from_rank(rank, s, 100, num_threads=num_threads)
+            self.assertEqual(mAP_1, mAP)
+            self.assertTrue((p_1 == p).all())
+            self.assertTrue((r_1 == r).all())
+
+    def test_map_from_hashes(self):
+        mAP_1, p_1, r_1 = hashranking.compute_map_from_hashes(self.hashes_db, self.hashes_query, self.db, self.query, 500, num_threads=1)
+        for num_threads in [2, 3, 8, 1000]:
+            mAP, p, r = hashranking.compute_map_from_hashes(self.hashes_db, self.hashes_query, self.db, self.query, 500, num_threads=num_threads)
+            self.assertEqual(mAP_1, mAP)
+            self.assertTrue((p_1 == p).all())
+            self.assertTrue((r_1 == r).all())
+
+        mAP_py, p_py, r_py = hashranking.numpy_implementation.compute_map_from_hashes(self.hashes_db, self.hashes_query, self.db, self.query, 500)
+        self.assertEqual(mAP_py, mAP_1)
+        self.assertTrue(np.allclose(p_py, p_1))
+        self.assertTrue(np.allclose(r_py, r_1))
@@ -0,0 +1,39 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import hashranking
+import numpy as np
+import unittest
+
+
+class TopKTests(unittest.TestCase):
+    def test_basic(self):
+        b1 = [[1.0, -1.0, -1.0], [-1.0, 1.0, -1.0], [1.0, 1.0, -1.0]]
+        b2 = [[1.0, -1.0, -1.0], [1.0, 1.0, -1.0], [-1.0, 1.0, -1.0]]
+        indices, distances = hashranking.hamming_topk(b1, b2, 2)
+        self.assertTrue((indices == [[0, 1], [2, 1], [1, 0]]).all())
+        self.assertTrue((distances == [[0, 1], [0, 1], [0, 1]]).all())
+
+    def test_on_random(self):
+        for hash_size in [8, 24, 64, 128, 256]:
+            b1 = np.random.rand(200, hash_size).astype(np.float32) - 0.5
+            b2 = np.random.rand(500, hash_size).astype(np.float32) - 0.5
+            rank = hashranking.hamming_rank(b1, b2)
+            distance = hashranking.hamming_distance(b1, b2)
+            for k in [0, 1, 10, 100, 500]:
+                indices, distances = hashranking.hamming_topk(b1, b2, k)
+                self.assertEqual(indices.shape, (200, k))
+                self.assertEqual(distances.dtype, distance.dtype)
+                self.assertTrue((indices == rank[:, :k]).all())
+                self.assertTrue((distances == np.take_along_axis(distance, indices.astype(np.intp), axis=1)).all())
+
+                indices_py, distances_py = hashranking.numpy_implementation.hamming_topk(b1, b2, k)
+                self.assertTrue((indices == indices_py).all())
+                self.assertEqual(indices_py.dtype, indices.dtype)
+                self.assertTrue((distances == distances_py).all())
+
+    def test_k_too_large(self):
+        for f in [hashranking.hamming_topk, hashranking.numpy_implementation.hamming_topk]:
+            for k in [4, -1]:
+                with self.assertRaisesRegex(ValueError, r'k must be in \[0, size of b2\]'):
+                    f(np.ones((2, 8), dtype=np.float32), np.ones((3, 8), dtype=np.float32), k)
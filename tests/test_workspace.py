@@ -0,0 +1,103 @@
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import hashranking
+import numpy as np
+import unittest
+
+
+def _rss_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class WorkspaceTests(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.labels_db = rng.randint(10, size=2000).astype(np.uint32)
+        self.labels_query = rng.randint(10, size=30).astype(np.uint32)
+        self.hashes_db = rng.randn(2000, 64).astype(np.float32)
+        self.hashes_query = rng.randn(30, 64).astype(np.float32)
+        self.vectors_db = rng.randn(2000, 16).astype(np.float32)
+        self.vectors_query = rng.randn(30, 16).astype(np.float32)
+
+    def _calls(self, workspace, num_threads=0):
+        """Calls every entry point and returns copies of the results"""
+        kwargs = dict(num_threads=num_threads, workspace=workspace)
+        distance = hashranking.hamming_distance(self.hashes_query, self.hashes_db, **kwargs).copy()
+        rank = hashranking.argsort(distance, **kwargs).copy()
+        s = (self.labels_query[:, None] == self.labels_db[None, :]).astype(np.uint8)
+        results = [
+            hashranking.pack_hashes(self.hashes_db, **kwargs),
+            distance,
+            rank,
+            hashranking.hamming_rank(self.hashes_query, self.hashes_db, **kwargs),
+            hashranking.hamming_topk(self.hashes_query, self.hashes_db, 10, **kwargs),
+            hashranking.compute_map_from_rank(rank, s, 100, **kwargs),
+            hashranking.compute_map_from_hashes(self.hashes_db, self.hashes_query, self.labels_db, self.labels_query,
+                                                100, **kwargs),
+            hashranking.compute_metrics(self.hashes_db, self.hashes_query, self.labels_db, self.labels_query,
+                                        map_at=[0, 100], ndcg_at=[10], radius=[2], per_query=True, **kwargs),
+            hashranking.asymmetric_score(self.hashes_query, self.hashes_db, **kwargs),
+            hashranking.asymmetric_topk(self.hashes_query, self.hashes_db, 10, **kwargs),
+            hashranking.hamming_rerank(self.hashes_query, self.hashes_db, self.vectors_query, self.vectors_db, 5, 50,
+                                       **kwargs),
+        ]
+        return [_copy(r) for r in results]
+
+    def test_same_results(self):
+        expected = self._calls(None)
+        workspace = hashranking.Workspace()
+        for num_threads in [1, 3, 1]:
+            self.assertEqual(_flatten(self._calls(workspace, num_threads)), _flatten(expected))
+        self.assertGreater(workspace.nbytes, 0)
+
+    def test_outputs(self):
+        workspace = hashranking.Workspace()
+        d1 = hashranking.hamming_distance(self.hashes_query, self.hashes_db, workspace=workspace)
+        d2 = hashranking.hamming_distance(self.hashes_query[::-1], self.hashes_db, workspace=workspace)
+        self.assertTrue(d1 is d2 or np.shares_memory(d1, d2))
+        self.assertTrue((d2 == hashranking.hamming_distance(self.hashes_query[::-1], self.hashes_db)).all())
+
+        # Different shape gets a new array, the old one stays valid
+        d3 = hashranking.hamming_distance(self.hashes_query[:5], self.hashes_db, workspace=workspace)
+        self.assertFalse(np.shares_memory(d2, d3))
+
+        workspace.clear()
+        self.assertEqual(workspace.nbytes, 0)
+        self.assertTrue((d3 == hashranking.hamming_distance(self.hashes_query[:5], self.hashes_db)).all())
+
+    def test_leaks(self):
+        if not os.path.exists('/proc/self/statm'):
+            self.skipTest("RSS is not available")
+
+        workspace = hashranking.Workspace()
+        for w in [None, workspace]:
+            for _ in range(10):
+                self._calls(w)
+        rss = _rss_bytes()
+        for _ in range(100):
+            self._calls(None)
+            self._calls(workspace)
+        self.assertLess(_rss_bytes() - rss, 8 << 20)
+
+
+def _copy(result):
+    if isinstance(result, tuple):
+        return tuple(_copy(r) for r in result)
+    if isinstance(result, dict):
+        return {k: _copy(v) for k, v in result.items()}
+    return np.copy(result) if isinstance(result, np.ndarray) else result
+
+
+def _flatten(result):
+    """Converts nested results to lists, so that they can be compared with assertEqual"""
+    if isinstance(result, (tuple, list)):
+        return [_flatten(r) for r in result]
+    if isinstance(result, dict):
+        return {k: _flatten(v) for k, v in result.items()}
+    return result.tolist() if isinstance(result, np.ndarray) else result
+
+
+if __name__ == '__main__':
+    unittest.main()